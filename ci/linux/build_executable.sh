@@ -4,6 +4,6 @@
 
 rm -Rf ./dist/
 mkdir ./dist/
-pyinstaller --hidden-import fastparquet -p src/ --onedir -y -n ev-flex-metric src/ev_flex_metric/shifted_energy_profiles.py
+pyinstaller --hidden-import fastparquet --exclude-module numba -p src/ --onedir -y -n ev-flex-metric src/ev_flex_metric/shifted_energy_profiles.py
 cp README.md ./dist/
 cp -R ./package_files/* ./dist/
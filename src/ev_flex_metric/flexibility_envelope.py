@@ -0,0 +1,129 @@
+import os
+import sys
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pandas
+import pytz
+from dataclass_binder import Binder
+
+from ev_flex_metric.instrumentation import MemoryBudgetExceeded, StageTimer
+from ev_flex_metric.main import BlockMetadata, ChargingSession, SessionFeatureTable
+from ev_flex_metric.shifted_energy_profiles import ChargingSessionCache, InputConfig, InstrumentationConfig, \
+    OutputProfilesConfig, write_df_to_file
+
+
+@dataclass
+class FlexibilityEnvelopeConfig:
+    pc4: int
+    window_start: datetime
+    window_end: datetime
+    input: InputConfig
+    output: OutputProfilesConfig
+    ptu_duration: timedelta = timedelta(minutes=15)
+    instrumentation: InstrumentationConfig | None = None
+
+
+def fleet_flexibility_envelope(charge_sessions: list[ChargingSession], window: BlockMetadata) -> pandas.DataFrame:
+    """The cumulative energy the fleet of charge_sessions charges within window when charging as late as possible,
+    by default and as early as possible.
+
+    The energy of the fleet by the end of a PTU may be moved anywhere between the lower and the upper envelope. Only
+    the session windows, default energy and max power are used so no sessions are shifted.
+
+    :param charge_sessions: The charge sessions in the steps of window.
+    :param window: The window for which the envelope is calculated. Each session keeps its default energy in the
+        window within the window.
+    :return: The lower, baseline and upper cumulative energy in kWh by the end of each PTU indexed by the start of
+        the PTU.
+    """
+    window_range = window.to_range_in_block_int()
+    lower, baseline, upper = SessionFeatureTable(charge_sessions).cumulative_energy_envelope(window_range.start,
+                                                                                             window_range.end)
+    joule_per_kwh = 3_600_000
+    return pandas.DataFrame(data={'lower_cumulative_energy_kwh': lower / joule_per_kwh,
+                                  'baseline_cumulative_energy_kwh': baseline / joule_per_kwh,
+                                  'upper_cumulative_energy_kwh': upper / joule_per_kwh},
+                            index=pandas.date_range(window.start_time.replace(tzinfo=None),
+                                                    periods=window_range.total_block_duration(),
+                                                    freq=window.step_duration))
+
+
+def sessions_in_window(df_charge_sessions: pandas.DataFrame,
+                       window_start: datetime,
+                       window_end: datetime) -> pandas.DataFrame:
+    """The charge sessions which overlap the window. Sessions outside of the window do not add to the envelope so
+    their profiles need not be read and clipped.
+
+    :param df_charge_sessions: The charge sessions with a start and end column.
+    :param window_start: The start of the window.
+    :param window_end: The end of the window.
+    :return: The charge sessions which start before the end of the window and end after the start of the window.
+    """
+    return df_charge_sessions[(df_charge_sessions['start'] < window_end) & (df_charge_sessions['end'] > window_start)]
+
+
+def calculate_flexibility_envelopes(config: FlexibilityEnvelopeConfig, timer: StageTimer) -> None:
+    window = BlockMetadata(config.window_start, config.window_end, config.ptu_duration)
+
+    print('Reading in charge sessions...')
+    with timer.stage('session_read'):
+        df_charge_sessions = config.input.read_session_table(config.pc4).df
+    print('Read in charge sessions!')
+
+    for (pc4,), df_charge_sessions_pc4_group in df_charge_sessions.groupby(by=['pc4']):
+        print(f'Reading in energy profiles for pc4 area {pc4}...')
+        with timer.stage('profile_read', pc4):
+            df_energy_profiles_for_pc4 = pandas.read_parquet(config.input.energy_profiles_path_template_parquet.replace('{pc4}', str(pc4)))
+            df_energy_profiles_for_pc4['time'] = df_energy_profiles_for_pc4['time'].dt.tz_localize(pytz.utc)
+        print(f'Read in energy profiles!')
+
+        with timer.stage('session_construction', pc4):
+            charge_sessions = ChargingSessionCache(sessions_in_window(df_charge_sessions_pc4_group,
+                                                                      config.window_start,
+                                                                      config.window_end),
+                                                   df_energy_profiles_for_pc4,
+                                                   config.ptu_duration).charging_sessions(window)
+        with timer.stage('envelope', pc4):
+            df_envelope = fleet_flexibility_envelope(charge_sessions, window)
+        window_start_str = config.window_start.replace(tzinfo=None).isoformat(timespec="minutes").replace(":", "")
+        window_end_str = config.window_end.replace(tzinfo=None).isoformat(timespec="minutes").replace(":", "")
+        filename = f'pc4{pc4}_envelope_windowstart{window_start_str}_windowend{window_end_str}'
+        with timer.stage('file_write', pc4):
+            write_df_to_file(config.output, filename, df_envelope)
+        print(f'Wrote the flexibility envelope of {len(charge_sessions)} charge sessions in pc4 {pc4} to {filename}.')
+
+
+def main():
+    timer = StageTimer()
+    try:
+        config_path = Path(os.environ.get("CONFIG_PATH", "flexibility_envelope_config.toml"))
+        print(f"Reading config path at {config_path}")
+        with timer.stage('config_parse'):
+            config = Binder(FlexibilityEnvelopeConfig).parse_toml(config_path)
+    except Exception as ex:
+        print(f"Error reading configuration file: {ex}")
+        sys.exit(1)
+    instrumentation = config.instrumentation or InstrumentationConfig()
+    timer.memory_monitor = instrumentation.memory_monitor()
+
+    exit_code = 0
+    try:
+        calculate_flexibility_envelopes(config, timer)
+    except MemoryBudgetExceeded as ex:
+        print(f'Stopping the run: {ex}')
+        exit_code = 1
+
+    if instrumentation.timing_report_path:
+        timer.write_report(instrumentation.timing_report_path)
+        print(f'Wrote timing report to {instrumentation.timing_report_path}')
+    if instrumentation.memory_profiling and timer.memory_monitor is not None:
+        print('Top allocation sites:')
+        print('\n'.join(timer.memory_monitor.top_allocations()))
+    if exit_code:
+        sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
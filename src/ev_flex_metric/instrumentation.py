@@ -0,0 +1,265 @@
+import csv
+import json
+import math
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator, Optional
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None  # type: ignore
+
+TimingKey = tuple[str, Optional[int], Optional[str]]
+
+MEGABYTE = 1024 * 1024
+
+REPORT_STATISTICS = ['count', 'total_seconds', 'mean_seconds', 'p50_seconds', 'p90_seconds', 'p99_seconds',
+                     'max_seconds']
+
+
+def percentile(sorted_values: list[float], percent: float) -> float:
+    """Percentile of sorted_values using linear interpolation between the closest ranks.
+
+    :param sorted_values: The values sorted in ascending order. Must contain at least one value.
+    :param percent: The percentile to calculate in the range 0..100.
+    :return: The value at the percentile.
+    """
+    position = (len(sorted_values) - 1) * percent / 100
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def duration_statistics(durations: list[float]) -> dict[str, float]:
+    sorted_durations = sorted(durations)
+    return {'count': len(sorted_durations),
+            'total_seconds': sum(sorted_durations),
+            'mean_seconds': sum(sorted_durations) / len(sorted_durations),
+            'p50_seconds': percentile(sorted_durations, 50),
+            'p90_seconds': percentile(sorted_durations, 90),
+            'p99_seconds': percentile(sorted_durations, 99),
+            'max_seconds': sorted_durations[-1]}
+
+
+def current_rss_bytes() -> Optional[int]:
+    """The resident set size of this process.
+
+    Falls back to the peak resident set size on platforms without /proc.
+
+    :return: The resident set size in bytes or None if it cannot be determined on this platform.
+    """
+    try:
+        with open('/proc/self/statm') as open_file:
+            return int(open_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes() -> Optional[int]:
+    """The peak resident set size of this process or None if it cannot be determined on this platform."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes while macOS reports bytes.
+    return max_rss if os.uname().sysname == 'Darwin' else max_rss * 1024
+
+
+class MemoryBudgetExceeded(RuntimeError):
+    pass
+
+
+class MemoryMonitor:
+    """Samples the memory usage at the end of each stage and enforces an optional memory budget.
+
+    The RSS is sampled for every stage. If tracing is enabled, tracemalloc is used to also record the peak of the
+    memory allocated by Python during each stage and the top allocation sites. Tracing slows down the run
+    considerably so it is meant to find the stage and code responsible for high memory usage.
+    """
+    budget_bytes: Optional[int]
+    trace: bool
+    num_top_allocations: int
+    max_rss_per_stage: dict[str, int]
+    max_traced_peak_per_stage: dict[str, int]
+    peak_rss_stage: Optional[tuple[str, Optional[int], Optional[str]]]
+
+    def __init__(self, budget_mb: Optional[float] = None, trace: bool = False, num_top_allocations: int = 10):
+        self.budget_bytes = int(budget_mb * MEGABYTE) if budget_mb is not None else None
+        self.trace = trace
+        self.num_top_allocations = num_top_allocations
+        self.max_rss_per_stage = {}
+        self.max_traced_peak_per_stage = {}
+        self.peak_rss_stage = None
+        self._peak_rss = 0
+        self._active_stages: list[tuple[str, Optional[int], Optional[str]]] = []
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, stage: str, pc4: Optional[int] = None, scenario: Optional[str] = None) -> Iterator[None]:
+        """Record the memory usage of a stage and check the budget when it ends.
+
+        The memory usage is also recorded if the stage raises, in which case the budget is not checked so the error
+        of the stage is not hidden. Long stages call check to stop as soon as the budget is exceeded.
+        """
+        if self.trace:
+            tracemalloc.reset_peak()
+        self._active_stages.append((stage, pc4, scenario))
+        try:
+            yield
+        finally:
+            self._active_stages.pop()
+            if self.trace:
+                _, traced_peak = tracemalloc.get_traced_memory()
+                self.max_traced_peak_per_stage[stage] = max(traced_peak, self.max_traced_peak_per_stage.get(stage, 0))
+            rss = self._sample_rss(stage, pc4, scenario)
+        if rss is not None:
+            self.check_budget(rss, stage, pc4, scenario)
+
+    def _sample_rss(self, stage: str, pc4: Optional[int], scenario: Optional[str]) -> Optional[int]:
+        rss = current_rss_bytes()
+        if rss is not None:
+            self.max_rss_per_stage[stage] = max(rss, self.max_rss_per_stage.get(stage, 0))
+            if rss > self._peak_rss:
+                self._peak_rss = rss
+                self.peak_rss_stage = (stage, pc4, scenario)
+        return rss
+
+    def check(self) -> None:
+        """Check the budget while a stage is running, e.g. once per household or chunk of a long stage.
+
+        Does nothing without a budget so it is cheap to call in loops.
+        """
+        if self.budget_bytes is None or not self._active_stages:
+            return
+        stage, pc4, scenario = self._active_stages[-1]
+        rss = self._sample_rss(stage, pc4, scenario)
+        if rss is not None:
+            self.check_budget(rss, stage, pc4, scenario, during=True)
+
+    def check_budget(self,
+                     rss: int,
+                     stage: str,
+                     pc4: Optional[int],
+                     scenario: Optional[str],
+                     during: bool = False) -> None:
+        if self.budget_bytes is not None and rss > self.budget_bytes:
+            message = (f'Memory budget of {self.budget_bytes / MEGABYTE:.0f} MB exceeded '
+                       f'{"during" if during else "after"} stage "{stage}" '
+                       f'(pc4: {pc4}, scenario: {scenario}) with an RSS of {rss / MEGABYTE:.0f} MB.')
+            top_allocations = self.top_allocations()
+            if top_allocations:
+                message += ' Top allocation sites:\n' + '\n'.join(top_allocations)
+            raise MemoryBudgetExceeded(message)
+
+    def top_allocations(self) -> list[str]:
+        if not self.trace or not tracemalloc.is_tracing():
+            return []
+        statistics = tracemalloc.take_snapshot().statistics('lineno')[:self.num_top_allocations]
+        return [f'{statistic.traceback[0].filename}:{statistic.traceback[0].lineno} '
+                f'{statistic.size / MEGABYTE:.1f} MB in {statistic.count} blocks'
+                for statistic in statistics]
+
+    def report(self) -> dict:
+        peak_rss = peak_rss_bytes()
+        return {'budget_mb': self.budget_bytes / MEGABYTE if self.budget_bytes is not None else None,
+                'peak_rss_mb': peak_rss / MEGABYTE if peak_rss is not None else None,
+                'peak_rss_stage': self.peak_rss_stage,
+                'max_rss_mb_per_stage': {stage: rss / MEGABYTE for stage, rss in self.max_rss_per_stage.items()},
+                'max_traced_peak_mb_per_stage': {stage: peak / MEGABYTE
+                                                 for stage, peak in self.max_traced_peak_per_stage.items()},
+                'top_allocations': self.top_allocations()}
+
+
+@dataclass
+class StageTimer:
+    """Collects the wall clock duration of each stage of a run per pc4 and per scenario.
+
+    Timing the same stage multiple times for the same pc4 and scenario accumulates into a single duration. The
+    statistics of a stage are calculated over these accumulated durations, e.g. the p90 of the time spent shifting
+    per scenario.
+    """
+    durations: dict[TimingKey, float] = field(default_factory=dict)
+    started_at: float = field(default_factory=time.perf_counter)
+    memory_monitor: Optional[MemoryMonitor] = None
+    statistics: dict[str, dict[str, float | str]] = field(default_factory=dict)
+
+    @contextmanager
+    def stage(self, stage: str, pc4: Optional[int] = None, scenario: Optional[str] = None) -> Iterator[None]:
+        memory_stage = self.memory_monitor.stage(stage, pc4, scenario) if self.memory_monitor else nullcontext()
+        start = time.perf_counter()
+        try:
+            with memory_stage:
+                yield
+        finally:
+            self.add(stage, time.perf_counter() - start, pc4, scenario)
+
+    def check_memory(self) -> None:
+        """Check the memory budget within the running stage. Does nothing without a memory monitor."""
+        if self.memory_monitor is not None:
+            self.memory_monitor.check()
+
+    def add(self, stage: str, duration_seconds: float, pc4: Optional[int] = None, scenario: Optional[str] = None):
+        key = (stage, pc4, scenario)
+        self.durations[key] = self.durations.get(key, 0.0) + duration_seconds
+
+    def add_statistics(self, name: str, statistics: dict[str, float | str]) -> None:
+        """Add statistics which are not timings, such as the hit rate of a cache, to the report."""
+        self.statistics[name] = statistics
+
+    def _statistics_per_stage(self, keys: list[TimingKey]) -> dict[str, dict[str, float]]:
+        durations_per_stage: dict[str, list[float]] = {}
+        for key in keys:
+            durations_per_stage.setdefault(key[0], []).append(self.durations[key])
+        return {stage: duration_statistics(durations) for stage, durations in durations_per_stage.items()}
+
+    def report(self) -> dict:
+        keys_per_pc4: dict[int, list[TimingKey]] = {}
+        keys_per_scenario: dict[str, list[TimingKey]] = {}
+        for key in self.durations:
+            _, pc4, scenario = key
+            if pc4 is not None:
+                keys_per_pc4.setdefault(pc4, []).append(key)
+            if scenario is not None:
+                keys_per_scenario.setdefault(scenario, []).append(key)
+
+        result = {'total_seconds': time.perf_counter() - self.started_at,
+                  'stages': self._statistics_per_stage(list(self.durations)),
+                  'per_pc4': {str(pc4): self._statistics_per_stage(keys) for pc4, keys in keys_per_pc4.items()},
+                  'per_scenario': {scenario: self._statistics_per_stage(keys)
+                                   for scenario, keys in keys_per_scenario.items()}}
+        if self.memory_monitor is not None:
+            result['memory'] = self.memory_monitor.report()
+        if self.statistics:
+            result['statistics'] = self.statistics
+        return result
+
+    def write_report(self, path: Path) -> None:
+        """Write the report as JSON or CSV depending on the extension of path.
+
+        The CSV report contains a row per stage for each scope: the whole run, each pc4 and each scenario. The memory
+        usage and the other statistics are only part of the JSON report.
+        """
+        report = self.report()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        match path.suffix.lower():
+            case '.json':
+                with open(path, 'w') as open_file:
+                    json.dump(report, open_file, indent=2)
+            case '.csv':
+                with open(path, 'w', newline='') as open_file:
+                    writer = csv.writer(open_file)
+                    writer.writerow(['scope', 'key', 'stage'] + REPORT_STATISTICS)
+                    scopes = [('run', {'': report['stages']}),
+                              ('pc4', report['per_pc4']),
+                              ('scenario', report['per_scenario'])]
+                    for scope, statistics_per_key in scopes:
+                        for key, statistics_per_stage in statistics_per_key.items():
+                            for stage, statistics in statistics_per_stage.items():
+                                writer.writerow([scope, key, stage] + [statistics[s] for s in REPORT_STATISTICS])
+            case _:
+                raise RuntimeError(f'Unknown report extension {path.suffix}. Options are .json and .csv')
@@ -0,0 +1,125 @@
+import sys
+from typing import Sequence
+
+import numpy
+
+try:
+    import numba
+except ImportError:  # numba is an optional dependency to compile the kernels.
+    numba = None  # type: ignore
+
+
+def divide_in_order(default_energy_per_step, order, non_flexible_energy: float, energy_per_step) -> None:
+    """Evenly divide non_flexible_energy across the steps in order while not increasing above the default energy.
+
+    A step which cannot take its even share passes the rest on to the steps after it in order. Works on lists as well
+    as arrays so the same function is compiled with numba.
+
+    :param default_energy_per_step: The default energy of each step.
+    :param order: The indices of the steps in the order in which they are filled.
+    :param non_flexible_energy: The energy to divide across the steps.
+    :param energy_per_step: The divided energy of each step. Changed in place.
+    """
+    non_flexible_energy_to_divide = non_flexible_energy
+    total_remaining_duration = len(order)
+    for step_index in order:
+        proposed_non_flexible_energy_current_step = non_flexible_energy_to_divide / total_remaining_duration
+        set_non_flexible_energy_current_step = min(default_energy_per_step[step_index],
+                                                   proposed_non_flexible_energy_current_step)
+        energy_per_step[step_index] = set_non_flexible_energy_current_step
+        non_flexible_energy_to_divide = non_flexible_energy_to_divide - set_non_flexible_energy_current_step
+        total_remaining_duration -= 1
+
+
+def capped_even_split_array(default_energy_per_step: numpy.ndarray, non_flexible_energy: float) -> numpy.ndarray:
+    """capped_even_split on an array. The stable merge sort orders steps with the same default energy in the same
+    way as the stable sort of Python."""
+    energy_per_step = numpy.zeros(len(default_energy_per_step))
+    divide_in_order(default_energy_per_step,
+                    numpy.argsort(default_energy_per_step, kind='mergesort'),
+                    non_flexible_energy,
+                    energy_per_step)
+    return energy_per_step
+
+
+def immediate_fill_in_place(energy_per_step,
+                            first_index: int,
+                            capacity_per_step,
+                            energy_joule: float) -> tuple[float, int]:
+    """Charge energy_joule as quickly as possible by increasing the energy of each step up to its capacity.
+
+    Works on lists as well as arrays so the same function is compiled with numba.
+
+    :param energy_per_step: The energy of each step. Changed in place.
+    :param first_index: The index in energy_per_step of the first step which may be charged.
+    :param capacity_per_step: The maximum energy of each step which may be charged starting at first_index.
+    :param energy_joule: The energy to charge.
+    :return: The energy which did not fit and the number of steps from first_index up to and including the last
+        step in which the energy changed.
+    """
+    energy_to_charge = energy_joule
+    num_steps_charged = 0
+    for step_offset in range(len(capacity_per_step)):
+        energy_in_step = energy_per_step[first_index + step_offset]
+        energy_room = capacity_per_step[step_offset] - energy_in_step
+        will_charge_extra = min(energy_room, energy_to_charge)
+        energy_to_charge -= will_charge_extra
+        energy_per_step[first_index + step_offset] = energy_in_step + will_charge_extra
+        if will_charge_extra:
+            num_steps_charged = step_offset + 1
+    return energy_to_charge, num_steps_charged
+
+
+# The kernels are compiled with numba if it is installed. Plain Python steps through lists faster than through arrays,
+# so the callers pass lists and these are only converted to arrays for the compiled kernels. A frozen executable
+# cannot write the numba cache next to its modules so it compiles on each run instead.
+if numba is not None:
+    BACKEND = 'numba'
+    _cache = not getattr(sys, 'frozen', False)
+    divide_in_order = numba.njit(cache=_cache)(divide_in_order)
+    capped_even_split_array = numba.njit(cache=_cache)(capped_even_split_array)
+    immediate_fill_in_place = numba.njit(cache=_cache)(immediate_fill_in_place)
+else:
+    BACKEND = 'python'
+
+
+def capped_even_split(default_energy_per_step: Sequence[float], non_flexible_energy: float) -> list[float]:
+    """Evenly divide non_flexible_energy across the steps while not increasing above the default energy of a step.
+
+    Steps are filled from the least default energy first. A step which cannot take its even share passes the rest on
+    to the steps with more default energy. Steps with the same default energy are filled in order.
+
+    :param default_energy_per_step: The default energy of each step.
+    :param non_flexible_energy: The energy to divide across the steps.
+    :return: The divided energy of each step in the order of default_energy_per_step.
+    """
+    if BACKEND == 'numba':
+        return capped_even_split_array(numpy.asarray(default_energy_per_step, dtype=float),
+                                       non_flexible_energy).tolist()
+    energy_per_step = [0.0] * len(default_energy_per_step)
+    divide_in_order(default_energy_per_step,
+                    sorted(range(len(default_energy_per_step)), key=default_energy_per_step.__getitem__),
+                    non_flexible_energy,
+                    energy_per_step)
+    return energy_per_step
+
+
+def immediate_fill(energy_per_step: list[float],
+                   first_index: int,
+                   capacity_per_step: Sequence[float],
+                   energy_joule: float) -> tuple[float, int]:
+    """Charge energy_joule as quickly as possible by increasing the energy of each step up to its capacity.
+
+    :param energy_per_step: The energy of each step. Changed in place.
+    :param first_index: The index in energy_per_step of the first step which may be charged.
+    :param capacity_per_step: The maximum energy of each step which may be charged starting at first_index.
+    :param energy_joule: The energy to charge.
+    :return: The energy which did not fit and the number of steps from first_index up to and including the last
+        step in which the energy changed.
+    """
+    if BACKEND == 'numba':
+        charged_steps = numpy.array(energy_per_step[first_index:first_index + len(capacity_per_step)], dtype=float)
+        result = immediate_fill_in_place(charged_steps, 0, numpy.asarray(capacity_per_step, dtype=float), energy_joule)
+        energy_per_step[first_index:first_index + len(capacity_per_step)] = charged_steps.tolist()
+        return result
+    return immediate_fill_in_place(energy_per_step, first_index, capacity_per_step, energy_joule)
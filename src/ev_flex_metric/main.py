@@ -1,19 +1,37 @@
+import hashlib
+import heapq
 import json
 import math
-from dataclasses import dataclass
+import os
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
+from itertools import islice
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Iterator, Sequence
 
 import avro.schema
 from avro.datafile import DataFileWriter
 from avro.io import DatumWriter
+import numpy
+import pandas
 import pytz
 import openpyxl
 
+from ev_flex_metric import kernels
+from ev_flex_metric.progress import ProgressReporter, WarningCollector, warn
 from ev_flex_metric.ranges import IntRangeInBlock, DecimalRangeInBlock, DecimalInstantInBlock, IntInstantInBlock
 
 
+def to_epoch_ns(instant: datetime) -> int:
+    """Nanoseconds since the unix epoch of instant. Naive instants are interpreted as UTC."""
+    return pandas.Timestamp(instant).value
+
+
+def to_epoch_ns_array(instants: pandas.Series) -> numpy.ndarray:
+    """Vectorized version of to_epoch_ns returning an int64 array."""
+    return pandas.DatetimeIndex(instants).asi8
+
+
 def times_ranges_overlap(start1: datetime, end1: datetime, start2: datetime, end2: datetime):
     return not(end1 <= start2 or start1 >= end2)
 
@@ -45,6 +63,8 @@ class BlockMetadata:
                                f'start ({start_time}).')
 
         self.num_of_blocks = int(duration_secs / step_duration_secs)
+        self.start_epoch_ns = to_epoch_ns(start_time)
+        self.step_duration_ns = pandas.Timedelta(step_duration).value
 
     def convert_to_instant_in_block(self, instant: datetime) -> DecimalInstantInBlock:
         seconds_in_block = (instant - self.start_time).total_seconds()
@@ -52,6 +72,21 @@ class BlockMetadata:
 
         return factor_in_steps
 
+    def convert_epoch_ns_to_instants_in_block(self, instants_epoch_ns: numpy.ndarray) -> numpy.ndarray:
+        """Vectorized version of convert_to_instant_in_block for instants on the integer epoch clock.
+
+        The instants are nanoseconds since the unix epoch, see to_epoch_ns_array. Converting them only requires an
+        integer offset and a single division so the instants of all sessions of a dataset can be converted to a
+        block at once instead of doing datetime arithmetic per session.
+
+        :param instants_epoch_ns: The instants in nanoseconds since the unix epoch as int64 array.
+        :return: The decimal instants in this block as float array.
+        """
+        return (instants_epoch_ns - self.start_epoch_ns) / self.step_duration_ns
+
+    def block_num_to_epoch_ns(self, block_num: int) -> int:
+        return self.start_epoch_ns + block_num * self.step_duration_ns
+
     def convert_to_range_in_block_decimal(self, start: datetime, end: datetime) -> DecimalRangeInBlock:
         if end < start:
             raise RuntimeError(f'Cannot construct range {start}-{end} as start is later then end.')
@@ -75,7 +110,7 @@ class BlockMetadata:
         return times_ranges_overlap(start, end, self.start_time, self.end_time)
 
     def to_range_in_block_int(self) -> IntRangeInBlock:
-        return IntRangeInBlock(0, self.num_of_blocks)
+        return IntRangeInBlock.unchecked(0, self.num_of_blocks)
 
     def from_instant_in_block(self, instant_in_block: DecimalInstantInBlock) -> datetime:
         return self.start_time + (self.step_duration * instant_in_block)
@@ -84,15 +119,64 @@ class BlockMetadata:
         return self.from_instant_in_block(int_block.start), self.from_instant_in_block(int_block.end)
 
 
+class ValuesView(Sequence[float]):
+    """Read-only window onto a slice of the values buffer of another profile.
+
+    Views are created when masking or splitting a profile so the values are not copied. A profile holding a view
+    copies the values into its own buffer before a value is modified, see ValuesInBlockProfile.writable_values.
+    """
+    __slots__ = ('buffer', 'start', 'stop')
+
+    def __init__(self, buffer: list[float], start: int, stop: int):
+        self.buffer = buffer
+        self.start = start
+        self.stop = stop
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return self.tolist()[index]
+            return ValuesView(self.buffer, self.start + start, self.start + max(start, stop))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('ValuesView index out of range')
+        return self.buffer[self.start + index]
+
+    def __iter__(self) -> Iterator[float]:
+        return islice(self.buffer, self.start, self.stop)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, ValuesView):
+            other = other.tolist()
+        return self.tolist() == other
+
+    def __repr__(self) -> str:
+        return repr(self.tolist())
+
+    def tolist(self) -> list[float]:
+        return self.buffer[self.start:self.stop]
+
+
 @dataclass
 class ValuesInBlockProfile:
-    """Abstract profile containing float values per block num"""
+    """Abstract profile containing float values per block num.
+
+    The values are either a list owned by the profile or a view onto the values of another profile. Values are
+    shared between profiles until one of them modifies its values through writable_values, which copies the values
+    first (copy-on-write).
+    """
     range_in_block: IntRangeInBlock
-    value_per_block: list[float]
+    value_per_block: Sequence[float]
 
-    def __init__(self, range_in_block: IntRangeInBlock, value_per_block: list[float]):
+    def __init__(self, range_in_block: IntRangeInBlock, value_per_block: Sequence[float]):
         self.range_in_block = range_in_block
         self.value_per_block = value_per_block
+        self._values_shared = False
 
         if len(value_per_block) != range_in_block.total_block_duration():
             raise RuntimeError(f'Expected the size of the energy_per_block profile ({len(value_per_block)}) and the '
@@ -113,14 +197,51 @@ class ValuesInBlockProfile:
     def value_at(self, block_num: int) -> float:
         return self.value_per_block[self.normalize_index(block_num)]
 
+    def values_view(self, view_range: IntRangeInBlock) -> ValuesView:
+        """View onto the values for the blocks in view_range without copying them.
+
+        :param view_range: The range of blocks to view. Must be contained by the range of this profile.
+        :return: The view. The values of this profile are marked as shared so they are copied before being modified.
+        """
+        if isinstance(self.value_per_block, ValuesView):
+            buffer = self.value_per_block.buffer
+            offset = self.value_per_block.start
+        else:
+            buffer = self.value_per_block  # type: ignore
+            offset = 0
+            self._values_shared = True
+        offset -= self.range_in_block.start
+        return ValuesView(buffer, offset + view_range.start, offset + view_range.end)
+
+    def writable_values(self) -> list[float]:
+        """The values of this profile as a list which may be modified in place.
+
+        If the values are a view or are viewed by another profile, they are copied first.
+
+        :return: The values owned by this profile.
+        """
+        if self._values_shared or not isinstance(self.value_per_block, list):
+            self.value_per_block = list(self.value_per_block)
+            self._values_shared = False
+        return self.value_per_block
+
 
 class EnergyProfile(ValuesInBlockProfile):
     """Energy split per block"""
-    total_energy: float
 
-    def __init__(self, range_in_block: IntRangeInBlock, energy_per_block: list[float]):
+    def __init__(self, range_in_block: IntRangeInBlock, energy_per_block: Sequence[float]):
         super().__init__(range_in_block, energy_per_block)
-        self.total_energy = sum(energy_per_block)
+        self._total_energy: Optional[float] = None
+
+    @property
+    def total_energy(self) -> float:
+        if self._total_energy is None:
+            self._total_energy = sum(self.value_per_block)
+        return self._total_energy
+
+    def writable_values(self) -> list[float]:
+        self._total_energy = None
+        return super().writable_values()
 
     def energy_between(self, between: IntRangeInBlock) -> float:
         return sum(self.value_per_block[self.normalize_index(between.start):self.normalized_index_for_block_num(between.end)])
@@ -128,18 +249,32 @@ class EnergyProfile(ValuesInBlockProfile):
     def energy_at(self, block_num: int) -> float:
         return self.value_at(block_num)
 
+    def copy(self) -> 'EnergyProfile':
+        return EnergyProfile(self.range_in_block, list(self.value_per_block))
+
+    def set_energy(self, energy_profile: 'EnergyProfile') -> None:
+        """Overwrite the energy of this profile with the energy of energy_profile on the blocks of energy_profile.
+
+        :param energy_profile: The energy to write. Its range must be contained by the range of this profile.
+        """
+        if not self.range_in_block.contains(energy_profile.range_in_block):
+            raise RuntimeError(f'Energy profile {energy_profile.range_in_block} is outside of profile '
+                               f'{self.range_in_block}')
+        start_index = self.normalized_index_for_block_num(energy_profile.range_in_block.start)
+        end_index = self.normalized_index_for_block_num(energy_profile.range_in_block.end)
+        self.writable_values()[start_index:end_index] = energy_profile.value_per_block
+
     def mask_int(self, mask: IntRangeInBlock) -> Optional['EnergyProfile']:
         """Generate a new energy profile for the range of steps defined by mask.
 
+        The new energy profile is a view onto the values of this profile so no values are copied.
+
         :param mask: The range of steps for which the energy profile should be created.
         :return: An energy profile with the energy values at the steps defined in the mask.
         """
         intersection = self.range_in_block.intersection_int(mask)
         if intersection is not None:
-            new_values = []
-            for i in intersection.block_nums():
-                new_values.append(self.value_at(i))
-            return EnergyProfile(intersection, new_values)
+            return EnergyProfile(intersection, self.values_view(intersection))
         else:
             return None
 
@@ -201,8 +336,8 @@ class EnergyProfile(ValuesInBlockProfile):
             raise RuntimeError(f'The other energy profile ({other_right}) must start immediately after this '
                                f'profile ({self})')
 
-        new_range_in_block = IntRangeInBlock(self.range_in_block.start, other_right.range_in_block.end)
-        new_energy_values = self.value_per_block + other_right.value_per_block
+        new_range_in_block = IntRangeInBlock.unchecked(self.range_in_block.start, other_right.range_in_block.end)
+        new_energy_values = [*self.value_per_block, *other_right.value_per_block]
 
         return EnergyProfile(new_range_in_block, new_energy_values)
 
@@ -222,7 +357,43 @@ class EnergyProfile(ValuesInBlockProfile):
 
             new_values.append(new_value)
 
-        return EnergyProfile(IntRangeInBlock(common_blocks_start, common_blocks_end), new_values)
+        return EnergyProfile(IntRangeInBlock.unchecked(common_blocks_start, common_blocks_end), new_values)
+
+
+class EnergyProfileAccumulator:
+    """Sums energy profiles into a single buffer preallocated for a fixed range.
+
+    Unlike profile_addition, adding a profile does not allocate a new list for the union of both ranges. Every added
+    profile must therefore be contained by the range of the accumulator.
+    """
+    range_in_block: IntRangeInBlock
+    energy_per_block: list[float]
+
+    def __init__(self, range_in_block: IntRangeInBlock):
+        self.range_in_block = range_in_block
+        self.energy_per_block = [0.0] * range_in_block.total_block_duration()
+
+    def add_into(self, energy_profile: EnergyProfile) -> None:
+        """Add the energy of energy_profile to the buffer at the blocks of energy_profile.
+
+        :param energy_profile: The energy profile to add. Must be contained by the range of the accumulator.
+        """
+        if not self.range_in_block.contains(energy_profile.range_in_block):
+            outside_ranges = [outside_range
+                              for outside_range in energy_profile.range_in_block.subtract_int(self.range_in_block)
+                              if outside_range is not None]
+            raise RuntimeError(f'Energy profile {energy_profile.range_in_block} is outside of accumulated profile '
+                               f'{self.range_in_block} on ranges {outside_ranges}')
+
+        energy_per_block = self.energy_per_block
+        index = energy_profile.range_in_block.start - self.range_in_block.start
+        for energy in energy_profile.value_per_block:
+            energy_per_block[index] += energy
+            index += 1
+
+    def to_energy_profile(self) -> EnergyProfile:
+        """The accumulated energy as an energy profile. The profile takes over the buffer without copying it."""
+        return EnergyProfile(self.range_in_block, self.energy_per_block)
 
 
 class EvFlexMetricProfile(ValuesInBlockProfile):
@@ -235,6 +406,18 @@ class EvFlexMetricProfile(ValuesInBlockProfile):
         return self.value_at(block_num)
 
 
+@dataclass(slots=True)
+class ShiftResult:
+    """The energy profile of a charging session after shifting its flexible energy to after the congestion.
+
+    Besides the profile, the intermediate results are kept which determine whether the same profile results from
+    shifting in a shorter flex window.
+    """
+    energy_profile: EnergyProfile
+    non_flexible_energy: Optional[float]
+    charged_extra_until: Optional[int]
+
+
 @dataclass
 class ChargingSession:
     """The (part of the) charging session that is valid within the block."""
@@ -265,14 +448,14 @@ class ChargingSession:
         new_energy_profile = []
         for i in session.block_nums():
             energy_to_charge = energy_to_charge_profile.energy_at(i)
-            step_factor = round(session.duration_at_step_num(i), 10)
-
-            max_charging_energy_for_step = step_factor * self.max_charging_energy_per_step_joule
+            max_charging_energy_for_step = self.max_charging_energy_at_step(session,
+                                                                            i,
+                                                                            self.max_charging_energy_per_step_joule)
             if energy_to_charge > max_charging_energy_for_step and not fix_energy_profile:
                 raise RuntimeError(f'Energy profile charges above max charging capacity at step #{i} with '
                                    f'{energy_to_charge} out of {max_charging_energy_for_step}. '
                                    f'Max joules for charging in a step is {self.max_charging_energy_per_step_joule} '
-                                   f'and scoped with factor {step_factor}.')
+                                   f'and scoped with factor {round(session.duration_at_step_num(i), 10)}.')
             new_energy_profile.append(min(max_charging_energy_for_step, energy_to_charge))
 
         if fix_energy_profile:
@@ -284,6 +467,33 @@ class ChargingSession:
         self.energy_to_charge_profile = energy_to_charge_profile
         self.meta_data = meta_data
 
+    @staticmethod
+    def max_charging_energy_at_step(session: DecimalRangeInBlock,
+                                    step_num: int,
+                                    max_charging_energy_per_step_joule: float) -> float:
+        """The max energy which may be charged at step_num scoped by how long the session covers the step."""
+        step_factor = round(session.duration_at_step_num(step_num), 10)
+        return step_factor * max_charging_energy_per_step_joule
+
+    @classmethod
+    def unchecked(cls,
+                  session: DecimalRangeInBlock,
+                  max_charging_power_watt: float,
+                  energy_to_charge_profile: EnergyProfile,
+                  meta_data: BlockMetadata) -> 'ChargingSession':
+        """Create a charging session without validating or fixing energy_to_charge_profile.
+
+        Only meant for callers which already guarantee that the energy profile covers the session and does not
+        charge above the max charging capacity at any step, such as sessions re-based from a cached session.
+        """
+        result = object.__new__(cls)
+        result.session = session
+        result.max_charging_power_watt = max_charging_power_watt
+        result.max_charging_energy_per_step_joule = max_charging_power_watt * meta_data.step_duration.total_seconds()
+        result.energy_to_charge_profile = energy_to_charge_profile
+        result.meta_data = meta_data
+        return result
+
     def can_charge_energy_in_step(self, step_num: int) -> float:
         return self.max_charging_energy_per_step_joule * self.session.duration_at_step_num(step_num)
 
@@ -375,28 +585,10 @@ class ChargingSession:
         session_congestion_dec = self.session.intersection_decimal(congestion_steps)
 
         if session_congestion_dec is not None and non_flexible_energy is not None:
-            # First sort blocks by least default_energy_first
-            least_default_energy_first: list[tuple[int, float, float]] = []
-            for i in session_congestion_dec.block_nums():
-                default_energy = self.energy_to_charge_profile.energy_at(i)
-                step_duration = session_congestion_dec.duration_at_step_num(i)
-                least_default_energy_first.append((i, default_energy, step_duration))
-            least_default_energy_first.sort(key=lambda i: i[1])
-
-            non_flexible_energy_to_divide = non_flexible_energy
-            total_remaining_duration = len(least_default_energy_first)
-            energy_per_block = []
-            for step_num, default_energy_at_step, step_duration in least_default_energy_first:
-                proposed_non_flexible_energy_current_block = non_flexible_energy_to_divide / total_remaining_duration
-                set_non_flexible_energy_current_block = min(default_energy_at_step,
-                                                            proposed_non_flexible_energy_current_block)
-                energy_per_block.append((step_num, set_non_flexible_energy_current_block))
-                non_flexible_energy_to_divide = non_flexible_energy_to_divide - set_non_flexible_energy_current_block
-                total_remaining_duration -= 1
-            energy_per_block.sort(key=lambda i: i[0])
-
+            default_energy_per_block = [self.energy_to_charge_profile.energy_at(i)
+                                        for i in session_congestion_dec.block_nums()]
             result = EnergyProfile(session_congestion_dec.to_range_in_block_int(),
-                                 list(map(lambda i: i[1], energy_per_block)))
+                                   kernels.capped_even_split(default_energy_per_block, non_flexible_energy))
 
             return result
         else:
@@ -405,38 +597,61 @@ class ChargingSession:
     def charge_extra_energy_immediately(self,
                                         energy_profile: EnergyProfile,
                                         energy_joule: float) -> EnergyProfile:
-        energy_to_charge = energy_joule
-        new_energy_values = []
-        for i in energy_profile.range_in_block.block_nums():
-            energy_in_step = energy_profile.energy_at(i)
-            energy_room = self.can_charge_energy_in_step(i) - energy_in_step
-            will_charge_extra = min(energy_room, energy_to_charge)
-            energy_to_charge -= will_charge_extra
-            new_energy_values.append(energy_in_step + will_charge_extra)
+        result = energy_profile.copy()
+        self.charge_extra_energy_immediately_into(result, result.range_in_block, energy_joule)
+        return result
+
+    def charge_extra_energy_immediately_into(self,
+                                             energy_profile: EnergyProfile,
+                                             charge_range: IntRangeInBlock,
+                                             energy_joule: float) -> Optional[int]:
+        """Charge energy_joule as quickly as possible in the steps of charge_range by modifying energy_profile.
+
+        :param energy_profile: The energy profile to charge the extra energy into.
+        :param charge_range: The steps in which the extra energy may be charged. Must be within energy_profile.
+        :param energy_joule: The extra energy to charge.
+        :return: The step after the last step in which the energy changed or None if no step changed.
+        """
+        values = energy_profile.writable_values()
+        capacity_per_step = [self.can_charge_energy_in_step(i) for i in charge_range.block_nums()]
+        energy_to_charge, num_steps_charged = kernels.immediate_fill(values,
+                                                                     charge_range.start - energy_profile.range_in_block.start,
+                                                                     capacity_per_step,
+                                                                     energy_joule)
 
         if energy_to_charge > 0.001:
             raise RuntimeError(f'Could not fit {energy_to_charge} out of {energy_joule} in energy profile {self}')
-
-        return EnergyProfile(energy_profile.range_in_block,
-                             new_energy_values)
+        return charge_range.start + num_steps_charged if num_steps_charged else None
 
     def shift_flexible_energy_after_congestion(self,
                                                flex_window: BlockMetadata,
                                                congestion_steps: IntRangeInBlock) -> EnergyProfile:
         """Shift as much flexible energy outside of the congestion to after the congestion steps.
 
-        Energy is shifted to immediately after the congestion and charging as quickly as possible.
+        Energy is shifted to immediately after the congestion and charging as quickly as possible. The result is
+        written into a single copy of the default energy profile.
 
         :param congestion_steps: Steps within block which have congestion.
         :return: The alternative energy profile where the energy during congestion is shifted to immediately
             after the congestion.
         """
+        return self.shift_flexible_energy_after_congestion_result(flex_window, congestion_steps).energy_profile
+
+    def shift_flexible_energy_after_congestion_result(self,
+                                                      flex_window: BlockMetadata,
+                                                      congestion_steps: IntRangeInBlock) -> ShiftResult:
+        """Shift as much flexible energy outside of the congestion to after the congestion steps.
+
+        :param congestion_steps: Steps within block which have congestion.
+        :return: The alternative energy profile as in shift_flexible_energy_after_congestion together with the non
+            flexible energy and the step after the last step in which shifted energy was charged.
+        """
         non_flexible_energy = self.non_flexible_energy_utilizing_after_congestion(flex_window,
                                                                                   congestion_steps)
         congestion_energy_profile = self.non_flexible_energy_evenly_divided_while_not_increasing_above_default_charging(non_flexible_energy,
                                                                                                                         congestion_steps)
         if non_flexible_energy is None and congestion_energy_profile is None:
-            return self.energy_to_charge_profile
+            return ShiftResult(self.energy_to_charge_profile, None, None)
 
         if not math.isclose(non_flexible_energy, congestion_energy_profile.total_energy, rel_tol=0.01):
             raise RuntimeError(f'The non flexible energy {non_flexible_energy} does not match the desired energy '
@@ -446,25 +661,25 @@ class ChargingSession:
         default_profile_during_congestion = self.energy_to_charge_profile.mask_int(congestion_steps)
         energy_to_move = default_profile_during_congestion.total_energy - congestion_energy_profile.total_energy
 
-        default_profile_before_congestion, default_profile_after_congestion = self.energy_to_charge_profile.split_on_int(congestion_steps)
-
-        if default_profile_before_congestion:
-            resulting_energy_profile = default_profile_before_congestion.profile_concat_right(congestion_energy_profile)
-        else:
-            resulting_energy_profile = congestion_energy_profile
-            #default_profile_before_block, default_profile_during_block_before_congestion = default_profile_before_congestion.split_on_int(self.meta_data.to_range_in_block_int())
-        if default_profile_after_congestion:
-            default_profile_during_block_after_congestion, default_profile_after_block = default_profile_after_congestion.split_on_int_instant(flex_window.to_range_in_block_int().end)
-            shifted_profile_after_congestion = self.charge_extra_energy_immediately(default_profile_during_block_after_congestion,
-                                                                                    energy_to_move)
-            resulting_energy_profile = resulting_energy_profile.profile_concat_right(shifted_profile_after_congestion)
-            if default_profile_after_block:
-                resulting_energy_profile = resulting_energy_profile.profile_concat_right(default_profile_after_block)
+        resulting_energy_profile = self.energy_to_charge_profile.copy()
+        resulting_energy_profile.set_energy(congestion_energy_profile)
+
+        charged_extra_until = None
+        _, range_after_congestion = self.energy_to_charge_profile.range_in_block.subtract_int(congestion_steps)
+        if range_after_congestion:
+            range_during_block_after_congestion, _ = range_after_congestion.split_on_int_instant(flex_window.to_range_in_block_int().end)
+            if range_during_block_after_congestion is not None:
+                charged_extra_until = self.charge_extra_energy_immediately_into(resulting_energy_profile,
+                                                                                range_during_block_after_congestion,
+                                                                                energy_to_move)
+            elif energy_to_move > 0.001:
+                raise RuntimeError(f'There was energy to move ({energy_to_move}) after the congestion but the flex '
+                                   f'window ends before the profile after the congestion {range_after_congestion}')
         elif energy_to_move > (0.01 * default_profile_during_congestion.total_energy):
             raise RuntimeError(f'There was energy to move ({energy_to_move}) after the congestion but there is no '
                                f'profile after the congestion')
 
-        return resulting_energy_profile
+        return ShiftResult(resulting_energy_profile, non_flexible_energy, charged_extra_until)
 
     def calculate_flex_metric(self, congestion_steps: IntRangeInBlock) -> EvFlexMetricProfile:
         ''' Calculates the ev_flex_metric for a single EV session.
@@ -500,6 +715,189 @@ class ChargingSession:
         return EvFlexMetricProfile(flex_steps, ev_flex_metric_per_step)
 
 
+class SessionFeatureTable:
+    """Per session features to answer non flexible energy queries for many sessions and ranges with array lookups.
+
+    The table holds the fractional start and end of each session, its total energy and, per step of its energy
+    profile, the cumulative default energy and the cumulative energy it could charge at its maximum power. The energy
+    or charging capacity of a session between two steps is then the difference of two cumulative values instead of a
+    sum over the steps. All queries accept arrays of session indices and ranges which are broadcast together.
+
+    The non flexible energy utilizing the whole session is calculated with the same floating point operations as
+    ChargingSession.non_flexible_energy_utilizing_whole_session so gives exactly the same result. Queries using the
+    cumulative values may differ from summing the steps in the last bits as the additions happen in another order.
+    """
+    session_starts: numpy.ndarray
+    session_ends: numpy.ndarray
+    profile_starts: numpy.ndarray
+    profile_ends: numpy.ndarray
+    max_charging_energy_per_step_joule: numpy.ndarray
+    total_energy: numpy.ndarray
+    cumulative_default_energy: numpy.ndarray
+    cumulative_capacity: numpy.ndarray
+    _offsets: numpy.ndarray
+
+    def __init__(self, charging_sessions: Sequence[ChargingSession]):
+        self.session_starts = numpy.array([charging_session.session.start for charging_session in charging_sessions],
+                                          dtype=float)
+        self.session_ends = numpy.array([charging_session.session.end for charging_session in charging_sessions],
+                                        dtype=float)
+        self.profile_starts = numpy.array([charging_session.energy_to_charge_profile.range_in_block.start
+                                           for charging_session in charging_sessions], dtype=numpy.int64)
+        self.profile_ends = numpy.array([charging_session.energy_to_charge_profile.range_in_block.end
+                                         for charging_session in charging_sessions], dtype=numpy.int64)
+        self.max_charging_energy_per_step_joule = numpy.array([charging_session.max_charging_energy_per_step_joule
+                                                               for charging_session in charging_sessions], dtype=float)
+        self.total_energy = numpy.array([charging_session.energy_to_charge_profile.total_energy
+                                         for charging_session in charging_sessions], dtype=float)
+
+        # Each session has one cumulative value per step of its energy profile plus a leading zero.
+        self._offsets = numpy.zeros(len(charging_sessions) + 1, dtype=numpy.int64)
+        numpy.cumsum(self.profile_ends - self.profile_starts + 1, out=self._offsets[1:])
+        self.cumulative_default_energy = numpy.zeros(self._offsets[-1], dtype=float)
+        self.cumulative_capacity = numpy.zeros(self._offsets[-1], dtype=float)
+        for index, charging_session in enumerate(charging_sessions):
+            profile = charging_session.energy_to_charge_profile
+            offset = self._offsets[index]
+            self.cumulative_default_energy[offset + 1:self._offsets[index + 1]] = numpy.cumsum(profile.value_per_block)
+            capacity = [charging_session.can_charge_energy_in_step(step_num)
+                        for step_num in profile.range_in_block.block_nums()]
+            self.cumulative_capacity[offset + 1:self._offsets[index + 1]] = numpy.cumsum(capacity)
+
+    def __len__(self) -> int:
+        return len(self.session_starts)
+
+    def _cumulative_at(self, cumulative: numpy.ndarray, session_indices: numpy.ndarray, step_nums: numpy.ndarray) -> numpy.ndarray:
+        profile_starts = self.profile_starts[session_indices]
+        step_nums = numpy.clip(step_nums, profile_starts, self.profile_ends[session_indices])
+        return cumulative[self._offsets[session_indices] + step_nums - profile_starts]
+
+    def energy_between(self, session_indices, start_step_nums, end_step_nums) -> numpy.ndarray:
+        """The default energy of the sessions from start_step_nums until end_step_nums.
+
+        :param session_indices: The indices of the sessions in this table.
+        :param start_step_nums: The first step of each range.
+        :param end_step_nums: The step after the last step of each range. Must not be before the first step.
+        :return: The default energy in joule of each session during each range.
+        """
+        session_indices, start_step_nums, end_step_nums = numpy.broadcast_arrays(session_indices,
+                                                                                 start_step_nums,
+                                                                                 end_step_nums)
+        return (self._cumulative_at(self.cumulative_default_energy, session_indices, end_step_nums) -
+                self._cumulative_at(self.cumulative_default_energy, session_indices, start_step_nums))
+
+    def capacity_between(self, session_indices, start_step_nums, end_step_nums) -> numpy.ndarray:
+        """The energy the sessions could charge at their maximum power from start_step_nums until end_step_nums.
+
+        :param session_indices: The indices of the sessions in this table.
+        :param start_step_nums: The first step of each range.
+        :param end_step_nums: The step after the last step of each range. Must not be before the first step.
+        :return: The charging capacity in joule of each session during each range.
+        """
+        session_indices, start_step_nums, end_step_nums = numpy.broadcast_arrays(session_indices,
+                                                                                 start_step_nums,
+                                                                                 end_step_nums)
+        return (self._cumulative_at(self.cumulative_capacity, session_indices, end_step_nums) -
+                self._cumulative_at(self.cumulative_capacity, session_indices, start_step_nums))
+
+    def cumulative_energy_envelope(self, start_step_num: int, end_step_num: int) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        """The cumulative energy all sessions together charge from start_step_num when charging as late as possible,
+        by default and as early as possible.
+
+        Each session charges its default energy between start_step_num and end_step_num within the same steps. As
+        early as possible it charges at its maximum power from start_step_num until this energy is charged. As late
+        as possible it charges at its maximum power so it just finishes charging this energy by end_step_num. All
+        sessions and steps are calculated at once so this takes memory for the number of sessions times steps.
+
+        :param start_step_num: The first step of the range.
+        :param end_step_num: The step after the last step of the range.
+        :return: The lower, the default and the upper cumulative energy in joule charged by the end of each step in
+            the range.
+        """
+        session_indices = numpy.arange(len(self))
+        step_ends = numpy.arange(start_step_num + 1, end_step_num + 1)
+        energy = self.energy_between(session_indices, start_step_num, end_step_num)[:, numpy.newaxis]
+        capacity_since_start = self.capacity_between(session_indices[:, numpy.newaxis], start_step_num, step_ends)
+        capacity_until_end = self.capacity_between(session_indices[:, numpy.newaxis], step_ends, end_step_num)
+        lower = numpy.maximum(energy - capacity_until_end, 0.0).sum(axis=0)
+        default = self.energy_between(session_indices[:, numpy.newaxis], start_step_num, step_ends).sum(axis=0)
+        upper = numpy.minimum(energy, capacity_since_start).sum(axis=0)
+        return lower, default, upper
+
+    def overlaps(self, session_indices, range_starts, range_ends) -> numpy.ndarray:
+        """Whether the sessions overlap the ranges in the same way as RangeInBlock.overlaps."""
+        return ~((self.session_starts[session_indices] >= range_ends) | (self.session_ends[session_indices] <= range_starts))
+
+    def non_flexible_energy_utilizing_whole_session(self, session_indices, congestion_starts, congestion_ends) -> numpy.ndarray:
+        """Vectorized ChargingSession.non_flexible_energy_utilizing_whole_session.
+
+        :param session_indices: The indices of the sessions in this table.
+        :param congestion_starts: The first step of each congestion.
+        :param congestion_ends: The step after the last step of each congestion.
+        :return: The non flexible energy of each session during each congestion or NaN if they do not overlap.
+        """
+        session_indices, congestion_starts, congestion_ends = numpy.broadcast_arrays(session_indices,
+                                                                                     congestion_starts,
+                                                                                     congestion_ends)
+        session_starts = self.session_starts[session_indices]
+        session_ends = self.session_ends[session_indices]
+        session_congestion_duration = (numpy.minimum(session_ends, congestion_ends) -
+                                       numpy.maximum(session_starts, congestion_starts))
+        non_congestion_room_joule = (((session_ends - session_starts) - session_congestion_duration) *
+                                     self.max_charging_energy_per_step_joule[session_indices])
+        non_flexible_energy = numpy.maximum(self.total_energy[session_indices] - non_congestion_room_joule, 0.0)
+        return numpy.where(self.overlaps(session_indices, congestion_starts, congestion_ends), non_flexible_energy, numpy.nan)
+
+    def non_flexible_energy_utilizing_after_congestion(self,
+                                                       session_indices,
+                                                       congestion_starts,
+                                                       congestion_ends,
+                                                       flex_window_starts,
+                                                       flex_window_ends) -> numpy.ndarray:
+        """Vectorized ChargingSession.non_flexible_energy_utilizing_after_congestion.
+
+        :param session_indices: The indices of the sessions in this table.
+        :param congestion_starts: The first step of each congestion.
+        :param congestion_ends: The step after the last step of each congestion.
+        :param flex_window_starts: The first step of each flex window.
+        :param flex_window_ends: The step after the last step of each flex window.
+        :return: The non flexible energy of each session during each congestion or NaN if the session does not
+            overlap the congestion within the flex window.
+        """
+        (session_indices, congestion_starts, congestion_ends,
+         flex_window_starts, flex_window_ends) = numpy.broadcast_arrays(session_indices,
+                                                                        congestion_starts,
+                                                                        congestion_ends,
+                                                                        flex_window_starts,
+                                                                        flex_window_ends)
+        session_starts = self.session_starts[session_indices]
+        session_ends = self.session_ends[session_indices]
+        in_flex_window = ~((session_starts >= flex_window_ends) | (session_ends <= flex_window_starts))
+        flex_starts = numpy.maximum(session_starts, flex_window_starts)
+        flex_ends = numpy.minimum(session_ends, flex_window_ends)
+
+        during_congestion = in_flex_window & ~((flex_starts >= congestion_ends) | (flex_ends <= congestion_starts))
+        congestion_starts_in_session = numpy.floor(numpy.maximum(flex_starts, congestion_starts)).astype(numpy.int64)
+        congestion_ends_in_session = numpy.ceil(numpy.minimum(flex_ends, congestion_ends)).astype(numpy.int64)
+        charged_energy_in_congestion = self.energy_between(session_indices,
+                                                           congestion_starts_in_session,
+                                                           numpy.maximum(congestion_ends_in_session,
+                                                                         congestion_starts_in_session))
+
+        after_congestion = flex_ends > congestion_ends
+        after_starts = numpy.maximum(flex_starts, congestion_ends)
+        after_starts_int = numpy.floor(after_starts).astype(numpy.int64)
+        after_ends_int = numpy.maximum(numpy.ceil(flex_ends).astype(numpy.int64), after_starts_int)
+        default_charged_energy_after_congestion = self.energy_between(session_indices, after_starts_int, after_ends_int)
+        non_congestion_room_joule = numpy.maximum((flex_ends - after_starts) * self.max_charging_energy_per_step_joule[session_indices] -
+                                                  default_charged_energy_after_congestion,
+                                                  0.0)
+        non_flexible_energy = numpy.where(after_congestion,
+                                          numpy.maximum(charged_energy_in_congestion - non_congestion_room_joule, 0.0),
+                                          charged_energy_in_congestion)
+        return numpy.where(during_congestion, non_flexible_energy, numpy.nan)
+
+
 def to_energy_profile_using_default_charge_behaviour(session: DecimalRangeInBlock,
                                                      block_metadata: BlockMetadata,
                                                      charged_energy_kwh: float,
@@ -544,6 +942,45 @@ def to_energy_profile_using_default_charge_behaviour(session: DecimalRangeInBloc
                          energy_per_block + [0] * (session_int.total_block_duration() - len(energy_per_block)))
 
 
+def to_default_energy_profile_in_block(transaction: 'ElaadChargingSession | AlbatrosChargingSession',
+                                       block_metadata: BlockMetadata,
+                                       default_energy_profiles: dict[tuple[int, int], EnergyProfile]) -> EnergyProfile:
+    """The energy profile of the transaction using the default charge behaviour within block_metadata.
+
+    The profile only depends on the transaction and the step grid, not on where the block starts. It is calculated
+    once per step grid in a grid block starting at the step boundary at or before the start of the transaction and
+    cached in default_energy_profiles. Blocks on the same step grid which only differ in their start re-base the
+    cached profile by an integer number of steps instead of calculating it again.
+
+    :param transaction: The transaction to calculate the energy profile for.
+    :param block_metadata: The block to express the energy profile in.
+    :param default_energy_profiles: The cached profiles of this transaction per step duration and grid phase.
+    :return: The energy profile covering the session steps relative to the start of block_metadata.
+    """
+    step_duration_ns = block_metadata.step_duration_ns
+    grid_phase_ns = block_metadata.start_epoch_ns % step_duration_ns
+    session_start_epoch_ns = to_epoch_ns(transaction.utc_session_start)
+    grid_start_epoch_ns = session_start_epoch_ns - (session_start_epoch_ns - grid_phase_ns) % step_duration_ns
+    steps_from_block_start = (grid_start_epoch_ns - block_metadata.start_epoch_ns) // step_duration_ns
+
+    grid_energy_profile = default_energy_profiles.get((step_duration_ns, grid_phase_ns))
+    if grid_energy_profile is None:
+        grid_start = block_metadata.start_time + block_metadata.step_duration * steps_from_block_start
+        grid_block = BlockMetadata(grid_start, grid_start, block_metadata.step_duration)
+        grid_energy_profile = to_energy_profile_using_default_charge_behaviour(
+            grid_block.convert_to_range_in_block_decimal(transaction.utc_session_start, transaction.utc_session_stop),
+            grid_block,
+            transaction.charged_energy_kwh,
+            transaction.charging_time,
+            transaction.max_power_kw)
+        default_energy_profiles[(step_duration_ns, grid_phase_ns)] = grid_energy_profile
+
+    grid_range = grid_energy_profile.range_in_block
+    return EnergyProfile(IntRangeInBlock.unchecked(grid_range.start + steps_from_block_start,
+                                                   grid_range.end + steps_from_block_start),
+                         grid_energy_profile.values_view(grid_range))
+
+
 @dataclass
 class ElaadChargingSession:
     """
@@ -560,15 +997,15 @@ class ElaadChargingSession:
     charging_time: timedelta
     charged_energy_kwh: float
     max_power_kw: float
+    _default_energy_profiles: dict[tuple[int, int], EnergyProfile] = field(default_factory=dict,
+                                                                          init=False,
+                                                                          repr=False,
+                                                                          compare=False)
 
     def to_general_charging_session(self, block_metadata: BlockMetadata) -> Optional[ChargingSession]:
         block_range = block_metadata.to_range_in_block_int()
         session = block_metadata.convert_to_range_in_block_decimal(self.utc_session_start, self.utc_session_stop)
-        energy_profile = to_energy_profile_using_default_charge_behaviour(session,
-                                                                          block_metadata,
-                                                                          self.charged_energy_kwh,
-                                                                          self.charging_time,
-                                                                          self.max_power_kw)
+        energy_profile = to_default_energy_profile_in_block(self, block_metadata, self._default_energy_profiles)
 
         if session:
             masked_session = session.intersection_decimal(block_range)
@@ -583,24 +1020,34 @@ class ElaadChargingSession:
             return None
 
     @staticmethod
-    def from_line(line: str) -> Optional['ElaadChargingSession']:
+    def from_line(line: str, warnings: Optional[WarningCollector] = None) -> Optional['ElaadChargingSession']:
+        """Parse a line of the Elaad transactions CSV.
+
+        :param line: The CSV line.
+        :param warnings: Collects the warnings by category. If None, warnings are printed.
+        :return: The charge session or None if the line cannot be parsed and is skipped.
+        """
         parts = line.rstrip('\n').split(',')
         skip_reasons = []
 
         if parts[8] == 'NA':
-            skip_reasons.append('Charge duration was NA instead of a number.')
+            skip_reasons.append(('charge duration NA', 'Charge duration was NA instead of a number.'))
 
         if parts[10] == 'NA':
-            skip_reasons.append('Charged energy in kWh was NA instead of a number.')
+            skip_reasons.append(('charged energy NA', 'Charged energy in kWh was NA instead of a number.'))
 
         if parts[11] == 'NA':
-            skip_reasons.append('Peak power in kW was NA instead of a number.')
+            skip_reasons.append(('peak power NA', 'Peak power in kW was NA instead of a number.'))
 
         if parts[8] == '0' and parts[10] != '0':
-            skip_reasons.append(f'Charge time was 0 but there was {parts[10]} energy charged.')
+            skip_reasons.append(('energy charged without charge time',
+                                 f'Charge time was 0 but there was {parts[10]} energy charged.'))
 
         if skip_reasons:
-            print(f'Skipping unparseable line (reasons: {skip_reasons}): {line}')
+            for category, _ in skip_reasons:
+                warn(warnings,
+                     f'Skipped line: {category}',
+                     f'Skipping unparseable line (reasons: {[reason for _, reason in skip_reasons]}): {line}')
             result = None
         else:
             transaction_id = parts[1].strip('"')
@@ -614,9 +1061,11 @@ class ElaadChargingSession:
                 # Charging time exceeds transaction duration.
                 # Margin of 36 seconds is acceptable as the charge time is in hours and only significant to 2 digits
                 # behind the comma. This is a resolution of 36 seconds.
-                print(f'Warning! [{transaction_id}] Transaction duration ({transaction_duration.total_seconds()} '
-                      f'seconds) was less than charging time ({charging_time.total_seconds()} seconds) but within '
-                      f'acceptable margin. Correct transaction duration to charging time.')
+                warn(warnings,
+                     'Corrected transaction duration to charging time',
+                     f'Warning! [{transaction_id}] Transaction duration ({transaction_duration.total_seconds()} '
+                     f'seconds) was less than charging time ({charging_time.total_seconds()} seconds) but within '
+                     f'acceptable margin. Correct transaction duration to charging time.')
                 end = start + charging_time
             elif (charging_time.total_seconds() - transaction_duration.total_seconds()) >= 36:
                 raise RuntimeError(f'[{transaction_id}] charging time {charging_time} was significantly longer than '
@@ -635,9 +1084,11 @@ class ElaadChargingSession:
                 max_increase_allowed = max(36, non_charge_seconds_in_transaction + ElaadChargingSession.ALLOWED_TRANSACTION_DURATION_INCREASE_TO_FIT_CHARGING_FACTOR * transaction_duration.total_seconds())
 
                 if 0 <= increased_charging_time <= max_increase_allowed:
-                    print(f'Warning! [{transaction_id}] Charging duration was not long enough causing the charging '
-                          f'session to use more than max_power_kw on average. Increasing charging_time by '
-                          f'{math.ceil(increased_charging_time)} seconds which is within acceptable margin.')
+                    warn(warnings,
+                         'Increased charging time to stay below max power',
+                         f'Warning! [{transaction_id}] Charging duration was not long enough causing the charging '
+                         f'session to use more than max_power_kw on average. Increasing charging_time by '
+                         f'{math.ceil(increased_charging_time)} seconds which is within acceptable margin.')
                     charging_time = charging_time + timedelta(seconds=math.ceil(increased_charging_time))
                     end = max(end, start + charging_time)
                 elif increased_charging_time >= max_increase_allowed:
@@ -654,14 +1105,23 @@ class ElaadChargingSession:
         return result
 
     @staticmethod
-    def parse_file(path: Path) -> list['ElaadChargingSession']:
+    def parse_file(path: Path, warnings_log_path: Optional[Path] = None) -> list['ElaadChargingSession']:
+        """Parse all charge sessions from an Elaad transactions CSV.
+
+        Warnings for individual lines are counted by category and a summary is printed after parsing.
+
+        :param path: Path to the CSV file.
+        :param warnings_log_path: If set, a sample of the warnings of each category is written to this file.
+        :return: All charge sessions in the CSV which could be parsed.
+        """
         elaad_transactions = []
         num_skipped = 0
         total_lines = 0
+        warnings = WarningCollector()
         with open(path) as open_file:
             open_file.readline() # skip header
             for line in open_file:
-                transaction = ElaadChargingSession.from_line(line)
+                transaction = ElaadChargingSession.from_line(line, warnings)
                 if transaction is None:
                     num_skipped += 1
                 else:
@@ -669,6 +1129,10 @@ class ElaadChargingSession:
                 total_lines += 1
 
         print(f'Skipped {num_skipped} out of {total_lines} lines.')
+        print(warnings.summary())
+        if warnings_log_path is not None:
+            warnings.write_log(warnings_log_path)
+            print(f'Wrote a sample of the warnings to {warnings_log_path}')
 
         return elaad_transactions
 
@@ -689,15 +1153,15 @@ class AlbatrosChargingSession:
     charging_time: timedelta
     charged_energy_kwh: float
     max_power_kw: float
+    _default_energy_profiles: dict[tuple[int, int], EnergyProfile] = field(default_factory=dict,
+                                                                          init=False,
+                                                                          repr=False,
+                                                                          compare=False)
 
     def to_general_charging_session(self, block_metadata: BlockMetadata) -> Optional[ChargingSession]:
         block_range = block_metadata.to_range_in_block_int()
         session = block_metadata.convert_to_range_in_block_decimal(self.utc_session_start, self.utc_session_stop)
-        energy_profile = to_energy_profile_using_default_charge_behaviour(session,
-                                                                          block_metadata,
-                                                                          self.charged_energy_kwh,
-                                                                          self.charging_time,
-                                                                          self.max_power_kw)
+        energy_profile = to_default_energy_profile_in_block(self, block_metadata, self._default_energy_profiles)
 
         if session:
             masked_session = session.intersection_decimal(block_range)
@@ -739,26 +1203,50 @@ class AlbatrosChargingSession:
         return result
 
     @staticmethod
-    def parse_file(path: Path) -> list['AlbatrosChargingSession']:
+    def iter_file(path: Path) -> Iterator['AlbatrosChargingSession']:
+        """Stream the charge sessions from an Albatros XLSX workbook row by row.
+
+        The workbook is opened in read-only and values-only mode so only the current row is held in memory.
+
+        :param path: Path to the XLSX workbook. The first row is expected to contain the column headers.
+        :return: Iterator yielding a charge session for each row in the workbook.
+        """
+        workbook = openpyxl.load_workbook(path, read_only=True, keep_vba=False, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            headers = next(rows, None)
+            if headers is not None:
+                for row in rows:
+                    yield AlbatrosChargingSession.from_line(dict(zip(headers, row)))
+        finally:
+            workbook.close()
+
+    @staticmethod
+    def parse_file(path: Path,
+                   use_sidecar_cache: bool = True,
+                   sidecar_cache_dir: Optional[Path] = None) -> list['AlbatrosChargingSession']:
+        """Parse all charge sessions from an Albatros XLSX workbook.
+
+        After parsing the workbook, the sessions are written to a typed parquet sidecar, by default next to the
+        workbook. The sidecar is used instead of the workbook as long as the workbook is unchanged according to its
+        modification time and size or, if those differ, its SHA-256 hash. Writing the sidecar is best-effort: if it
+        cannot be written, e.g. on a read-only mount, a warning is printed and the parsed sessions are returned.
+
+        :param path: Path to the XLSX workbook.
+        :param use_sidecar_cache: If the parquet sidecar should be read and written.
+        :param sidecar_cache_dir: Directory to keep the sidecar in instead of the directory of the workbook.
+        :return: All charge sessions in the workbook.
+        """
+        if use_sidecar_cache:
+            transactions = _read_albatros_sidecar(path, sidecar_cache_dir)
+            if transactions is not None:
+                print(f'Read {len(transactions)} charge sessions from sidecar cache of {path}.')
+                return transactions
+
         transactions = []
         num_skipped = 0
         total_lines = 0
-
-        workbook = openpyxl.load_workbook(path, keep_vba=False, data_only=True)
-        sheet = workbook.active
-
-        headers = []
-        for column in sheet.iter_cols(min_row=1, max_row=2):
-            headers.append(column[0].value)
-        lines = []
-        for row in sheet.iter_rows(min_row=2):
-            line = {}
-            for header, cell in zip(headers, row):
-                line[header] = cell.value
-            lines.append(line)
-
-        for line in lines:
-            transaction = AlbatrosChargingSession.from_line(line)
+        for transaction in AlbatrosChargingSession.iter_file(path):
             if transaction is None:
                 num_skipped += 1
             else:
@@ -767,55 +1255,248 @@ class AlbatrosChargingSession:
 
         print(f'Skipped {num_skipped} out of {total_lines} lines.')
 
+        if use_sidecar_cache:
+            try:
+                _write_albatros_sidecar(path, transactions, sidecar_cache_dir)
+            except OSError as ex:
+                print(f'Warning: Could not write the sidecar cache of {path}, continuing without it: {ex}')
+
         return transactions
 
 
-def calculate_ev_flex_metric(block_metadata: BlockMetadata,
-                             congestion: IntRangeInBlock,
-                             sessions_in_block: list[ChargingSession]) -> Optional[EvFlexMetricProfile]:
-    if not block_metadata.to_range_in_block_int().contains(congestion):
-        raise RuntimeError(f'Congestion range {congestion} should be contained by block {block_metadata}.')
-
-    total_non_flexible_energy_profile: Optional[EnergyProfile] = None
-    total_default_energy_profile: Optional[EnergyProfile] = None
-    for charging_session in sessions_in_block:
-        non_flexible_energy = charging_session.non_flexible_energy_utilizing_whole_session(congestion)
-        non_flexible_energy_evenly_divided = charging_session.non_flexible_energy_evenly_divided(non_flexible_energy,
-                                                                                                 congestion)
-
-        if total_non_flexible_energy_profile is None:
-            total_non_flexible_energy_profile = non_flexible_energy_evenly_divided
-        elif non_flexible_energy_evenly_divided is not None:
-            total_non_flexible_energy_profile = total_non_flexible_energy_profile.profile_addition(non_flexible_energy_evenly_divided)
-
-        default_energy_profile = charging_session.energy_to_charge_profile.mask_int(congestion)
-        if total_default_energy_profile is None:
-            total_default_energy_profile = default_energy_profile
-        elif default_energy_profile is not None:
-            total_default_energy_profile = total_default_energy_profile.profile_addition(default_energy_profile)
-
-    if total_default_energy_profile is not None and total_non_flexible_energy_profile is not None:
-        if total_non_flexible_energy_profile.range_in_block != total_default_energy_profile.range_in_block:
-            raise RuntimeError('Something weird happened...')
+ALBATROS_SIDECAR_SUFFIX = '.sessions.parquet'
+ALBATROS_SIDECAR_FINGERPRINT_SUFFIX = '.sessions.json'
+
+
+def _albatros_sidecar_paths(path: Path, sidecar_cache_dir: Optional[Path]) -> Tuple[Path, Path]:
+    directory = path.parent if sidecar_cache_dir is None else sidecar_cache_dir
+    return (directory / (path.name + ALBATROS_SIDECAR_SUFFIX),
+            directory / (path.name + ALBATROS_SIDECAR_FINGERPRINT_SUFFIX))
+
+
+def _file_sha256(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as open_file:
+        for chunk in iter(lambda: open_file.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _read_albatros_sidecar(path: Path, sidecar_cache_dir: Optional[Path]) -> Optional[list[AlbatrosChargingSession]]:
+    """Read the charge sessions from the parquet sidecar of path if the sidecar is still valid.
+
+    :param path: Path to the XLSX workbook.
+    :param sidecar_cache_dir: Directory of the sidecar or None if it is next to the workbook.
+    :return: The cached charge sessions or None if there is no valid sidecar.
+    """
+    sidecar_path, fingerprint_path = _albatros_sidecar_paths(path, sidecar_cache_dir)
+    if not sidecar_path.exists() or not fingerprint_path.exists():
+        return None
+
+    with open(fingerprint_path) as open_file:
+        fingerprint = json.load(open_file)
+    stat = path.stat()
+    if fingerprint['source_mtime_ns'] != stat.st_mtime_ns or fingerprint['source_size'] != stat.st_size:
+        if fingerprint['source_sha256'] != _file_sha256(path):
+            return None
+        fingerprint['source_mtime_ns'] = stat.st_mtime_ns
+        fingerprint['source_size'] = stat.st_size
+        try:
+            with open(fingerprint_path, 'w') as open_file:
+                json.dump(fingerprint, open_file)
+        except OSError as ex:
+            print(f'Warning: Could not update the sidecar fingerprint of {path}: {ex}')
+
+    df = pandas.read_parquet(sidecar_path)
+    return [AlbatrosChargingSession(int(row.transaction_id),
+                                    row.utc_session_start.to_pydatetime().replace(tzinfo=pytz.utc),
+                                    row.utc_session_stop.to_pydatetime().replace(tzinfo=pytz.utc),
+                                    timedelta(microseconds=int(row.charging_time_us)),
+                                    float(row.charged_energy_kwh),
+                                    float(row.max_power_kw))
+            for row in df.itertuples(index=False)]
+
+
+def _write_albatros_sidecar(path: Path,
+                            transactions: list[AlbatrosChargingSession],
+                            sidecar_cache_dir: Optional[Path]) -> None:
+    """Write the charge sessions to the typed parquet sidecar of path together with the fingerprint of path.
+
+    :param path: Path to the XLSX workbook the charge sessions were parsed from.
+    :param transactions: The parsed charge sessions.
+    :param sidecar_cache_dir: Directory of the sidecar or None if it is next to the workbook. Created if missing.
+    """
+    sidecar_path, fingerprint_path = _albatros_sidecar_paths(path, sidecar_cache_dir)
+    sidecar_path.parent.mkdir(parents=True, exist_ok=True)
+    df = pandas.DataFrame({
+        'transaction_id': pandas.Series([t.transaction_id for t in transactions], dtype='int64'),
+        'utc_session_start': pandas.to_datetime([t.utc_session_start for t in transactions], utc=True),
+        'utc_session_stop': pandas.to_datetime([t.utc_session_stop for t in transactions], utc=True),
+        'charging_time_us': pandas.Series([t.charging_time // timedelta(microseconds=1) for t in transactions],
+                                          dtype='int64'),
+        'charged_energy_kwh': pandas.Series([t.charged_energy_kwh for t in transactions], dtype='float64'),
+        'max_power_kw': pandas.Series([t.max_power_kw for t in transactions], dtype='float64'),
+    })
+    df.to_parquet(sidecar_path, index=False)
+
+    stat = path.stat()
+    with open(fingerprint_path, 'w') as open_file:
+        json.dump({'source_mtime_ns': stat.st_mtime_ns,
+                   'source_size': stat.st_size,
+                   'source_sha256': _file_sha256(path)},
+                  open_file)
+
+
+class SlidingSessionWindow:
+    """The transactions overlapping a window in time which only moves forward.
+
+    Moving the window only visits the transactions entering and leaving the window instead of checking the overlap
+    of every transaction again. Transactions are added once the window end passes their start and removed once the
+    window start passes their stop.
+    """
+    transactions: list['ElaadChargingSession | AlbatrosChargingSession']
+
+    def __init__(self, transactions: list['ElaadChargingSession | AlbatrosChargingSession']):
+        self.transactions = transactions
+        self._indices_by_start = sorted(range(len(transactions)), key=lambda index: transactions[index].utc_session_start)
+        self._num_entered = 0
+        self._active_by_stop: list[tuple[datetime, int]] = []
+        self._active_indices: set[int] = set()
+        self._window_start: Optional[datetime] = None
+        self._window_end: Optional[datetime] = None
+
+    def move_to(self, window_start: datetime, window_end: datetime) -> list['ElaadChargingSession | AlbatrosChargingSession']:
+        """Move the window and return the transactions which overlap it.
+
+        :param window_start: The new start of the window. May not be earlier than the previous start.
+        :param window_end: The new end of the window. May not be earlier than the previous end.
+        :return: The transactions overlapping the window in the order of the transactions given to this window.
+        """
+        if self._window_start is not None and (window_start < self._window_start or window_end < self._window_end):
+            raise RuntimeError(f'Cannot move window {self._window_start}-{self._window_end} back to '
+                               f'{window_start}-{window_end}.')
+        self._window_start = window_start
+        self._window_end = window_end
+
+        while (self._num_entered < len(self._indices_by_start)
+               and self.transactions[self._indices_by_start[self._num_entered]].utc_session_start < window_end):
+            index = self._indices_by_start[self._num_entered]
+            self._num_entered += 1
+            heapq.heappush(self._active_by_stop, (self.transactions[index].utc_session_stop, index))
+            self._active_indices.add(index)
+
+        while self._active_by_stop and self._active_by_stop[0][0] <= window_start:
+            _, index = heapq.heappop(self._active_by_stop)
+            self._active_indices.discard(index)
+
+        return [self.transactions[index] for index in sorted(self._active_indices)]
+
+
+class BlockEvFlexMetricEvaluator:
+    """Evaluates the ev flex metric of many congestions within the same block.
+
+    The default energy per step of all sessions in the block is aggregated once. Evaluating a congestion then only
+    requires the non flexible energy of the sessions during that congestion, which is calculated for all sessions at
+    once from their session features, so the default energy profiles are not masked and added again for every
+    congestion.
+    Sessions are aggregated in the order they are given, which results in the same values as adding their energy
+    profiles per congestion.
+    """
+    block_metadata: BlockMetadata
+    sessions_in_block: list[ChargingSession]
+    session_features: SessionFeatureTable
+    default_energy_per_block: list[float]
+
+    def __init__(self, block_metadata: BlockMetadata, sessions_in_block: list[ChargingSession]):
+        self.block_metadata = block_metadata
+        self.sessions_in_block = sessions_in_block
+        self.session_features = SessionFeatureTable(sessions_in_block)
+
+        block_range = block_metadata.to_range_in_block_int()
+        default_energy = EnergyProfileAccumulator(block_range)
+        for charging_session in sessions_in_block:
+            default_energy_profile = charging_session.energy_to_charge_profile.mask_int(block_range)
+            if default_energy_profile is not None:
+                default_energy.add_into(default_energy_profile)
+        self.default_energy_per_block = default_energy.energy_per_block
+
+    def sessions_during(self, congestion: IntRangeInBlock) -> list[ChargingSession]:
+        return [charging_session for charging_session in self.sessions_in_block
+                if charging_session.session.overlaps(congestion)]
+
+    def ev_flex_metric(self, congestion: IntRangeInBlock) -> Optional[EvFlexMetricProfile]:
+        if not self.block_metadata.to_range_in_block_int().contains(congestion):
+            raise RuntimeError(f'Congestion range {congestion} should be contained by block {self.block_metadata}.')
+
+        non_flexible_energy_per_block = [0.0] * congestion.total_block_duration()
+        metric_range: Optional[IntRangeInBlock] = None
+        session_indices = numpy.arange(len(self.sessions_in_block))
+        during_congestion = self.session_features.overlaps(session_indices, congestion.start, congestion.end)
+        session_indices_during_congestion = session_indices[during_congestion]
+        non_flexible_energies = self.session_features.non_flexible_energy_utilizing_whole_session(
+            session_indices_during_congestion,
+            congestion.start,
+            congestion.end).tolist()
+        for session_index, non_flexible_energy in zip(session_indices_during_congestion.tolist(), non_flexible_energies):
+            charging_session = self.sessions_in_block[session_index]
+            session_congestion = charging_session.session.intersection_decimal(congestion)
+            session_congestion_int = session_congestion.to_range_in_block_int()
+            if metric_range is None:
+                metric_range = session_congestion_int
+            else:
+                metric_range = IntRangeInBlock.unchecked(min(metric_range.start, session_congestion_int.start),
+                                                         max(metric_range.end, session_congestion_int.end))
+
+            non_flexible_energy_per_step = non_flexible_energy / session_congestion.total_block_duration()
+            for i in session_congestion.block_nums():
+                non_flexible_energy_per_block[i - congestion.start] += (non_flexible_energy_per_step *
+                                                                        session_congestion.duration_at_step_num(i))
+
+        if metric_range is None:
+            return None
 
         ev_flex_values = []
-        for i in total_default_energy_profile.range_in_block.block_nums():
-            non_flex_energy = total_non_flexible_energy_profile.energy_at(i)
-            default_energy = total_default_energy_profile.energy_at(i)
+        for i in metric_range.block_nums():
+            non_flex_energy = non_flexible_energy_per_block[i - congestion.start]
+            default_energy = self.default_energy_per_block[i]
             if default_energy == 0.0:
                 ev_flex_metric = 0
             else:
                 ev_flex_metric = (default_energy - non_flex_energy) / default_energy
             ev_flex_values.append(ev_flex_metric)
 
-        return EvFlexMetricProfile(total_default_energy_profile.range_in_block,
-                                   ev_flex_values)
-    return None
+        return EvFlexMetricProfile(metric_range, ev_flex_values)
+
+
+def calculate_ev_flex_metric(block_metadata: BlockMetadata,
+                             congestion: IntRangeInBlock,
+                             sessions_in_block: list[ChargingSession]) -> Optional[EvFlexMetricProfile]:
+    return BlockEvFlexMetricEvaluator(block_metadata, sessions_in_block).ev_flex_metric(congestion)
+
+
+def calculate_ev_flex_metrics(block_metadata: BlockMetadata,
+                              congestions: list[IntRangeInBlock],
+                              sessions_in_block: list[ChargingSession]) -> list[Optional[EvFlexMetricProfile]]:
+    """Calculate the ev flex metric for each of the congestions within the same block at once.
+
+    :param block_metadata: The block containing all congestions.
+    :param congestions: The congestions to evaluate.
+    :param sessions_in_block: The sessions during the block.
+    :return: The ev flex metric per congestion in the same order as congestions.
+    """
+    evaluator = BlockEvFlexMetricEvaluator(block_metadata, sessions_in_block)
+    return [evaluator.ev_flex_metric(congestion) for congestion in congestions]
 
 
 def main():
-    # transactions = ElaadChargingSession.parse_file(Path('/mnt/vm-shared/ElaadNL datasets.HoogVertrouwelijk/transactions1Y.csv'))
-    transactions = AlbatrosChargingSession.parse_file(Path('/mnt/vm-shared/ChargeSessions_private_charging_5501.xlsx'))
+    session_store_path = os.environ.get('SESSION_STORE_PATH')
+    if session_store_path:
+        # Imported here as the session store depends on the charging session types in this module.
+        from ev_flex_metric.session_store import SessionTable
+        transactions = SessionTable.read(Path(session_store_path)).to_albatros_charging_sessions()
+    else:
+        # transactions = ElaadChargingSession.parse_file(Path('/mnt/vm-shared/ElaadNL datasets.HoogVertrouwelijk/transactions1Y.csv'))
+        transactions = AlbatrosChargingSession.parse_file(Path('/mnt/vm-shared/ChargeSessions_private_charging_5501.xlsx'))
     output_schema = json.dumps({'name': 'ev_flex_metric_elaad_2019',
                                 'type': 'record',
                                 'fields': [{"name": "block_start_epoch_timestamp",
@@ -840,55 +1521,64 @@ def main():
     with DataFileWriter(open('notebooks/ev_flex_metric.avro', "wb"), DatumWriter(), avro.schema.parse(output_schema)) as writer:
         resolution = timedelta(hours=1)
         step_duration = timedelta(minutes=15)
-        for block_length_duration in [8, 12, 16, 20, 24, 28, 32, 36]:
-            for congestion_start in range(0, block_length_duration, 4):
-                start = datetime(year=2021, month=6, day=1, hour=0, minute=0, second=0, tzinfo=pytz.utc)
-                final = start + timedelta(days=7)
-                block_duration = step_duration * block_length_duration
-                end = start + block_duration
-                block_metadata = BlockMetadata(start, end, step_duration)
-                congestion = IntRangeInBlock(congestion_start, congestion_start + 4)
-
-                while start < final:
-                    congestion_start = congestion.start * step_duration + start
-                    congestion_end = congestion.end * step_duration + start
-                    charging_sessions = []
-                    for elaad_transaction in transactions:
-                        if times_ranges_overlap(congestion_start,
-                                                congestion_end,
-                                                elaad_transaction.utc_session_start,
-                                                elaad_transaction.utc_session_stop):
-                            charging_session = elaad_transaction.to_general_charging_session(block_metadata)
-                            if charging_session:
-                                charging_sessions.append(charging_session)
-                    print(f'A number of {len(charging_sessions)} charging sessions overlap with the chosen block')
-
-                    ev_flex_metric = calculate_ev_flex_metric(block_metadata, congestion, charging_sessions)
-                    print(f'{start}-{end}', ev_flex_metric)
+        sweep_duration = timedelta(days=7)
+        block_length_durations = [8, 12, 16, 20, 24, 28, 32, 36]
+        progress = ProgressReporter(total=sum(len(range(0, block_length_duration, 4))
+                                              for block_length_duration in block_length_durations) * math.ceil(sweep_duration / resolution),
+                                    unit='blocks')
+        for block_length_duration in block_length_durations:
+            congestions = [IntRangeInBlock(congestion_start, congestion_start + 4)
+                           for congestion_start in range(0, block_length_duration, 4)]
+            # All congestions of a block are evaluated at once but the records are written per congestion to keep
+            # the order of the output.
+            records_per_congestion = [[] for _ in congestions]
+            start = datetime(year=2021, month=6, day=1, hour=0, minute=0, second=0, tzinfo=pytz.utc)
+            final = start + sweep_duration
+            block_duration = step_duration * block_length_duration
+            end = start + block_duration
+            block_metadata = BlockMetadata(start, end, step_duration)
+            transactions_during_block = SlidingSessionWindow(transactions)
+
+            while start < final:
+                charging_sessions = []
+                for elaad_transaction in transactions_during_block.move_to(start, end):
+                    charging_session = elaad_transaction.to_general_charging_session(block_metadata)
+                    if charging_session:
+                        charging_sessions.append(charging_session)
+
+                evaluator = BlockEvFlexMetricEvaluator(block_metadata, charging_sessions)
+                for congestion, records in zip(congestions, records_per_congestion):
+                    ev_flex_metric = evaluator.ev_flex_metric(congestion)
                     if ev_flex_metric:
+                        num_of_charging_sessions = len(evaluator.sessions_during(congestion))
                         for ev_flex_metric_timestep, ev_flex_matric_value in zip(range(congestion.start, congestion.end),
                                                                                  ev_flex_metric.value_per_block):
-                            writer.append({'block_start_epoch_timestamp': start,
-                                           'timestep_duration_seconds': int(step_duration.total_seconds()),
-                                           'block_length_timestep': block_metadata.num_of_blocks,
-                                           'congestion_start_timestep': congestion.start,
-                                           'congestion_end_timestep': congestion.end,
-                                           'ev_flex_metric_for_timestep': ev_flex_metric_timestep,
-                                           'ev_flex_metric_value': ev_flex_matric_value,
-                                           'num_of_charging_sessions_during_congestion': len(charging_sessions)})
-
-                    start = start + resolution
-                    end = start + block_duration
-                    block_metadata = BlockMetadata(start, end, step_duration)
-
-                    # congestion = IntRangeInBlock(2, 4)
-                    # print(calculate_ev_flex_metric(block_metadata, congestion, charging_sessions))
-                    #
-                    # congestion = IntRangeInBlock(3, 4)
-                    # print(calculate_ev_flex_metric(block_metadata, congestion, charging_sessions))
-                    #
-                    # congestion = IntRangeInBlock(0, 4)
-                    # print(calculate_ev_flex_metric(block_metadata, congestion, charging_sessions))
+                            records.append({'block_start_epoch_timestamp': start,
+                                            'timestep_duration_seconds': int(step_duration.total_seconds()),
+                                            'block_length_timestep': block_metadata.num_of_blocks,
+                                            'congestion_start_timestep': congestion.start,
+                                            'congestion_end_timestep': congestion.end,
+                                            'ev_flex_metric_for_timestep': ev_flex_metric_timestep,
+                                            'ev_flex_metric_value': ev_flex_matric_value,
+                                            'num_of_charging_sessions_during_congestion': num_of_charging_sessions})
+
+                start = start + resolution
+                end = start + block_duration
+                block_metadata = BlockMetadata(start, end, step_duration)
+                progress.advance(len(congestions))
+
+            for records in records_per_congestion:
+                for record in records:
+                    writer.append(record)
+
+            # congestion = IntRangeInBlock(2, 4)
+            # print(calculate_ev_flex_metric(block_metadata, congestion, charging_sessions))
+            #
+            # congestion = IntRangeInBlock(3, 4)
+            # print(calculate_ev_flex_metric(block_metadata, congestion, charging_sessions))
+            #
+            # congestion = IntRangeInBlock(0, 4)
+            # print(calculate_ev_flex_metric(block_metadata, congestion, charging_sessions))
 
 
 if __name__ == '__main__':
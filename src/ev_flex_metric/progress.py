@@ -0,0 +1,95 @@
+import time
+from datetime import timedelta
+from pathlib import Path
+from typing import Callable, Optional
+
+
+def format_duration(seconds: float) -> str:
+    return str(timedelta(seconds=round(seconds)))
+
+
+class ProgressReporter:
+    """Prints the progress of a run with its throughput and ETA at most once every interval.
+
+    The final item is always reported so the last line printed shows the total duration and throughput.
+    """
+    total: int
+    unit: str
+    interval_seconds: float
+    done: int
+
+    def __init__(self,
+                 total: int,
+                 unit: str = 'items',
+                 interval_seconds: float = 10.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.total = total
+        self.unit = unit
+        self.interval_seconds = interval_seconds
+        self.done = 0
+        self._clock = clock
+        self._started_at = clock()
+        self._last_reported_at = self._started_at
+
+    def advance(self, num_done: int = 1) -> None:
+        self.done += num_done
+        now = self._clock()
+        if now - self._last_reported_at >= self.interval_seconds or self.done >= self.total:
+            self._last_reported_at = now
+            print(self.status(now))
+
+    def status(self, now: Optional[float] = None) -> str:
+        if now is None:
+            now = self._clock()
+        elapsed = now - self._started_at
+        if elapsed > 0 and self.done > 0:
+            throughput = self.done / elapsed
+            eta = format_duration(max(self.total - self.done, 0) / throughput)
+        else:
+            throughput = 0.0
+            eta = 'unknown'
+        return (f'Processed {self.done}/{self.total} {self.unit} ({throughput:.2f} {self.unit}/s, '
+                f'elapsed {format_duration(elapsed)}, ETA {eta})')
+
+
+class WarningCollector:
+    """Aggregates warnings by category instead of printing each of them.
+
+    Every warning is counted but only the first max_samples_per_category messages of each category are kept.
+    """
+    max_samples_per_category: int
+    counts: dict[str, int]
+    samples: dict[str, list[str]]
+
+    def __init__(self, max_samples_per_category: int = 20):
+        self.max_samples_per_category = max_samples_per_category
+        self.counts = {}
+        self.samples = {}
+
+    def warn(self, category: str, message: str) -> None:
+        self.counts[category] = self.counts.get(category, 0) + 1
+        samples = self.samples.setdefault(category, [])
+        if len(samples) < self.max_samples_per_category:
+            samples.append(message)
+
+    def summary(self) -> str:
+        if not self.counts:
+            return 'No warnings.'
+        return '\n'.join(f'{count} x {category}' for category, count in self.counts.items())
+
+    def write_log(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as open_file:
+            for category, count in self.counts.items():
+                samples = self.samples[category]
+                open_file.write(f'{category}: {count} warnings, showing {len(samples)}\n')
+                for sample in samples:
+                    open_file.write(f'    {sample}\n')
+
+
+def warn(warnings: Optional[WarningCollector], category: str, message: str) -> None:
+    """Add the warning to warnings or print the message if no collector is given."""
+    if warnings is None:
+        print(message)
+    else:
+        warnings.warn(category, message)
@@ -7,8 +7,13 @@ IntInstantInBlock = int
 RangeType = TypeVar("RangeType", bound=float)
 
 
-@dataclass
+@dataclass(slots=True)
 class RangeInBlock(Generic[RangeType]):
+    """A range during the block with a start time and an end time.
+
+    Ranges are slotted as they are created in large numbers. Subclasses must define `__slots__ = ()` to stay free
+    of a `__dict__`.
+    """
     start: RangeType
     end: RangeType
 
@@ -18,6 +23,18 @@ class RangeInBlock(Generic[RangeType]):
         if start > end:
             raise RuntimeError(f'Cannot create a range where end ({end}) is earlier than start ({start}).')
 
+    @classmethod
+    def unchecked(cls, start: RangeType, end: RangeType):
+        """Create a range without validating that start <= end.
+
+        Only meant for callers which already guarantee that start <= end, such as the intersection or subtraction
+        of two valid ranges.
+        """
+        result = object.__new__(cls)
+        result.start = start
+        result.end = end
+        return result
+
     def __eq__(self, other) -> bool:
         if isinstance(other, RangeInBlock):
             return self.start == other.start and self.end == other.end
@@ -25,7 +42,7 @@ class RangeInBlock(Generic[RangeType]):
             return False
 
     def __hash__(self) -> int:
-        return hash(self.start) + hash(self.end)
+        return hash((self.start, self.end))
 
     def overlaps(self, other: 'RangeInBlock') -> bool:
         return not (self.start >= other.end or self.end <= other.start)
@@ -43,19 +60,18 @@ class RangeInBlock(Generic[RangeType]):
 
 class DecimalRangeInBlock(RangeInBlock[DecimalInstantInBlock]):
     """A range during the block with a start time and an end time. Start is inclusive, end is exclusive."""
-
-    def __init__(self, start: float, end: float):
-        super().__init__(start, end)
+    __slots__ = ()
 
     def intersection_decimal(self, other: 'RangeInBlock') -> Optional['DecimalRangeInBlock']:
         if self.overlaps(other):
-            return DecimalRangeInBlock(max(self.start, other.start), min(self.end, other.end))
+            return DecimalRangeInBlock.unchecked(max(self.start, other.start), min(self.end, other.end))
         else:
             return None
 
     def intersection_int(self, other: 'RangeInBlock') -> Optional['IntRangeInBlock']:
         if self.overlaps(other):
-            return IntRangeInBlock(math.floor(max(self.start, other.start)), math.ceil(min(self.end, other.end)))
+            return IntRangeInBlock.unchecked(math.floor(max(self.start, other.start)),
+                                             math.ceil(min(self.end, other.end)))
         else:
             return None
 
@@ -71,7 +87,7 @@ class DecimalRangeInBlock(RangeInBlock[DecimalInstantInBlock]):
         return iter(range(self.start_int, self.end_int))
 
     def to_range_in_block_int(self) -> 'IntRangeInBlock':
-        return IntRangeInBlock(self.start_int, self.end_int)
+        return IntRangeInBlock.unchecked(math.floor(self.start), math.ceil(self.end))
 
     def duration_at_step_num(self, step_num: int) -> float:
         """Duration as a factor of 0..1 of how long the step at step_num is inside the range.
@@ -101,24 +117,22 @@ class DecimalRangeInBlock(RangeInBlock[DecimalInstantInBlock]):
         """
         left = None
         if self.start < other.start:
-            left = DecimalRangeInBlock(self.start, min(other.start, self.end))
+            left = DecimalRangeInBlock.unchecked(self.start, min(other.start, self.end))
 
         right = None
         if self.end > other.end:
-            right = DecimalRangeInBlock(max(self.start, other.end), self.end)
+            right = DecimalRangeInBlock.unchecked(max(self.start, other.end), self.end)
 
         return left, right
 
 
 class IntRangeInBlock(RangeInBlock[IntInstantInBlock]):
     """A range during the block with a start time and an end time.  Start is inclusive, end is exclusive."""
-
-    def __init__(self, start: int, end: int):
-        super().__init__(start, end)
+    __slots__ = ()
 
     def intersection_int(self, other: 'IntRangeInBlock') -> Optional['IntRangeInBlock']:
         if self.overlaps(other):
-            return IntRangeInBlock(max(self.start, other.start), min(self.end, other.end))
+            return IntRangeInBlock.unchecked(max(self.start, other.start), min(self.end, other.end))
         else:
             return None
 
@@ -136,12 +150,12 @@ class IntRangeInBlock(RangeInBlock[IntInstantInBlock]):
             return None, self
         else:
             if instant > self.start:
-                left = IntRangeInBlock(self.start, instant)
+                left = IntRangeInBlock.unchecked(self.start, instant)
             else:
                 left = None
 
             if instant < self.end:
-                right = IntRangeInBlock(instant, self.end)
+                right = IntRangeInBlock.unchecked(instant, self.end)
             else:
                 right = None
         return left, right
@@ -159,10 +173,10 @@ class IntRangeInBlock(RangeInBlock[IntInstantInBlock]):
                 """
         left = None
         if self.start < other.start:
-            left = IntRangeInBlock(self.start, min(other.start, self.end))
+            left = IntRangeInBlock.unchecked(self.start, min(other.start, self.end))
 
         right = None
         if self.end > other.end:
-            right = IntRangeInBlock(max(self.start, other.end), self.end)
+            right = IntRangeInBlock.unchecked(max(self.start, other.end), self.end)
 
         return left, right
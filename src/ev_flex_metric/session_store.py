@@ -0,0 +1,172 @@
+import argparse
+from dataclasses import dataclass
+from enum import Enum
+from pathlib import Path
+from typing import Optional
+
+import pandas
+import pytz
+
+from ev_flex_metric.main import AlbatrosChargingSession, ElaadChargingSession
+
+SESSION_TABLE_DTYPES = {
+    'pc4': 'int64',
+    'household_id': 'int64',
+    'session_id': 'int64',
+    'start': 'datetime64[ns, UTC]',
+    'end': 'datetime64[ns, UTC]',
+    'charge_end': 'datetime64[ns, UTC]',
+    'charged_energy_kwh': 'float64',
+    'max_power_kw': 'float64',
+}
+SESSION_TABLE_SORT_ORDER = ['pc4', 'household_id', 'start']
+
+
+class SessionSourceType(Enum):
+    ELAAD_CSV = 'elaad-csv'
+    ALBATROS_XLSX = 'albatros-xlsx'
+    PRIVATE_CHARGING_PARQUET = 'private-charging-parquet'
+
+
+@dataclass
+class SessionTable:
+    """Columnar table of charge sessions normalized from any of the input sources.
+
+    Each row is a charge session with the columns in SESSION_TABLE_DTYPES. `start` and `end` are the moments the EV
+    is plugged in and out, `charge_end` is the moment the EV stops charging when using the default charge behaviour.
+    All timestamps are in UTC. Rows are sorted by pc4, household and start.
+
+    Sources which do not contain a pc4 or household receive the pc4 given during ingestion and use the session id
+    as household id.
+    """
+    df: pandas.DataFrame
+
+    def __init__(self, df: pandas.DataFrame):
+        missing_columns = set(SESSION_TABLE_DTYPES) - set(df.columns)
+        if missing_columns:
+            raise RuntimeError(f'Session table is missing columns {sorted(missing_columns)}.')
+
+        df = df[list(SESSION_TABLE_DTYPES)].astype(SESSION_TABLE_DTYPES)
+        self.df = df.sort_values(by=SESSION_TABLE_SORT_ORDER, kind='stable').reset_index(drop=True)
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    def for_pc4(self, pc4: int) -> 'SessionTable':
+        return SessionTable(self.df[self.df['pc4'] == pc4])
+
+    def to_albatros_charging_sessions(self) -> list[AlbatrosChargingSession]:
+        """Convert the sessions to the object model used by the legacy flex metric sweep."""
+        return [AlbatrosChargingSession(int(row.session_id),
+                                        row.start.to_pydatetime().replace(tzinfo=pytz.utc),
+                                        row.end.to_pydatetime().replace(tzinfo=pytz.utc),
+                                        (row.charge_end - row.start).to_pytimedelta(),
+                                        float(row.charged_energy_kwh),
+                                        float(row.max_power_kw))
+                for row in self.df.itertuples(index=False)]
+
+    def write(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.df.to_parquet(path, index=False)
+
+    @staticmethod
+    def read(path: Path, pc4: Optional[int] = None) -> 'SessionTable':
+        table = SessionTable(pandas.read_parquet(path))
+        if pc4 is not None:
+            table = table.for_pc4(pc4)
+        return table
+
+    @staticmethod
+    def from_private_charging_parquet(path: Path) -> 'SessionTable':
+        """Normalize the private charging sessions parquet which accompanies the per-pc4 energy profiles."""
+        df = pandas.read_parquet(path)
+        return SessionTable(pandas.DataFrame({'pc4': df['pc4'],
+                                              'household_id': df['household_id'],
+                                              'session_id': df['session_id'],
+                                              'start': _to_utc(df['startTime']),
+                                              'end': _to_utc(df['plugOutTime']),
+                                              'charge_end': _to_utc(df['endTime']),
+                                              'charged_energy_kwh': df['charge_kWh'],
+                                              'max_power_kw': df['maxChargePower_kW']}))
+
+    @staticmethod
+    def from_albatros_xlsx(path: Path, pc4: int, sidecar_cache_dir: Optional[Path] = None) -> 'SessionTable':
+        sessions = AlbatrosChargingSession.parse_file(path, sidecar_cache_dir=sidecar_cache_dir)
+        return SessionTable._from_charging_sessions(sessions, pc4)
+
+    @staticmethod
+    def from_elaad_csv(path: Path, pc4: int, warnings_log_path: Optional[Path] = None) -> 'SessionTable':
+        return SessionTable._from_charging_sessions(ElaadChargingSession.parse_file(path, warnings_log_path), pc4)
+
+    @staticmethod
+    def _from_charging_sessions(sessions: list[AlbatrosChargingSession] | list[ElaadChargingSession],
+                                pc4: int) -> 'SessionTable':
+        session_ids = [int(session.transaction_id) for session in sessions]
+        starts = pandas.to_datetime([session.utc_session_start for session in sessions], utc=True)
+        charging_times = pandas.to_timedelta([session.charging_time for session in sessions])
+        return SessionTable(pandas.DataFrame({
+            'pc4': [pc4] * len(sessions),
+            'household_id': session_ids,
+            'session_id': session_ids,
+            'start': starts,
+            'end': pandas.to_datetime([session.utc_session_stop for session in sessions], utc=True),
+            'charge_end': starts + charging_times,
+            'charged_energy_kwh': [session.charged_energy_kwh for session in sessions],
+            'max_power_kw': [session.max_power_kw for session in sessions],
+        }))
+
+    @staticmethod
+    def from_source(source_type: SessionSourceType,
+                    path: Path,
+                    pc4: Optional[int] = None,
+                    warnings_log_path: Optional[Path] = None,
+                    sidecar_cache_dir: Optional[Path] = None) -> 'SessionTable':
+        match source_type:
+            case SessionSourceType.PRIVATE_CHARGING_PARQUET:
+                return SessionTable.from_private_charging_parquet(path)
+            case SessionSourceType.ALBATROS_XLSX | SessionSourceType.ELAAD_CSV if pc4 is None:
+                raise RuntimeError(f'Source type {source_type.value} does not contain a pc4 so it must be given.')
+            case SessionSourceType.ALBATROS_XLSX:
+                return SessionTable.from_albatros_xlsx(path, pc4, sidecar_cache_dir)
+            case SessionSourceType.ELAAD_CSV:
+                return SessionTable.from_elaad_csv(path, pc4, warnings_log_path)
+            case _:
+                raise RuntimeError(f'Unknown session source type {source_type}')
+
+
+def _to_utc(series: pandas.Series) -> pandas.Series:
+    if series.dt.tz is None:
+        return series.dt.tz_localize(pytz.utc)
+    return series.dt.tz_convert(pytz.utc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Normalize charge sessions from an input source into a session '
+                                                 'store parquet file.')
+    parser.add_argument('--source-type',
+                        required=True,
+                        choices=[source_type.value for source_type in SessionSourceType])
+    parser.add_argument('--source', required=True, type=Path, help='Path to the input source.')
+    parser.add_argument('--output', required=True, type=Path, help='Path to write the session store parquet file.')
+    parser.add_argument('--pc4', type=int, help='The pc4 of the sessions for sources which do not contain a pc4.')
+    parser.add_argument('--warnings-log-path',
+                        type=Path,
+                        help='Path to write a sample of the warnings per category while parsing the source.')
+    parser.add_argument('--sidecar-cache-dir',
+                        type=Path,
+                        help='Directory to cache the parsed sessions of an Albatros workbook in. Defaults to the '
+                             'directory of the workbook.')
+    args = parser.parse_args()
+
+    print(f'Ingesting {args.source_type} sessions from {args.source}...')
+    table = SessionTable.from_source(SessionSourceType(args.source_type),
+                                     args.source,
+                                     args.pc4,
+                                     args.warnings_log_path,
+                                     args.sidecar_cache_dir)
+    table.write(args.output)
+    print(f'Wrote {len(table)} sessions to {args.output}.')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,26 @@
 import os
 import sys
+from collections import OrderedDict
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 from enum import Enum
-from functools import reduce
 from itertools import combinations
 from pathlib import Path
-from typing import List
+from typing import Hashable, List, Optional, Sequence
 
+import numpy
 import pandas
 import pytz
 from dataclass_binder import Binder
 
-from ev_flex_metric.main import ChargingSession, EnergyProfile, BlockMetadata
+from ev_flex_metric import kernels
+from ev_flex_metric.instrumentation import StageTimer, MemoryMonitor, MemoryBudgetExceeded
+from ev_flex_metric.main import ChargingSession, EnergyProfile, EnergyProfileAccumulator, BlockMetadata, \
+    ShiftResult, ValuesView, to_epoch_ns_array
+from ev_flex_metric.progress import ProgressReporter
 from ev_flex_metric.ranges import DecimalRangeInBlock, IntRangeInBlock
+from ev_flex_metric.session_store import SessionTable
+from ev_flex_metric.shifting_strategies import NeighbourhoodLoad, SessionBatch, ShiftingStrategy, shifting_strategy
 
 
 def write_df_to_file(config: 'OutputProfilesConfig', filename: str, df: pandas.DataFrame) -> None:
@@ -31,36 +38,204 @@ def write_df_to_file(config: 'OutputProfilesConfig', filename: str, df: pandas.D
             raise RuntimeError(f'Unknown extension {config.file_format}')
 
 
+class ShiftedEnergyProfileMemo:
+    """A least recently used memo of the shifted energy profiles of charge sessions.
+
+    The shifted energy profile of a session only depends on the session itself, where it starts relative to the flex
+    window, the part of the congestion overlapping the session and where the flex window ends. The caller identifies
+    the session and its start relative to the flex window with a session key, e.g. the position of the session
+    together with its start relative to the flex window in nanoseconds. The congestion is clipped to the steps of the
+    session so scenarios which only differ in congestion after the session ended reuse the same shifted profile.
+
+    Per session and congestion the result of the longest flex window is kept. If the shifted energy is charged as
+    early as possible after the congestion, the result of a shorter flex window is the same if the shorter flex window
+    leaves the same non flexible energy in the congestion and does not end before the last step in which shifted
+    energy was charged. Only the non flexible energy is then calculated for the shorter flex window. Scenarios should
+    therefore visit the longest flex window first. Shifting strategies which spread the shifted energy across the flex
+    window disable this with derive_shorter_flex_windows.
+
+    The session key must be exact as the shifted profile is calculated in steps of the flex window. Keying on the
+    fractional start relative to the congestion would mix up sessions of which the steps in the flex window differ
+    in the last bits.
+    """
+    max_entries: int
+    derive_shorter_flex_windows: bool
+    hits: int
+    derived_hits: int
+    misses: int
+    evictions: int
+    _shift_results: OrderedDict[Hashable, tuple[int, ShiftResult]]
+
+    def __init__(self, max_entries: int, derive_shorter_flex_windows: bool = True):
+        self.max_entries = max_entries
+        self.derive_shorter_flex_windows = derive_shorter_flex_windows
+        self.hits = 0
+        self.derived_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._shift_results = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._shift_results)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.derived_hits + self.misses
+        return (self.hits + self.derived_hits) / lookups if lookups else 0.0
+
+    def _key(self, session_key: Hashable, charge_session: ChargingSession, congestion: IntRangeInBlock) -> Optional[Hashable]:
+        congestion_during_session = congestion.intersection_int(charge_session.energy_to_charge_profile.range_in_block)
+        if congestion_during_session is None:
+            return None
+        return session_key, congestion_during_session.start, congestion_during_session.end
+
+    @staticmethod
+    def _flex_window_end(charge_session: ChargingSession, flex_window: BlockMetadata) -> int:
+        return min(flex_window.to_range_in_block_int().end, charge_session.energy_to_charge_profile.range_in_block.end)
+
+    def get(self,
+            session_key: Hashable,
+            charge_session: ChargingSession,
+            flex_window: BlockMetadata,
+            congestion: IntRangeInBlock) -> Optional[EnergyProfile]:
+        """Look up the shifted energy profile of a charge session.
+
+        :param session_key: Identifies the charge session and its start relative to flex_window exactly.
+        :param charge_session: The charge session to shift.
+        :param flex_window: The flex window in which the charge session is shifted.
+        :param congestion: When congestion occurs.
+        :return: The shifted energy profile of charge_session or None if it is not in the memo. It is shared with
+            later lookups so may not be changed.
+        """
+        key = self._key(session_key, charge_session, congestion)
+        memoized = self._shift_results.get(key) if key is not None else None
+        if memoized is not None:
+            flex_window_end = self._flex_window_end(charge_session, flex_window)
+            memoized_flex_window_end, shift_result = memoized
+            if memoized_flex_window_end == flex_window_end:
+                self.hits += 1
+                self._shift_results.move_to_end(key)
+                return shift_result.energy_profile
+            if (self.derive_shorter_flex_windows
+                    and flex_window_end < memoized_flex_window_end
+                    and (shift_result.charged_extra_until is None or shift_result.charged_extra_until <= flex_window_end)
+                    and charge_session.non_flexible_energy_utilizing_after_congestion(flex_window, congestion) == shift_result.non_flexible_energy):
+                self.derived_hits += 1
+                self._shift_results.move_to_end(key)
+                return shift_result.energy_profile
+        self.misses += 1
+        return None
+
+    def put(self,
+            session_key: Hashable,
+            charge_session: ChargingSession,
+            flex_window: BlockMetadata,
+            congestion: IntRangeInBlock,
+            shift_result: ShiftResult) -> None:
+        """Remember the shifted energy profile of a charge session which was not in the memo.
+
+        :param session_key: Identifies the charge session and its start relative to flex_window exactly.
+        :param charge_session: The shifted charge session.
+        :param flex_window: The flex window in which the charge session was shifted.
+        :param congestion: When congestion occurs.
+        :param shift_result: The result of shifting charge_session.
+        """
+        key = self._key(session_key, charge_session, congestion)
+        if key is None or self.max_entries <= 0:
+            return
+        flex_window_end = self._flex_window_end(charge_session, flex_window)
+        memoized = self._shift_results.get(key)
+        if memoized is None or flex_window_end > memoized[0]:
+            self._shift_results[key] = (flex_window_end, shift_result)
+        self._shift_results.move_to_end(key)
+        if len(self._shift_results) > self.max_entries:
+            self._shift_results.popitem(last=False)
+            self.evictions += 1
+
+    def shift_flexible_energy_after_congestion(self,
+                                               session_key: Hashable,
+                                               charge_session: ChargingSession,
+                                               flex_window: BlockMetadata,
+                                               congestion: IntRangeInBlock) -> EnergyProfile:
+        """The shifted energy profile of ChargingSession.shift_flexible_energy_after_congestion from the memo.
+
+        :param session_key: Identifies the charge session and its start relative to flex_window exactly.
+        :param charge_session: The charge session to shift.
+        :param flex_window: The flex window in which the charge session is shifted.
+        :param congestion: When congestion occurs.
+        :return: The shifted energy profile of charge_session. It is shared with later lookups so may not be changed.
+        """
+        if self._key(session_key, charge_session, congestion) is None or self.max_entries <= 0:
+            return charge_session.shift_flexible_energy_after_congestion(flex_window, congestion)
+        shifted_energy_profile = self.get(session_key, charge_session, flex_window, congestion)
+        if shifted_energy_profile is None:
+            shift_result = charge_session.shift_flexible_energy_after_congestion_result(flex_window, congestion)
+            self.put(session_key, charge_session, flex_window, congestion, shift_result)
+            shifted_energy_profile = shift_result.energy_profile
+        return shifted_energy_profile
+
+    def statistics(self) -> dict[str, float]:
+        return {'entries': len(self),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'derived_hits': self.derived_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hit_rate}
+
+
 def shift_energy_profile_for_charger(profile_range: IntRangeInBlock,
                                      flex_window: BlockMetadata,
                                      congestion: IntRangeInBlock,
-                                     charge_sessions: list[ChargingSession]) -> EnergyProfile:
+                                     charge_sessions: list[ChargingSession],
+                                     shifted_energy_profiles: Optional[dict[int, EnergyProfile]] = None) -> EnergyProfile:
     """Create the shifted energy profile for a given charger.
 
     :param profile_range: The range in time for which the energy profile should be generated.
     :param congestion: When congestion occurs.
     :param charge_sessions: The charge sessions of the charger which happen during profile_range.
+    :param shifted_energy_profiles: Optional. The shifted energy profiles by index in charge_sessions which were
+        already shifted, e.g. by a shifting strategy. The other charge sessions are shifted here.
     :return: An energy profile where all charge sessions are added to after shifting them according to congestion.
     """
-    result_energy_profile = EnergyProfile(profile_range, [0.0] * profile_range.total_block_duration())
-
-    for charge_session in charge_sessions:
-        shifted_energy_profile = charge_session.shift_flexible_energy_after_congestion(flex_window, congestion)
-        outside_of_result_profile_left, outside_of_result_profile_right = shifted_energy_profile.split_on_int(result_energy_profile.range_in_block)
-
-        outside_ranges = []
-        if outside_of_result_profile_left is not None:
-            outside_ranges.append(outside_of_result_profile_left.range_in_block)
-        if outside_of_result_profile_right is not None:
-            outside_ranges.append(outside_of_result_profile_right.range_in_block)
+    result_energy_profile = EnergyProfileAccumulator(profile_range)
 
-        if outside_ranges:
+    for session_index, charge_session in enumerate(charge_sessions):
+        shifted_energy_profile = shifted_energy_profiles.get(session_index) if shifted_energy_profiles else None
+        if shifted_energy_profile is None:
+            shifted_energy_profile = charge_session.shift_flexible_energy_after_congestion(flex_window, congestion)
+        try:
+            result_energy_profile.add_into(shifted_energy_profile)
+        except RuntimeError as ex:
             raise RuntimeError(f'Charge session {charge_session} shifted energy to '
                                f'{shifted_energy_profile.range_in_block} which was outside of result profile '
-                               f'{result_energy_profile.range_in_block} on ranges {outside_ranges}')
-        result_energy_profile = result_energy_profile.profile_addition(shifted_energy_profile)
+                               f'{result_energy_profile.range_in_block}') from ex
 
-    return result_energy_profile
+    return result_energy_profile.to_energy_profile()
+
+
+def region_changed_by_shifting(session_ranges: list[IntRangeInBlock],
+                               affected_indices: list[int]) -> tuple[IntRangeInBlock, list[int]]:
+    """The steps which may change by shifting the affected sessions and the sessions needed to sum these steps.
+
+    Shifting a session only changes its energy within its own steps. The region starts as the steps of the affected
+    sessions and grows with the steps of any other session overlapping it, so the energy of each step in the region
+    is summed from the sessions overlapping the region alone.
+
+    :param session_ranges: The steps of each session of a charger.
+    :param affected_indices: The indices of the sessions in session_ranges which are shifted. At least one.
+    :return: The region and the indices of the sessions overlapping the region in ascending order.
+    """
+    region = IntRangeInBlock(min(session_ranges[index].start for index in affected_indices),
+                             max(session_ranges[index].end for index in affected_indices))
+    while True:
+        overlapping_indices = [index for index, session_range in enumerate(session_ranges)
+                               if session_range.overlaps(region)]
+        grown_region = IntRangeInBlock(min([region.start] + [session_ranges[index].start for index in overlapping_indices]),
+                                       max([region.end] + [session_ranges[index].end for index in overlapping_indices]))
+        if grown_region == region:
+            return region, overlapping_indices
+        region = grown_region
 
 
 def generate_charging_sessions_from_charger_energy_profile(charge_session_ranges: list[DecimalRangeInBlock],
@@ -91,17 +266,17 @@ def generate_charging_sessions_from_charger_energy_profile(charge_session_ranges
                                f'2: {charge_session_range_2}')
 
     charge_sessions = []
-    result_energy_profile = EnergyProfile(charger_energy_profile.range_in_block,
-                                          [0.0] * charger_energy_profile.range_in_block.total_block_duration())
+    result_energy_profile = EnergyProfileAccumulator(charger_energy_profile.range_in_block)
     for charge_session_range, max_charging_power_watt in zip(charge_session_ranges,
                                                              max_charging_power_watt_per_charging_session):
         charge_session_energy_profile = charger_energy_profile.mask_decimal(charge_session_range)
-        result_energy_profile = result_energy_profile.profile_addition(charge_session_energy_profile)
+        result_energy_profile.add_into(charge_session_energy_profile)
         charge_sessions.append(ChargingSession(charge_session_range,
                                                max_charging_power_watt,
                                                charge_session_energy_profile,
                                                meta_data))
 
+    result_energy_profile = result_energy_profile.to_energy_profile()
     if result_energy_profile != charger_energy_profile:
         raise RuntimeError(f'Resulting energy profile for all charge sessions ({result_energy_profile}) do not equal '
                            f'to the energy profile of the charger ({charger_energy_profile}).')
@@ -109,10 +284,197 @@ def generate_charging_sessions_from_charger_energy_profile(charge_session_ranges
     return charge_sessions
 
 
+@dataclass(slots=True)
+class CachedEnergyProfile:
+    """Energy profile of a charge session cached by the absolute time range of the steps it covers."""
+    start_epoch_ns: int
+    end_epoch_ns: int
+    energy_per_block: list[float]
+    clipped_energy_per_block: list[float]
+
+
+class ActiveSessionSweep:
+    """The positions of the sessions overlapping a window in time which moves forward.
+
+    The session start and end events are sorted once. Moving the window forward only visits the sessions of which
+    the start moved before the window end or the end moved before the window start, instead of checking the overlap of
+    every session again. Moving the window backward restarts the sweep from the first event.
+    """
+    _positions_by_start: numpy.ndarray
+    _sorted_starts_epoch_ns: numpy.ndarray
+    _positions_by_end: numpy.ndarray
+    _sorted_ends_epoch_ns: numpy.ndarray
+    _num_started: int
+    _num_ended: int
+    _active_positions: set[int]
+    _window_start_epoch_ns: Optional[int]
+    _window_end_epoch_ns: Optional[int]
+
+    def __init__(self, session_starts_epoch_ns: numpy.ndarray, session_ends_epoch_ns: numpy.ndarray):
+        self._positions_by_start = numpy.argsort(session_starts_epoch_ns, kind='stable')
+        self._sorted_starts_epoch_ns = session_starts_epoch_ns[self._positions_by_start]
+        self._positions_by_end = numpy.argsort(session_ends_epoch_ns, kind='stable')
+        self._sorted_ends_epoch_ns = session_ends_epoch_ns[self._positions_by_end]
+        self._restart()
+
+    def _restart(self) -> None:
+        self._num_started = 0
+        self._num_ended = 0
+        self._active_positions = set()
+        self._window_start_epoch_ns = None
+        self._window_end_epoch_ns = None
+
+    def move_to(self, window_start_epoch_ns: int, window_end_epoch_ns: int) -> list[int]:
+        """Move the window and return the positions of the sessions which overlap it.
+
+        :param window_start_epoch_ns: The new start of the window in nanoseconds since the unix epoch.
+        :param window_end_epoch_ns: The new end of the window in nanoseconds since the unix epoch.
+        :return: The positions of the sessions overlapping the window in ascending order.
+        """
+        if self._window_start_epoch_ns is not None and (window_start_epoch_ns < self._window_start_epoch_ns or
+                                                        window_end_epoch_ns < self._window_end_epoch_ns):
+            self._restart()
+        self._window_start_epoch_ns = window_start_epoch_ns
+        self._window_end_epoch_ns = window_end_epoch_ns
+
+        num_started = int(numpy.searchsorted(self._sorted_starts_epoch_ns, window_end_epoch_ns, side='left'))
+        self._active_positions.update(self._positions_by_start[self._num_started:num_started].tolist())
+        self._num_started = num_started
+
+        # A session which ended before the window start also started before the window end so it is always entered
+        # before it leaves.
+        num_ended = int(numpy.searchsorted(self._sorted_ends_epoch_ns, window_start_epoch_ns, side='right'))
+        self._active_positions.difference_update(self._positions_by_end[self._num_ended:num_ended].tolist())
+        self._num_ended = num_ended
+
+        return sorted(self._active_positions)
+
+
+class ChargingSessionCache:
+    """Charge sessions of a pc4 which are built once and re-based to the flex window of each scenario.
+
+    Reading the energy profile of a session from the energy profiles, converting it to joules and clipping it to
+    the max charging capacity only depends on the absolute time range of the steps covered by the session. This is
+    done once per session and cached by that time range. Each scenario re-bases the sessions by converting their
+    start and end to the flex window and reusing the cached profile as long as the session covers the same absolute
+    steps, which holds for all flex windows aligned with the same step boundaries.
+
+    Only the first and last step depend on the flex window, as the fraction of those steps covered by the session
+    is recalculated for each flex window, so only they are clipped again per scenario.
+    """
+    df_energy_profiles: pandas.DataFrame
+    ptu_duration: timedelta
+    cached_energy_profiles: dict[int, CachedEnergyProfile]
+
+    def __init__(self,
+                 df_charge_sessions: pandas.DataFrame,
+                 df_energy_profiles: pandas.DataFrame,
+                 ptu_duration: timedelta):
+        self.df_energy_profiles = df_energy_profiles
+        self.ptu_duration = ptu_duration
+        self.cached_energy_profiles = {}
+
+        # Convert the session times to the integer epoch clock once so each flex window only needs an offset.
+        self._profile_times_epoch_ns = to_epoch_ns_array(df_energy_profiles['time'])
+        self._session_starts_epoch_ns = to_epoch_ns_array(df_charge_sessions['start'])
+        self._session_ends_epoch_ns = to_epoch_ns_array(df_charge_sessions['end'])
+        self._session_ids = df_charge_sessions['session_id'].tolist()
+        self._session_max_powers_kw = df_charge_sessions['max_power_kw'].tolist()
+
+    def __len__(self) -> int:
+        return len(self._session_ids)
+
+    def cached_energy_profile(self, session_position: int, start_epoch_ns: int, end_epoch_ns: int) -> CachedEnergyProfile:
+        cached = self.cached_energy_profiles.get(session_position)
+        if cached is None or cached.start_epoch_ns != start_epoch_ns or cached.end_epoch_ns != end_epoch_ns:
+            kwatt_profile_charging_session = self.df_energy_profiles[str(self._session_ids[session_position])].to_numpy()
+            kwatt_profile_charging_session = kwatt_profile_charging_session[(self._profile_times_epoch_ns >= start_epoch_ns) & (self._profile_times_epoch_ns < end_epoch_ns)]
+            energy_per_block = (kwatt_profile_charging_session * 1000 * self.ptu_duration.total_seconds()).tolist()
+
+            # Steps fully covered by the session may charge the max energy per step. The first and last step keep
+            # their energy as they are clipped per flex window.
+            max_charging_energy_per_step_joule = self._session_max_powers_kw[session_position] * 1000 * self.ptu_duration.total_seconds()
+            clipped_energy_per_block = [min(max_charging_energy_per_step_joule, energy) for energy in energy_per_block]
+            if energy_per_block:
+                clipped_energy_per_block[0] = energy_per_block[0]
+                clipped_energy_per_block[-1] = energy_per_block[-1]
+
+            cached = CachedEnergyProfile(start_epoch_ns, end_epoch_ns, energy_per_block, clipped_energy_per_block)
+            self.cached_energy_profiles[session_position] = cached
+        return cached
+
+    def session_starts_in_flex_window_ns(self, flex_window: BlockMetadata) -> list[int]:
+        """The start of each session relative to the start of flex_window in nanoseconds."""
+        return (self._session_starts_epoch_ns - flex_window.start_epoch_ns).tolist()
+
+    def active_session_sweep(self) -> 'ActiveSessionSweep':
+        """A sweep over the sessions of this cache to follow the sessions overlapping a window moving forward."""
+        return ActiveSessionSweep(self._session_starts_epoch_ns, self._session_ends_epoch_ns)
+
+    def charging_sessions(self, flex_window: BlockMetadata) -> list[ChargingSession]:
+        """All charge sessions re-based to flex_window in the order of the sessions given to this cache.
+
+        The sessions are equal to constructing them with ChargingSession(..., fix_energy_profile=True).
+
+        :param flex_window: The flex window to re-base the sessions to.
+        :return: The charge sessions in flex_window.
+        """
+        session_starts_in_block = flex_window.convert_epoch_ns_to_instants_in_block(self._session_starts_epoch_ns).tolist()
+        session_ends_in_block = flex_window.convert_epoch_ns_to_instants_in_block(self._session_ends_epoch_ns).tolist()
+
+        result = []
+        for session_position in range(len(self)):
+            session_dec = DecimalRangeInBlock(session_starts_in_block[session_position],
+                                              session_ends_in_block[session_position])
+            session_int = session_dec.to_range_in_block_int()
+            cached = self.cached_energy_profile(session_position,
+                                                flex_window.block_num_to_epoch_ns(session_int.start),
+                                                flex_window.block_num_to_epoch_ns(session_int.end))
+
+            max_charging_power_watt = self._session_max_powers_kw[session_position] * 1000
+            energy_per_block: Sequence[float] = ValuesView(cached.clipped_energy_per_block,
+                                                           0,
+                                                           len(cached.clipped_energy_per_block))
+            if cached.energy_per_block:
+                max_charging_energy_per_step_joule = max_charging_power_watt * flex_window.step_duration.total_seconds()
+                first_energy = min(ChargingSession.max_charging_energy_at_step(session_dec,
+                                                                               session_int.start,
+                                                                               max_charging_energy_per_step_joule),
+                                   cached.energy_per_block[0])
+                last_energy = min(ChargingSession.max_charging_energy_at_step(session_dec,
+                                                                              session_int.end - 1,
+                                                                              max_charging_energy_per_step_joule),
+                                  cached.energy_per_block[-1])
+                if len(cached.energy_per_block) == 1:
+                    last_energy = first_energy
+                if first_energy != energy_per_block[0] or last_energy != energy_per_block[-1]:
+                    energy_per_block = list(energy_per_block)
+                    energy_per_block[0] = first_energy
+                    energy_per_block[-1] = last_energy
+
+            result.append(ChargingSession.unchecked(session=session_dec,
+                                                    max_charging_power_watt=max_charging_power_watt,
+                                                    energy_to_charge_profile=EnergyProfile(range_in_block=session_int,
+                                                                                           energy_per_block=energy_per_block),
+                                                    meta_data=flex_window))
+        return result
+
+
 @dataclass
 class InputConfig:
-    charge_sessions_path_parquet: Path
     energy_profiles_path_template_parquet: str
+    charge_sessions_path_parquet: Path | None = None
+    session_store_path: Path | None = None
+
+    def read_session_table(self, pc4: int) -> SessionTable:
+        if self.session_store_path:
+            result = SessionTable.read(self.session_store_path, pc4)
+        elif self.charge_sessions_path_parquet:
+            result = SessionTable.from_private_charging_parquet(self.charge_sessions_path_parquet).for_pc4(pc4)
+        else:
+            raise RuntimeError('Either the field "session-store-path" or the field "charge-sessions-path-parquet" '
+                               'must be set in the input table. Currently they are both missing.')
+        return result
 
 
 class OutputFileFormat(Enum):
@@ -154,6 +516,22 @@ class CongestionStartIterateConfig:
     next_congestion_after: timedelta
 
 
+@dataclass
+class InstrumentationConfig:
+    timing_report_path: Path | None = None
+    progress_interval: timedelta = timedelta(seconds=10)
+    memory_profiling: bool = False
+    memory_budget_mb: int | None = None
+    memory_top_allocations: int = 10
+
+    def memory_monitor(self) -> MemoryMonitor | None:
+        if self.memory_profiling or self.memory_budget_mb is not None:
+            return MemoryMonitor(budget_mb=self.memory_budget_mb,
+                                 trace=self.memory_profiling,
+                                 num_top_allocations=self.memory_top_allocations)
+        return None
+
+
 @dataclass
 class Config:
     pc4: int
@@ -165,6 +543,11 @@ class Config:
     ptu_duration: timedelta = timedelta(minutes=15)
     congestion_start_moments: list[datetime] | None = None
     congestion_starts_iterate_until: CongestionStartIterateConfig | None = None
+    instrumentation: InstrumentationConfig | None = None
+    shift_memo_max_entries: int = 100_000
+    shifting_strategy: str = 'immediate-fill'
+    neighbourhood_capacity_kw: float | None = None
+    recurring_congestion: bool = False
 
     def congestion_starts(self) -> list[datetime]:
         if self.congestion_start_moments:
@@ -184,108 +567,485 @@ class Config:
 
 
 def main():
+    timer = StageTimer()
     try:
         config_path = Path(os.environ.get("CONFIG_PATH", "config.toml"))
         print(f"Reading config path at {config_path}")
-        config = Binder(Config).parse_toml(config_path)
+        with timer.stage('config_parse'):
+            config = Binder(Config).parse_toml(config_path)
     except Exception as ex:
         print(f"Error reading configuration file: {ex}")
         sys.exit(1)
+    instrumentation = config.instrumentation or InstrumentationConfig()
+    timer.memory_monitor = instrumentation.memory_monitor()
+
+    exit_code = 0
+    try:
+        calculate_shifted_energy_profiles(config, instrumentation, timer)
+    except MemoryBudgetExceeded as ex:
+        print(f'Stopping the run: {ex}')
+        exit_code = 1
+
+    if instrumentation.timing_report_path:
+        timer.write_report(instrumentation.timing_report_path)
+        print(f'Wrote timing report to {instrumentation.timing_report_path}')
+    if instrumentation.memory_profiling and timer.memory_monitor is not None:
+        print('Top allocation sites:')
+        print('\n'.join(timer.memory_monitor.top_allocations()))
+    if exit_code:
+        sys.exit(exit_code)
+
+
+def translate_energy_profile(energy_profile: EnergyProfile, block_num_offset: int) -> EnergyProfile:
+    """The same energy profile with its steps moved by block_num_offset. The values are shared through a view, so
+    writing to either profile copies its values first."""
+    return EnergyProfile(IntRangeInBlock(energy_profile.range_in_block.start + block_num_offset,
+                                         energy_profile.range_in_block.end + block_num_offset),
+                         energy_profile.values_view(energy_profile.range_in_block))
+
+
+def calculate_recurring_congestion_profiles(config: Config,
+                                            pc4: int,
+                                            df_index: pandas.DatetimeIndex,
+                                            charging_session_cache: ChargingSessionCache,
+                                            household_session_positions: list[tuple[Hashable, Sequence[int]]],
+                                            strategy: ShiftingStrategy,
+                                            instrumentation: InstrumentationConfig,
+                                            timer: StageTimer) -> None:
+    """Apply all congestion starts at once as a recurring congestion and write one file per scenario.
+
+    Each congestion start has its own flex window starting flex_window_start_before_congestion_start_ptu before it.
+    A session is shifted out of the first congestion it overlaps within the flex window of that congestion. The
+    shifted sessions are placed back on the steps of the output profile, which requires the congestion starts to be
+    a multiple of the PTU duration apart so all flex windows share the same steps.
+
+    :param config: The config of the run.
+    :param pc4: The pc4 area of the sessions.
+    :param df_index: The PTUs of the output profile.
+    :param charging_session_cache: The charge sessions of the pc4.
+    :param household_session_positions: The positions of the sessions in charging_session_cache per household.
+    :param strategy: The shifting strategy.
+    :param instrumentation: The instrumentation config.
+    :param timer: The timer to record the stages in.
+    """
+    congestion_starts = sorted(config.congestion_starts())
+    household_ids = [household_id for household_id, _ in household_session_positions]
+    output_range = IntRangeInBlock(0, len(df_index))
+    num_scenarios = len(config.flex_window_durations_ptu) * len(config.congestion_durations_ptu)
+    print(f'Processing {num_scenarios} recurring congestion scenarios of {len(congestion_starts)} congestion starts for '
+          f'pc4 {pc4} with {len(household_session_positions)} households...')
+    progress = ProgressReporter(total=num_scenarios,
+                                unit='scenarios',
+                                interval_seconds=instrumentation.progress_interval.total_seconds())
+    for congestion_start in congestion_starts[1:]:
+        if (congestion_start - congestion_starts[0]) % config.ptu_duration:
+            raise RuntimeError(f'Congestion start {congestion_start} should be a multiple of the PTU duration '
+                               f'({config.ptu_duration}) after the first congestion start {congestion_starts[0]}.')
+
+    for flex_window_duration in config.flex_window_durations_ptu:
+        flex_windows = []
+        for congestion_start in congestion_starts:
+            flex_window_start = congestion_start - timedelta(seconds=config.flex_window_start_before_congestion_start_ptu * config.ptu_duration.total_seconds())
+            flex_window = BlockMetadata(flex_window_start,
+                                        flex_window_start + timedelta(seconds=flex_window_duration * config.ptu_duration.total_seconds()),
+                                        config.ptu_duration)
+            if flex_windows and flex_windows[-1].end_time > flex_window.start_time:
+                raise RuntimeError(f'The flex window starting at {flex_window.start_time} overlaps the flex window of the '
+                                   f'previous congestion start. Recurring congestion requires the flex windows to be '
+                                   f'apart.')
+            flex_windows.append(flex_window)
+
+        # The baseline does not depend on the flex window as all flex windows share the same steps.
+        output_block_num_offset = -flex_windows[0].convert_to_range_in_block_int(config.output.profile_start,
+                                                                                 config.output.profile_end).start
+        with timer.stage('session_construction', pc4):
+            default_energy_profiles = [translate_energy_profile(charge_session.energy_to_charge_profile, output_block_num_offset)
+                                       for charge_session in charging_session_cache.charging_sessions(flex_windows[0])]
+        with timer.stage('baseline', pc4):
+            baseline_energy = numpy.zeros((len(df_index), len(household_ids)))
+            for column, (household_id, session_positions) in enumerate(household_session_positions):
+                timer.check_memory()
+                baseline_accumulator = EnergyProfileAccumulator(output_range)
+                for session_position in session_positions:
+                    baseline_accumulator.add_into(default_energy_profiles[session_position])
+                baseline_energy[:, column] = baseline_accumulator.energy_per_block
+            df_baselines_profiles = pandas.DataFrame(data=baseline_energy / config.ptu_duration.total_seconds(),
+                                                     index=df_index,
+                                                     columns=household_ids)
+
+        for congestion_duration in config.congestion_durations_ptu:
+            first_congestion_start_str = congestion_starts[0].replace(tzinfo=None).isoformat(timespec="minutes").replace(":", "")
+            last_congestion_start_str = congestion_starts[-1].replace(tzinfo=None).isoformat(timespec="minutes").replace(":", "")
+            filename = f'pc4{pc4}_recurring_flexwindowstartbefore{config.flex_window_start_before_congestion_start_ptu}_flexwindowduration{flex_window_duration}_congestionstart{first_congestion_start_str}_until{last_congestion_start_str}_congestionduration{congestion_duration}'
+
+            # Sessions are shifted out of the first congestion they overlap and keep their energy during later ones.
+            shifted_energy_profiles = {}
+            active_session_sweep = charging_session_cache.active_session_sweep()
+            for congestion_start, flex_window in zip(congestion_starts, flex_windows):
+                congestion = flex_window.convert_to_range_in_block_int(congestion_start,
+                                                                       congestion_start + (config.ptu_duration * congestion_duration))
+                if congestion.subtract_int(flex_window.to_range_in_block_int()) != (None, None):
+                    raise RuntimeError(f'Congestion({congestion}) should be fully within flex_window!')
+                with timer.stage('session_construction', pc4, filename):
+                    positions_to_shift = [session_position
+                                          for session_position in active_session_sweep.move_to(flex_window.block_num_to_epoch_ns(congestion.start),
+                                                                                                flex_window.block_num_to_epoch_ns(congestion.end))
+                                          if session_position not in shifted_energy_profiles]
+                    if not positions_to_shift:
+                        continue
+                    charge_sessions = charging_session_cache.charging_sessions(flex_window)
+                with timer.stage('shifting', pc4, filename):
+                    profile_range = flex_window.convert_to_range_in_block_int(config.output.profile_start,
+                                                                              config.output.profile_end)
+                    neighbourhood = None
+                    if config.neighbourhood_capacity_kw is not None:
+                        neighbourhood = NeighbourhoodLoad(EnergyProfile(profile_range, baseline_energy.sum(axis=1).tolist()),
+                                                          config.neighbourhood_capacity_kw * 1000 * config.ptu_duration.total_seconds())
+                    session_batch = SessionBatch([charge_sessions[session_position] for session_position in positions_to_shift],
+                                                 flex_window,
+                                                 congestion,
+                                                 neighbourhood)
+                    shift_results = session_batch.to_shift_results(strategy.shift(session_batch))
+                    for session_position, shift_result in zip(positions_to_shift, shift_results):
+                        shifted_energy_profiles[session_position] = translate_energy_profile(shift_result.energy_profile,
+                                                                                             -profile_range.start)
+
+            with timer.stage('shifting', pc4, filename):
+                shifted_energy = baseline_energy.copy()
+                for column, (household_id, session_positions) in enumerate(household_session_positions):
+                    timer.check_memory()
+                    if not any(session_position in shifted_energy_profiles for session_position in session_positions):
+                        continue
+                    shifted_accumulator = EnergyProfileAccumulator(output_range)
+                    for session_position in session_positions:
+                        shifted_accumulator.add_into(shifted_energy_profiles.get(session_position,
+                                                                                 default_energy_profiles[session_position]))
+                    shifted_energy[:, column] = shifted_accumulator.energy_per_block
+            with timer.stage('dataframe_build', pc4, filename):
+                df_shifted_profiles = pandas.DataFrame(data=shifted_energy / config.ptu_duration.total_seconds(),
+                                                       index=df_index,
+                                                       columns=household_ids)
+            with timer.stage('file_write', pc4, filename):
+                write_df_to_file(config.output.baseline_profiles, filename, df_baselines_profiles)
+                write_df_to_file(config.output.shifted_profiles, filename, df_shifted_profiles)
+            progress.advance()
+
+
+@dataclass
+class HouseholdSessions:
+    """The sessions of each household of a pc4 by their position in the charge sessions of the pc4."""
+    session_positions: list[tuple[Hashable, Sequence[int]]]
+    household_ids: list[Hashable]
+    columns: dict[Hashable, int]
+    positions_per_household: dict[Hashable, Sequence[int]]
+    household_per_session_position: dict[int, Hashable]
 
+    @staticmethod
+    def from_charge_sessions(df_charge_sessions: pandas.DataFrame) -> 'HouseholdSessions':
+        session_positions = list(df_charge_sessions.groupby(by='household_id').indices.items())
+        household_ids = [household_id for household_id, _ in session_positions]
+        return HouseholdSessions(session_positions=session_positions,
+                                 household_ids=household_ids,
+                                 columns={household_id: column for column, household_id in enumerate(household_ids)},
+                                 positions_per_household=dict(session_positions),
+                                 household_per_session_position={session_position: household_id
+                                                                 for household_id, positions in session_positions
+                                                                 for session_position in positions})
+
+
+@dataclass
+class CongestionStartContext:
+    """The charge sessions and the baseline of a congestion start which are shared by all scenarios starting at it.
+
+    The charge sessions and the baseline only depend on the start of the flex window. The charge sessions are placed
+    in the longest flex window. The flex windows are ordered from longest to shortest so the shifted energy profiles
+    of the shorter flex windows can be derived from the longest by the memo.
+    """
+    congestion_start: datetime
+    flex_window_start: datetime
+    flex_windows: list[tuple[int, BlockMetadata]]
+    profile_range: IntRangeInBlock
+    charge_sessions: list[ChargingSession]
+    session_starts_in_flex_window_ns: list[int]
+    # The energy and power per PTU and household.
+    baseline_energy: numpy.ndarray
+    baseline_power: numpy.ndarray
+    df_baseline_profiles: pandas.DataFrame
+
+
+def build_congestion_start_context(config: Config,
+                                   pc4: int,
+                                   congestion_start: datetime,
+                                   df_index: pandas.DatetimeIndex,
+                                   charging_session_cache: ChargingSessionCache,
+                                   households: HouseholdSessions,
+                                   timer: StageTimer) -> CongestionStartContext:
+    """Build the charge sessions and the baseline of a congestion start.
+
+    :param config: The config of the run.
+    :param pc4: The pc4 area of the sessions.
+    :param congestion_start: The congestion start to build the context of.
+    :param df_index: The PTUs of the output profile.
+    :param charging_session_cache: The charge sessions of the pc4.
+    :param households: The sessions of each household of the pc4.
+    :param timer: The timer to record the stages in.
+    :return: The context shared by all scenarios starting at congestion_start.
+    """
+    flex_window_start = congestion_start - timedelta(seconds=config.flex_window_start_before_congestion_start_ptu * config.ptu_duration.total_seconds())
+    flex_windows = [(flex_window_duration,
+                     BlockMetadata(flex_window_start,
+                                   flex_window_start + timedelta(seconds=flex_window_duration * config.ptu_duration.total_seconds()),
+                                   config.ptu_duration))
+                    for flex_window_duration in sorted(config.flex_window_durations_ptu, reverse=True)]
+    _, longest_flex_window = flex_windows[0]
+    profile_range = longest_flex_window.convert_to_range_in_block_int(config.output.profile_start,
+                                                                      config.output.profile_end)
+    with timer.stage('session_construction', pc4):
+        charge_sessions = charging_session_cache.charging_sessions(longest_flex_window)
+        session_starts_in_flex_window_ns = charging_session_cache.session_starts_in_flex_window_ns(longest_flex_window)
+    with timer.stage('baseline', pc4):
+        baseline_energy = numpy.zeros((len(df_index), len(households.household_ids)))
+        for household_id, session_positions in households.session_positions:
+            timer.check_memory()
+            baseline_accumulator = EnergyProfileAccumulator(profile_range)
+            for session_position in session_positions:
+                baseline_accumulator.add_into(charge_sessions[session_position].energy_to_charge_profile)
+            baseline_energy[:, households.columns[household_id]] = baseline_accumulator.energy_per_block
+        baseline_power = baseline_energy / config.ptu_duration.total_seconds()
+    with timer.stage('dataframe_build', pc4):
+        df_baseline_profiles = pandas.DataFrame(data=baseline_power, index=df_index, columns=households.household_ids)
+    return CongestionStartContext(congestion_start=congestion_start,
+                                  flex_window_start=flex_window_start,
+                                  flex_windows=flex_windows,
+                                  profile_range=profile_range,
+                                  charge_sessions=charge_sessions,
+                                  session_starts_in_flex_window_ns=session_starts_in_flex_window_ns,
+                                  baseline_energy=baseline_energy,
+                                  baseline_power=baseline_power,
+                                  df_baseline_profiles=df_baseline_profiles)
+
+
+def shift_affected_sessions(config: Config,
+                            context: CongestionStartContext,
+                            flex_window: BlockMetadata,
+                            congestion: IntRangeInBlock,
+                            affected_session_positions: list[int],
+                            strategy: ShiftingStrategy,
+                            shifted_energy_profile_memo: ShiftedEnergyProfileMemo) -> dict[int, EnergyProfile]:
+    """Shift the sessions overlapping the congestion. The sessions which are not in the memo are shifted in a single
+    batch.
+
+    :return: The shifted energy profile per session position.
+    """
+    result = {}
+    positions_to_shift = []
+    for session_position in affected_session_positions:
+        if not strategy.shifts_sessions_independently:
+            positions_to_shift.append(session_position)
+            continue
+        shifted_energy_profile = shifted_energy_profile_memo.get((session_position, context.session_starts_in_flex_window_ns[session_position]),
+                                                                 context.charge_sessions[session_position],
+                                                                 flex_window,
+                                                                 congestion)
+        if shifted_energy_profile is None:
+            positions_to_shift.append(session_position)
+        else:
+            result[session_position] = shifted_energy_profile
+    if not positions_to_shift:
+        return result
+
+    neighbourhood = None
+    if config.neighbourhood_capacity_kw is not None:
+        neighbourhood = NeighbourhoodLoad(EnergyProfile(context.profile_range, context.baseline_energy.sum(axis=1).tolist()),
+                                          config.neighbourhood_capacity_kw * 1000 * config.ptu_duration.total_seconds())
+    session_batch = SessionBatch([context.charge_sessions[session_position] for session_position in positions_to_shift],
+                                 flex_window,
+                                 congestion,
+                                 neighbourhood)
+    shift_results = session_batch.to_shift_results(strategy.shift(session_batch))
+    for session_position, shift_result in zip(positions_to_shift, shift_results):
+        if strategy.shifts_sessions_independently:
+            shifted_energy_profile_memo.put((session_position, context.session_starts_in_flex_window_ns[session_position]),
+                                            context.charge_sessions[session_position],
+                                            flex_window,
+                                            congestion,
+                                            shift_result)
+        result[session_position] = shift_result.energy_profile
+    return result
+
+
+def shift_and_write_scenario(config: Config,
+                             pc4: int,
+                             df_index: pandas.DatetimeIndex,
+                             households: HouseholdSessions,
+                             context: CongestionStartContext,
+                             flex_window_index: int,
+                             congestion_duration: int,
+                             active_session_sweep: ActiveSessionSweep,
+                             strategy: ShiftingStrategy,
+                             shifted_energy_profile_memo: ShiftedEnergyProfileMemo,
+                             timer: StageTimer) -> None:
+    """Shift the sessions of a single scenario and write its baseline and shifted profiles.
+
+    :param config: The config of the run.
+    :param pc4: The pc4 area of the sessions.
+    :param df_index: The PTUs of the output profile.
+    :param households: The sessions of each household of the pc4.
+    :param context: The charge sessions and the baseline of the congestion start of the scenario.
+    :param flex_window_index: The index of the flex window of the scenario in context.flex_windows.
+    :param congestion_duration: The congestion duration of the scenario in PTUs.
+    :param active_session_sweep: The sweep following the sessions overlapping the congestions of congestion_duration.
+    :param strategy: The shifting strategy.
+    :param shifted_energy_profile_memo: The memo of the shifted energy profiles of the pc4.
+    :param timer: The timer to record the stages in.
+    """
+    flex_window_duration, flex_window = context.flex_windows[flex_window_index]
+    current_congestion_end = context.congestion_start + (config.ptu_duration * congestion_duration)
+    flex_window_start_str = context.flex_window_start.replace(tzinfo=None) \
+                                                     .isoformat(timespec="minutes") \
+                                                     .replace(":", "")
+    congestion_start_str = context.congestion_start.replace(tzinfo=None)\
+                                                   .isoformat(timespec="minutes")\
+                                                   .replace(":", "")
+    filename = f'pc4{pc4}_flexwindowstart{flex_window_start_str}_flexwindowduration{flex_window_duration}_congestionstart{congestion_start_str}_congestionduration{congestion_duration}'
+
+    congestion = flex_window.convert_to_range_in_block_int(context.congestion_start,
+                                                           current_congestion_end)
+
+    if congestion.subtract_int(flex_window.to_range_in_block_int()) != (None, None):
+        raise RuntimeError(f'Congestion({congestion}) should be fully within flex_window!')
+
+    with timer.stage('session_construction', pc4, filename):
+        # Sessions which do not overlap the congestion keep their default energy profile so only households with an
+        # affected session need to be shifted.
+        affected_session_positions = active_session_sweep.move_to(flex_window.block_num_to_epoch_ns(congestion.start),
+                                                                  flex_window.block_num_to_epoch_ns(congestion.end))
+        affected_positions_per_household = {}
+        for session_position in affected_session_positions:
+            affected_positions_per_household.setdefault(households.household_per_session_position[session_position],
+                                                        set()).add(session_position)
+
+    # Shifting only changes the steps of the affected sessions, the other steps are copied from the baseline.
+    df_shifted_profiles = context.df_baseline_profiles
+    if affected_positions_per_household:
+        with timer.stage('shifting', pc4, filename):
+            shifted_energy_profile_per_position = shift_affected_sessions(config,
+                                                                          context,
+                                                                          flex_window,
+                                                                          congestion,
+                                                                          affected_session_positions,
+                                                                          strategy,
+                                                                          shifted_energy_profile_memo)
+        shifted_power = context.baseline_power.copy()
+        for household_id, affected_positions in affected_positions_per_household.items():
+            with timer.stage('shifting', pc4, filename):
+                timer.check_memory()
+                session_positions = households.positions_per_household[household_id]
+                region, region_indices = region_changed_by_shifting(
+                    [context.charge_sessions[session_position].energy_to_charge_profile.range_in_block
+                     for session_position in session_positions],
+                    [index for index, session_position in enumerate(session_positions)
+                     if session_position in affected_positions])
+                region_session_positions = [session_positions[index] for index in region_indices]
+                shifted_energy_profile_region = shift_energy_profile_for_charger(profile_range=region,
+                                                                                 flex_window=flex_window,
+                                                                                 congestion=congestion,
+                                                                                 charge_sessions=[context.charge_sessions[session_position]
+                                                                                                  for session_position in region_session_positions],
+                                                                                 shifted_energy_profiles={index: shifted_energy_profile_per_position[session_position]
+                                                                                                          for index, session_position in enumerate(region_session_positions)
+                                                                                                          if session_position in affected_positions})
+                shifted_power[region.start - context.profile_range.start:region.end - context.profile_range.start,
+                              households.columns[household_id]] = \
+                    numpy.array(shifted_energy_profile_region.value_per_block) / config.ptu_duration.total_seconds()
+        with timer.stage('dataframe_build', pc4, filename):
+            df_shifted_profiles = pandas.DataFrame(data=shifted_power, index=df_index, columns=households.household_ids)
+
+    with timer.stage('file_write', pc4, filename):
+        write_df_to_file(config.output.baseline_profiles, filename, context.df_baseline_profiles)
+        write_df_to_file(config.output.shifted_profiles, filename, df_shifted_profiles)
+
+
+def calculate_shifted_energy_profiles(config: Config,
+                                      instrumentation: InstrumentationConfig,
+                                      timer: StageTimer) -> None:
     df_index = pandas.date_range(config.output.profile_start.replace(tzinfo=None),
                                  config.output.profile_end.replace(tzinfo=None),
                                  freq=config.ptu_duration,
                                  inclusive='left')
 
+    strategy = shifting_strategy(config.shifting_strategy)
+    if not strategy.shifts_sessions_independently and config.neighbourhood_capacity_kw is None:
+        raise RuntimeError(f'The {config.shifting_strategy} shifting strategy requires the field '
+                           f'"neighbourhood-capacity-kw" to be set.')
+    print(f'Shifting with the {config.shifting_strategy} strategy.')
+    print(f'Running the shifting kernels with the {kernels.BACKEND} backend.')
+    timer.add_statistics('kernels', {'backend': kernels.BACKEND})
+
     print('Reading in charge sessions...')
-    df_charge_sessions = pandas.read_parquet(config.input.charge_sessions_path_parquet)
+    with timer.stage('session_read'):
+        df_charge_sessions = config.input.read_session_table(config.pc4).df
     print('Read in charge sessions!')
 
-    df_charge_sessions = df_charge_sessions[(df_charge_sessions['pc4'] == config.pc4)]
     congestion_starts = config.congestion_starts()
 
     for (pc4,), df_charge_sessions_pc4_group in df_charge_sessions.groupby(by=['pc4']):
         print(f'Reading in energy profiles for pc4 area {pc4}...')
-        df_energy_profiles_for_pc4 = pandas.read_parquet(config.input.energy_profiles_path_template_parquet.replace('{pc4}', str(pc4)))
-        df_energy_profiles_for_pc4['time'] = df_energy_profiles_for_pc4['time'].dt.tz_localize(pytz.utc)
+        with timer.stage('profile_read', pc4):
+            df_energy_profiles_for_pc4 = pandas.read_parquet(config.input.energy_profiles_path_template_parquet.replace('{pc4}', str(pc4)))
+            df_energy_profiles_for_pc4['time'] = df_energy_profiles_for_pc4['time'].dt.tz_localize(pytz.utc)
         print(f'Read in energy profiles!')
 
-        pc4_charge_sessions_grouped_by_household = df_charge_sessions_pc4_group.groupby(by=['household_id'])
-        for flex_window_duration in config.flex_window_durations_ptu:
-            for congestion_duration in config.congestion_durations_ptu:
-                for congestion_start in congestion_starts:
-                    current_congestion_end = congestion_start + (config.ptu_duration * congestion_duration)
-                    flex_window_start = congestion_start - timedelta(seconds=config.flex_window_start_before_congestion_start_ptu * config.ptu_duration.total_seconds())
-                    flex_window_end = flex_window_start + timedelta(seconds=flex_window_duration * config.ptu_duration.total_seconds())
-                    flex_window = BlockMetadata(flex_window_start,
-                                                flex_window_end,
-                                                config.ptu_duration)
-                    print(f'Processing pc4: {pc4} flexwindow_start: {flex_window_start} flexwindow_end: {flex_window_end} (duration: {flex_window_duration}) congestion_start: {congestion_start}, congestion_end: {current_congestion_end} (duration: {congestion_duration}) for {len(pc4_charge_sessions_grouped_by_household)} households')
-
-                    congestion = flex_window.convert_to_range_in_block_int(congestion_start,
-                                                                           current_congestion_end)
-
-                    if congestion.subtract_int(flex_window.to_range_in_block_int()) != (None, None):
-                        raise RuntimeError(f'Congestion({congestion}) should be fully within flex_window!')
-
-                    zero_energy_profile_range = flex_window.convert_to_range_in_block_int(config.output.profile_start,
-                                                                                          config.output.profile_end)
-                    zero_energy_profile = EnergyProfile(zero_energy_profile_range,
-                                                        [0.0] * zero_energy_profile_range.total_block_duration())
-                    df_shifted_profiles_data = {}
-                    df_baselines_profiles_data = {}
-                    for (household_id,), df_charge_sessions_household_group in pc4_charge_sessions_grouped_by_household:
-                        charge_sessions_on_charger = []
-                        for _, df_charge_session in df_charge_sessions_household_group.iterrows():
-                            session_start = df_charge_session['startTime'].replace(tzinfo=pytz.utc)
-                            session_end = df_charge_session['plugOutTime'].replace(tzinfo=pytz.utc)
-
-                            kwatt_profile_series_charging_session: pandas.Series = df_energy_profiles_for_pc4[str(df_charge_session['session_id'])]
-                            kwatt_profile_series_charging_session.index = df_energy_profiles_for_pc4['time']
-                            session_dec = flex_window.convert_to_range_in_block_decimal(session_start,
-                                                                                           session_end)
-                            session_int = session_dec.to_range_in_block_int()
-                            normalized_session_start, normalized_session_end = flex_window.from_int_block(session_int)
-                            kwatt_profile_series_charging_session = kwatt_profile_series_charging_session[(kwatt_profile_series_charging_session.index >= normalized_session_start) & (kwatt_profile_series_charging_session.index < normalized_session_end)]
-
-                            energy_profile_series_charging_session = kwatt_profile_series_charging_session * 1000 * config.ptu_duration.total_seconds()
-                            charge_session = ChargingSession(session=session_dec,
-                                                             max_charging_power_watt=df_charge_session['maxChargePower_kW'] * 1000,
-                                                             energy_to_charge_profile=EnergyProfile(range_in_block=session_int,
-                                                                                                    energy_per_block=energy_profile_series_charging_session.values.tolist()),
-                                                             meta_data=flex_window,
-                                                             fix_energy_profile=True)
-                            charge_sessions_on_charger.append(charge_session)
-
-                        shifted_energy_profile_household = shift_energy_profile_for_charger(profile_range=zero_energy_profile.range_in_block,
-                                                                                            flex_window=flex_window,
-                                                                                            congestion=congestion,
-                                                                                            charge_sessions=charge_sessions_on_charger)
-
-                        shifted_profile_household_series = pandas.Series(data=shifted_energy_profile_household.value_per_block,
-                                                                         index=df_index)
-                        watt_shifted_profile_household_series = shifted_profile_household_series / config.ptu_duration.total_seconds()
-                        df_shifted_profiles_data[household_id] = watt_shifted_profile_household_series
-
-                        baseline_energy_profile = reduce(lambda baseline, cs: baseline.profile_addition(cs.energy_to_charge_profile),
-                                                         charge_sessions_on_charger,
-                                                         zero_energy_profile)
-                        baseline_profile_household_series = pandas.Series(data=baseline_energy_profile.value_per_block,
-                                                                          index=df_index)
-                        watt_baseline_profile_household_series = baseline_profile_household_series / config.ptu_duration.total_seconds()
-                        df_baselines_profiles_data[household_id] = watt_baseline_profile_household_series
-
-                    df_baseline_profiles = pandas.DataFrame(data=df_baselines_profiles_data, index=df_index)
-                    df_shifted_profiles = pandas.DataFrame(data=df_shifted_profiles_data, index=df_index)
-                    flex_window_start_str = flex_window_start.replace(tzinfo=None) \
-                                                             .isoformat(timespec="minutes") \
-                                                             .replace(":", "")
-                    congestion_start_str = congestion_start.replace(tzinfo=None)\
-                                                           .isoformat(timespec="minutes")\
-                                                           .replace(":", "")
-                    filename = f'pc4{pc4}_flexwindowstart{flex_window_start_str}_flexwindowduration{flex_window_duration}_congestionstart{congestion_start_str}_congestionduration{congestion_duration}'
-                    write_df_to_file(config.output.baseline_profiles, filename, df_baseline_profiles)
-                    write_df_to_file(config.output.shifted_profiles, filename, df_shifted_profiles)
+        charging_session_cache = ChargingSessionCache(df_charge_sessions_pc4_group,
+                                                      df_energy_profiles_for_pc4,
+                                                      config.ptu_duration)
+        households = HouseholdSessions.from_charge_sessions(df_charge_sessions_pc4_group)
+        if config.recurring_congestion:
+            calculate_recurring_congestion_profiles(config,
+                                                    pc4,
+                                                    df_index,
+                                                    charging_session_cache,
+                                                    households.session_positions,
+                                                    strategy,
+                                                    instrumentation,
+                                                    timer)
+            continue
+        shifted_energy_profile_memo = ShiftedEnergyProfileMemo(config.shift_memo_max_entries,
+                                                               derive_shorter_flex_windows=strategy.fills_earliest_steps_first)
+        num_scenarios = len(config.flex_window_durations_ptu) * len(config.congestion_durations_ptu) * len(congestion_starts)
+        print(f'Processing {num_scenarios} scenarios for pc4 {pc4} with {len(households.household_ids)} households...')
+        progress = ProgressReporter(total=num_scenarios,
+                                    unit='scenarios',
+                                    interval_seconds=instrumentation.progress_interval.total_seconds())
+        active_session_sweeps = {congestion_duration: charging_session_cache.active_session_sweep()
+                                 for congestion_duration in config.congestion_durations_ptu}
+        for congestion_start in congestion_starts:
+            context = build_congestion_start_context(config,
+                                                     pc4,
+                                                     congestion_start,
+                                                     df_index,
+                                                     charging_session_cache,
+                                                     households,
+                                                     timer)
+            for flex_window_index in range(len(config.flex_window_durations_ptu)):
+                for congestion_duration in config.congestion_durations_ptu:
+                    shift_and_write_scenario(config,
+                                             pc4,
+                                             df_index,
+                                             households,
+                                             context,
+                                             flex_window_index,
+                                             congestion_duration,
+                                             active_session_sweeps[congestion_duration],
+                                             strategy,
+                                             shifted_energy_profile_memo,
+                                             timer)
+                    progress.advance()
+        memo_statistics = shifted_energy_profile_memo.statistics()
+        timer.add_statistics(f'shift_memo_pc4_{pc4}', memo_statistics)
+        print(f'Shift memo for pc4 {pc4}: {memo_statistics["hits"]} hits, {memo_statistics["derived_hits"]} derived '
+              f'hits, {memo_statistics["misses"]} misses '
+              f'(hit rate {memo_statistics["hit_rate"]:.1%}), {memo_statistics["evictions"]} evictions.')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,336 @@
+import heapq
+import math
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy
+
+from ev_flex_metric import kernels
+from ev_flex_metric.main import BlockMetadata, ChargingSession, EnergyProfile, ShiftResult
+from ev_flex_metric.ranges import IntRangeInBlock
+
+
+@dataclass(slots=True)
+class NeighbourhoodLoad:
+    """The default energy of all sessions in the neighbourhood and the energy it may charge in each step."""
+    default_energy: EnergyProfile
+    capacity_joule_per_step: float
+
+
+@dataclass
+class SessionBatch:
+    """Charge sessions laid out as rows of step arrays to shift them together.
+
+    Column 0 of a row is the first step of the energy profile of the session. Rows are padded with zeros after the
+    last step of the session. The masks select the steps of each session during the congestion and the steps after
+    the congestion within the flex window in which the energy moved out of the congestion may be charged.
+    """
+    session_ranges: list[IntRangeInBlock]
+    default_energy: numpy.ndarray
+    capacity: numpy.ndarray
+    congestion_mask: numpy.ndarray
+    charge_mask: numpy.ndarray
+    non_flexible_energy: numpy.ndarray
+    has_steps_after_congestion: numpy.ndarray
+    neighbourhood: Optional[NeighbourhoodLoad]
+
+    def __init__(self,
+                 charge_sessions: list[ChargingSession],
+                 flex_window: BlockMetadata,
+                 congestion: IntRangeInBlock,
+                 neighbourhood: Optional[NeighbourhoodLoad] = None):
+        self.neighbourhood = neighbourhood
+        self.session_ranges = [charge_session.energy_to_charge_profile.range_in_block for charge_session in charge_sessions]
+        num_steps = max((session_range.total_block_duration() for session_range in self.session_ranges), default=0)
+        flex_window_end = flex_window.to_range_in_block_int().end
+
+        self.default_energy = numpy.zeros((len(charge_sessions), num_steps))
+        self.capacity = numpy.zeros((len(charge_sessions), num_steps))
+        self.congestion_mask = numpy.zeros((len(charge_sessions), num_steps), dtype=bool)
+        self.charge_mask = numpy.zeros((len(charge_sessions), num_steps), dtype=bool)
+        self.non_flexible_energy = numpy.full(len(charge_sessions), numpy.nan)
+        self.has_steps_after_congestion = numpy.zeros(len(charge_sessions), dtype=bool)
+        for row, (charge_session, session_range) in enumerate(zip(charge_sessions, self.session_ranges)):
+            session_num_steps = session_range.total_block_duration()
+            self.default_energy[row, :session_num_steps] = charge_session.energy_to_charge_profile.value_per_block
+            self.capacity[row, :session_num_steps] = [charge_session.can_charge_energy_in_step(step_num)
+                                                      for step_num in session_range.block_nums()]
+            self.congestion_mask[row, max(congestion.start - session_range.start, 0):
+                                      max(congestion.end - session_range.start, 0)] = True
+            self.charge_mask[row, max(congestion.end - session_range.start, 0):
+                                  max(min(session_range.end, flex_window_end) - session_range.start, 0)] = True
+            self.has_steps_after_congestion[row] = session_range.end > congestion.end
+            non_flexible_energy = charge_session.non_flexible_energy_utilizing_after_congestion(flex_window, congestion)
+            if non_flexible_energy is not None:
+                self.non_flexible_energy[row] = non_flexible_energy
+
+    def __len__(self) -> int:
+        return len(self.session_ranges)
+
+    def to_shift_results(self, shifted_energy: numpy.ndarray) -> list[ShiftResult]:
+        """Convert the rows of shifted energy back to a shift result per session.
+
+        :param shifted_energy: The shifted energy of each session laid out in the same way as default_energy.
+        :return: The shifted energy profile, the non flexible energy and the step after the last step in which
+            shifted energy was charged of each session.
+        """
+        changed = self.charge_mask & (shifted_energy != self.default_energy)
+        num_steps = self.default_energy.shape[1]
+        last_changed = num_steps - numpy.argmax(changed[:, ::-1], axis=1)
+        result = []
+        for row, session_range in enumerate(self.session_ranges):
+            non_flexible_energy = self.non_flexible_energy[row]
+            result.append(ShiftResult(EnergyProfile(session_range,
+                                                    shifted_energy[row, :session_range.total_block_duration()].tolist()),
+                                      None if math.isnan(non_flexible_energy) else float(non_flexible_energy),
+                                      session_range.start + int(last_changed[row]) if changed[row].any() else None))
+        return result
+
+
+class ShiftingStrategy(ABC):
+    """Decides how the energy of a batch of charge sessions is shifted out of the congestion.
+
+    New strategies subclass ShiftingStrategy and are registered in SHIFTING_STRATEGIES to select them in the config.
+    """
+    # Whether the strategy charges the moved energy in the earliest steps after the congestion. The result of a
+    # longer flex window may then be reused for a shorter flex window.
+    fills_earliest_steps_first: bool = False
+    # Whether the shifted energy of a session only depends on the session itself. Otherwise all affected sessions of
+    # a scenario are shifted in one batch and the results are not memoized.
+    shifts_sessions_independently: bool = True
+
+    @abstractmethod
+    def shift(self, batch: SessionBatch) -> numpy.ndarray:
+        """Shift the flexible energy of all sessions in batch.
+
+        :param batch: The sessions to shift.
+        :return: The shifted energy of each session laid out in the same way as batch.default_energy.
+        """
+
+
+def keep_non_flexible_energy_evenly_divided(batch: SessionBatch, row: int) -> tuple[list[float], float, float]:
+    """Evenly divide the non flexible energy of a session across its congestion steps as in ChargingSession.
+
+    :param batch: The sessions to shift.
+    :param row: The row of the session in batch. The session must overlap the congestion.
+    :return: The energy of each step of the session with the non flexible energy in the congestion, the energy to
+        move out of the congestion and the default energy during the congestion.
+    """
+    non_flexible_energy = batch.non_flexible_energy[row]
+    session_num_steps = batch.session_ranges[row].total_block_duration()
+    congestion_steps = numpy.flatnonzero(batch.congestion_mask[row, :session_num_steps])
+    congestion_start, congestion_end = int(congestion_steps[0]), int(congestion_steps[-1]) + 1
+    energy_per_step = batch.default_energy[row, :session_num_steps].tolist()
+    non_flexible_energy_per_step = kernels.capped_even_split(energy_per_step[congestion_start:congestion_end],
+                                                             float(non_flexible_energy))
+    non_flexible_energy_total = sum(non_flexible_energy_per_step)
+    if not math.isclose(non_flexible_energy, non_flexible_energy_total, rel_tol=0.01):
+        raise RuntimeError(f'The non flexible energy {non_flexible_energy} does not match the divided energy '
+                           f'{non_flexible_energy_total} during congestion. This should not happen.')
+    default_energy_during_congestion = sum(energy_per_step[congestion_start:congestion_end])
+    energy_per_step[congestion_start:congestion_end] = non_flexible_energy_per_step
+    return energy_per_step, default_energy_during_congestion - non_flexible_energy_total, default_energy_during_congestion
+
+
+def charge_immediately(batch: SessionBatch,
+                       row: int,
+                       energy_per_step: list[float],
+                       energy_to_move: float,
+                       default_energy_during_congestion: float) -> None:
+    """Charge the energy moved out of the congestion as quickly as possible in the charge steps of a session.
+
+    :param batch: The sessions to shift.
+    :param row: The row of the session in batch.
+    :param energy_per_step: The energy of each step of the session. Changed in place.
+    :param energy_to_move: The energy to charge.
+    :param default_energy_during_congestion: The default energy of the session during the congestion.
+    """
+    session_range = batch.session_ranges[row]
+    charge_steps = numpy.flatnonzero(batch.charge_mask[row])
+    if len(charge_steps):
+        energy_left, _ = kernels.immediate_fill(energy_per_step,
+                                                int(charge_steps[0]),
+                                                batch.capacity[row, charge_steps[0]:charge_steps[-1] + 1].tolist(),
+                                                energy_to_move)
+        if energy_left > 0.001:
+            raise RuntimeError(f'Could not fit {energy_left} out of {energy_to_move} after the congestion in '
+                               f'charge session {session_range}')
+    elif batch.has_steps_after_congestion[row] and energy_to_move > 0.001:
+        raise RuntimeError(f'There was energy to move ({energy_to_move}) after the congestion but the flex '
+                           f'window ends before the profile after the congestion of {session_range}')
+    elif not batch.has_steps_after_congestion[row] and energy_to_move > (0.01 * default_energy_during_congestion):
+        raise RuntimeError(f'There was energy to move ({energy_to_move}) after the congestion but there is no '
+                           f'profile after the congestion of {session_range}')
+
+
+class ImmediateFillStrategy(ShiftingStrategy):
+    """Keeps the non flexible energy evenly divided in the congestion and charges the moved energy as quickly as
+    possible after the congestion.
+
+    Gives exactly the same energy as ChargingSession.shift_flexible_energy_after_congestion. The steps depend on each
+    other so each session is shifted with the kernels one after another.
+    """
+    fills_earliest_steps_first = True
+
+    def shift(self, batch: SessionBatch) -> numpy.ndarray:
+        shifted_energy = batch.default_energy.copy()
+        for row, session_range in enumerate(batch.session_ranges):
+            if math.isnan(batch.non_flexible_energy[row]):
+                continue
+            energy_per_step, energy_to_move, default_energy_during_congestion = keep_non_flexible_energy_evenly_divided(batch, row)
+            charge_immediately(batch, row, energy_per_step, energy_to_move, default_energy_during_congestion)
+            shifted_energy[row, :session_range.total_block_duration()] = energy_per_step
+        return shifted_energy
+
+
+def water_fill(capacity: numpy.ndarray, energy: numpy.ndarray) -> numpy.ndarray:
+    """Divide the energy of each row evenly across its steps while not exceeding the capacity of a step.
+
+    Steps which cannot take an even share pass the rest on to the other steps, so every step receives the same
+    level of energy unless its capacity is lower.
+
+    :param capacity: The capacity of each step per row. Steps with a capacity of 0 do not receive energy.
+    :param energy: The energy to divide per row.
+    :return: The divided energy of each step per row. If the energy of a row exceeds its total capacity, every step of
+        the row is filled up to its capacity.
+    """
+    num_rows, num_steps = capacity.shape
+    if num_steps == 0:
+        return numpy.zeros_like(capacity)
+    sorted_capacity = numpy.sort(capacity, axis=1)
+    filled_below = numpy.zeros_like(sorted_capacity)
+    numpy.cumsum(sorted_capacity[:, :-1], axis=1, out=filled_below[:, 1:])
+    # The level if the steps from this step onwards share the energy left after filling the steps below.
+    levels = (energy[:, numpy.newaxis] - filled_below) / numpy.arange(num_steps, 0, -1)
+    fits = levels <= sorted_capacity
+    level = numpy.where(fits.any(axis=1),
+                        levels[numpy.arange(num_rows), numpy.argmax(fits, axis=1)],
+                        numpy.inf)
+    return numpy.minimum(capacity, numpy.maximum(level, 0.0)[:, numpy.newaxis])
+
+
+class SpreadEvenlyStrategy(ShiftingStrategy):
+    """Keeps the non flexible energy evenly divided in the congestion and spreads the moved energy evenly across the
+    remaining steps of the session within the flex window.
+
+    All sessions of a batch are shifted at once with array operations.
+    """
+
+    def shift(self, batch: SessionBatch) -> numpy.ndarray:
+        affected = ~numpy.isnan(batch.non_flexible_energy)
+        default_energy_during_congestion = numpy.where(batch.congestion_mask, batch.default_energy, 0.0)
+        non_flexible_energy_per_step = water_fill(default_energy_during_congestion,
+                                                  numpy.where(affected, batch.non_flexible_energy, 0.0))
+        energy_to_move = default_energy_during_congestion.sum(axis=1) - non_flexible_energy_per_step.sum(axis=1)
+
+        room = numpy.where(batch.charge_mask, numpy.maximum(batch.capacity - batch.default_energy, 0.0), 0.0)
+        moved_energy_per_step = water_fill(room, energy_to_move)
+        energy_left = energy_to_move - moved_energy_per_step.sum(axis=1)
+        if numpy.any(affected & (energy_left > 0.001)):
+            row = int(numpy.argmax(affected & (energy_left > 0.001)))
+            raise RuntimeError(f'Could not fit {energy_left[row]} out of {energy_to_move[row]} after the congestion in '
+                               f'charge session {batch.session_ranges[row]}')
+
+        shifted_energy = numpy.where(batch.congestion_mask,
+                                     non_flexible_energy_per_step,
+                                     batch.default_energy + moved_energy_per_step)
+        return numpy.where(affected[:, numpy.newaxis], shifted_energy, batch.default_energy)
+
+
+class CoordinatedFillStrategy(ShiftingStrategy):
+    """Charges the moved energy of all sessions in the neighbourhood as quickly as possible after the congestion while
+    keeping the neighbourhood within its capacity.
+
+    Each step after the congestion the room left under the capacity of the neighbourhood is given to the sessions
+    which have energy left to charge, the session of which the flex window ends first goes first. A heap keeps the
+    sessions in this order so a scenario takes O(n log n) in the number of session steps. Energy which does not fit
+    under the capacity before the flex window of a session ends is charged as quickly as possible regardless of the
+    capacity, as the session has to charge it. If the capacity is never reached this is the same as immediate-fill.
+    """
+    shifts_sessions_independently = False
+
+    def shift(self, batch: SessionBatch) -> numpy.ndarray:
+        if batch.neighbourhood is None:
+            raise RuntimeError('The coordinated shifting strategy requires the load of the neighbourhood. Set '
+                               'neighbourhood-capacity-kw in the config.')
+        neighbourhood_energy = batch.neighbourhood.default_energy
+        shifted_energy = batch.default_energy.copy()
+
+        energy_per_step_per_row = {}
+        energy_to_move_per_row = {}
+        default_energy_during_congestion_per_row = {}
+        energy_left_per_row = {}
+        # The first and the last charge step of each session, as steps within the block.
+        charge_steps_per_row = []
+        for row, session_range in enumerate(batch.session_ranges):
+            if math.isnan(batch.non_flexible_energy[row]):
+                continue
+            energy_per_step, energy_to_move, default_energy_during_congestion = keep_non_flexible_energy_evenly_divided(batch, row)
+            energy_per_step_per_row[row] = energy_per_step
+            energy_to_move_per_row[row] = energy_to_move
+            default_energy_during_congestion_per_row[row] = default_energy_during_congestion
+            energy_left_per_row[row] = energy_to_move
+            charge_steps = numpy.flatnonzero(batch.charge_mask[row])
+            if len(charge_steps):
+                charge_steps_per_row.append((session_range.start + int(charge_steps[0]),
+                                             session_range.start + int(charge_steps[-1]),
+                                             row))
+        charge_steps_per_row.sort()
+
+        # Earliest deadline first: the heap holds (last charge step, row) of the sessions with energy left to charge.
+        sessions_to_charge = []
+        next_session = 0
+        step_num = charge_steps_per_row[0][0] if charge_steps_per_row else 0
+        while next_session < len(charge_steps_per_row) or sessions_to_charge:
+            if not sessions_to_charge:
+                step_num = max(step_num, charge_steps_per_row[next_session][0])
+            while next_session < len(charge_steps_per_row) and charge_steps_per_row[next_session][0] <= step_num:
+                first_step_num, last_step_num, row = charge_steps_per_row[next_session]
+                heapq.heappush(sessions_to_charge, (last_step_num, row))
+                next_session += 1
+
+            # Sessions of which the last charge step has passed are only dropped once they reach the top of the heap.
+            while sessions_to_charge and sessions_to_charge[0][0] < step_num:
+                heapq.heappop(sessions_to_charge)
+
+            room_in_neighbourhood = batch.neighbourhood.capacity_joule_per_step - neighbourhood_energy.energy_at(step_num)
+            charged_sessions = []
+            while sessions_to_charge and room_in_neighbourhood > 0:
+                last_step_num, row = heapq.heappop(sessions_to_charge)
+                step_index = step_num - batch.session_ranges[row].start
+                energy_per_step = energy_per_step_per_row[row]
+                energy_in_step = energy_per_step[step_index]
+                energy_room = batch.capacity[row, step_index] - energy_in_step
+                will_charge_extra = min(energy_room, energy_left_per_row[row], room_in_neighbourhood)
+                energy_left_per_row[row] -= will_charge_extra
+                energy_per_step[step_index] = energy_in_step + will_charge_extra
+                room_in_neighbourhood -= will_charge_extra
+                if energy_left_per_row[row] > 0 and last_step_num > step_num:
+                    charged_sessions.append((last_step_num, row))
+            for charged_session in charged_sessions:
+                heapq.heappush(sessions_to_charge, charged_session)
+            step_num += 1
+
+        for row, energy_per_step in energy_per_step_per_row.items():
+            charge_immediately(batch,
+                               row,
+                               energy_per_step,
+                               energy_left_per_row[row],
+                               default_energy_during_congestion_per_row[row])
+            shifted_energy[row, :batch.session_ranges[row].total_block_duration()] = energy_per_step
+        return shifted_energy
+
+
+SHIFTING_STRATEGIES: dict[str, ShiftingStrategy] = {
+    'immediate-fill': ImmediateFillStrategy(),
+    'spread-evenly': SpreadEvenlyStrategy(),
+    'coordinated': CoordinatedFillStrategy(),
+}
+
+
+def shifting_strategy(name: str) -> ShiftingStrategy:
+    strategy: Optional[ShiftingStrategy] = SHIFTING_STRATEGIES.get(name.lower())
+    if strategy is None:
+        raise RuntimeError(f'Unknown shifting strategy {name}. Options are {", ".join(SHIFTING_STRATEGIES)}')
+    return strategy
@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+from pathlib import Path
+import unittest
+
+import pandas
+import pytz
+from dataclass_binder import Binder
+
+from ev_flex_metric.flexibility_envelope import FlexibilityEnvelopeConfig, fleet_flexibility_envelope, \
+    sessions_in_window
+from ev_flex_metric.main import BlockMetadata, ChargingSession, EnergyProfile
+from ev_flex_metric.ranges import DecimalRangeInBlock, IntRangeInBlock
+
+
+SAMPLE_CONFIG_PATH = Path(__file__).parent.parent / 'package_files' / 'sample_flexibility_envelope_config.toml'
+
+
+class FlexibilityEnvelopeConfigTest(unittest.TestCase):
+    def test__parse_toml__sample_config(self):
+        # Act
+        config = Binder(FlexibilityEnvelopeConfig).parse_toml(SAMPLE_CONFIG_PATH)
+
+        # Assert
+        self.assertEqual(timedelta(days=1), config.window_end - config.window_start)
+        self.assertEqual(timedelta(minutes=15), config.ptu_duration)
+
+
+class FleetFlexibilityEnvelopeTest(unittest.TestCase):
+    def test__fleet_flexibility_envelope__sums_sessions_within_window(self):
+        # Arrange
+        window = BlockMetadata(datetime(2022, 3, 1, 13), datetime(2022, 3, 1, 14), timedelta(minutes=15))
+        # Can charge 3.6 kWh per 15 minutes / timestep
+        charge_sessions = [ChargingSession(DecimalRangeInBlock(1, 3),
+                                           14_400,
+                                           EnergyProfile(IntRangeInBlock(1, 3), [3_600_000, 3_600_000]),
+                                           window),
+                           ChargingSession(DecimalRangeInBlock(3, 6),
+                                           14_400,
+                                           EnergyProfile(IntRangeInBlock(3, 6), [7_200_000, 0, 0]),
+                                           window)]
+
+        # Act
+        df_envelope = fleet_flexibility_envelope(charge_sessions, window)
+
+        # Assert
+        expected_df_envelope = pandas.DataFrame(data={'lower_cumulative_energy_kwh': [0.0, 0.0, 2.0, 4.0],
+                                                      'baseline_cumulative_energy_kwh': [0.0, 1.0, 2.0, 4.0],
+                                                      'upper_cumulative_energy_kwh': [0.0, 2.0, 2.0, 4.0]},
+                                                index=pandas.date_range(datetime(2022, 3, 1, 13),
+                                                                        periods=4,
+                                                                        freq=timedelta(minutes=15)))
+        pandas.testing.assert_frame_equal(expected_df_envelope, df_envelope)
+
+
+class SessionsInWindowTest(unittest.TestCase):
+    def test__sessions_in_window__overlapping_sessions(self):
+        # Arrange
+        df_charge_sessions = pandas.DataFrame({
+            'session_id': [1, 2, 3, 4, 5],
+            'start': pandas.to_datetime(['2022-03-01 10:00', '2022-03-01 12:00', '2022-03-01 13:30',
+                                         '2022-03-01 13:45', '2022-03-01 14:00'], utc=True),
+            'end': pandas.to_datetime(['2022-03-01 13:00', '2022-03-01 13:15', '2022-03-01 13:45',
+                                       '2022-03-01 16:00', '2022-03-01 15:00'], utc=True)})
+
+        # Act
+        df_in_window = sessions_in_window(df_charge_sessions,
+                                          datetime(2022, 3, 1, 13, tzinfo=pytz.utc),
+                                          datetime(2022, 3, 1, 14, tzinfo=pytz.utc))
+
+        # Assert
+        self.assertEqual(df_in_window['session_id'].tolist(), [2, 3, 4])
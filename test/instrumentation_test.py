@@ -0,0 +1,201 @@
+import csv
+import json
+from pathlib import Path
+import tempfile
+import tracemalloc
+import unittest
+
+from ev_flex_metric.instrumentation import StageTimer, MemoryMonitor, MemoryBudgetExceeded, percentile, \
+    duration_statistics
+
+
+class PercentileTest(unittest.TestCase):
+    def test__percentile__interpolates_between_ranks(self):
+        # Arrange
+        sorted_values = [1.0, 2.0, 3.0, 4.0, 5.0]
+
+        # Act / Assert
+        self.assertEqual(percentile(sorted_values, 0), 1.0)
+        self.assertEqual(percentile(sorted_values, 50), 3.0)
+        self.assertAlmostEqual(percentile(sorted_values, 90), 4.6)
+        self.assertEqual(percentile(sorted_values, 100), 5.0)
+
+    def test__percentile__single_value(self):
+        # Act / Assert
+        self.assertEqual(percentile([2.5], 99), 2.5)
+
+    def test__duration_statistics__correct(self):
+        # Act
+        statistics = duration_statistics([3.0, 1.0, 2.0])
+
+        # Assert
+        self.assertEqual(statistics['count'], 3)
+        self.assertEqual(statistics['total_seconds'], 6.0)
+        self.assertEqual(statistics['mean_seconds'], 2.0)
+        self.assertEqual(statistics['p50_seconds'], 2.0)
+        self.assertEqual(statistics['max_seconds'], 3.0)
+
+
+class StageTimerTest(unittest.TestCase):
+    def test__add__accumulates_same_stage_pc4_and_scenario(self):
+        # Arrange
+        timer = StageTimer()
+
+        # Act
+        timer.add('shifting', 1.0, 1055, 'scenario_1')
+        timer.add('shifting', 2.0, 1055, 'scenario_1')
+        timer.add('shifting', 4.0, 1055, 'scenario_2')
+
+        # Assert
+        self.assertEqual(timer.durations, {('shifting', 1055, 'scenario_1'): 3.0,
+                                           ('shifting', 1055, 'scenario_2'): 4.0})
+
+    def test__stage__records_duration(self):
+        # Arrange
+        timer = StageTimer()
+
+        # Act
+        with timer.stage('config_parse'):
+            pass
+
+        # Assert
+        self.assertIn(('config_parse', None, None), timer.durations)
+        self.assertGreaterEqual(timer.durations[('config_parse', None, None)], 0.0)
+
+    def test__report__aggregated_per_stage_pc4_and_scenario(self):
+        # Arrange
+        timer = StageTimer()
+        timer.add('config_parse', 0.5)
+        timer.add('shifting', 1.0, 1055, 'scenario_1')
+        timer.add('shifting', 3.0, 1055, 'scenario_2')
+        timer.add('shifting', 5.0, 1212, 'scenario_3')
+
+        # Act
+        report = timer.report()
+
+        # Assert
+        self.assertEqual(report['stages']['shifting']['count'], 3)
+        self.assertEqual(report['stages']['shifting']['p50_seconds'], 3.0)
+        self.assertEqual(report['stages']['config_parse']['total_seconds'], 0.5)
+        self.assertEqual(report['per_pc4']['1055']['shifting']['total_seconds'], 4.0)
+        self.assertEqual(report['per_scenario']['scenario_3']['shifting']['total_seconds'], 5.0)
+        self.assertNotIn('config_parse', report['per_pc4']['1055'])
+
+    def test__report__includes_statistics(self):
+        # Arrange
+        timer = StageTimer()
+        timer.add('shifting', 1.0, 1055, 'scenario_1')
+
+        # Act
+        timer.add_statistics('shift_memo_pc4_1055', {'hits': 3, 'misses': 1, 'hit_rate': 0.75})
+
+        # Assert
+        self.assertEqual(timer.report()['statistics'], {'shift_memo_pc4_1055': {'hits': 3, 'misses': 1,
+                                                                                'hit_rate': 0.75}})
+        self.assertNotIn('statistics', StageTimer().report())
+
+    def test__write_report__json_and_csv(self):
+        # Arrange
+        timer = StageTimer()
+        timer.add('shifting', 1.0, 1055, 'scenario_1')
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            json_path = Path(temp_dir) / 'report.json'
+            csv_path = Path(temp_dir) / 'report.csv'
+
+            # Act
+            timer.write_report(json_path)
+            timer.write_report(csv_path)
+
+            # Assert
+            with open(json_path) as open_file:
+                self.assertEqual(json.load(open_file)['stages']['shifting']['count'], 1)
+            with open(csv_path) as open_file:
+                rows = list(csv.DictReader(open_file))
+            self.assertEqual([(row['scope'], row['key'], row['stage']) for row in rows],
+                             [('run', '', 'shifting'), ('pc4', '1055', 'shifting'),
+                              ('scenario', 'scenario_1', 'shifting')])
+
+    def test__write_report__unknown_extension(self):
+        # Act / Assert
+        with self.assertRaises(RuntimeError):
+            StageTimer().write_report(Path('report.txt'))
+
+
+class MemoryMonitorTest(unittest.TestCase):
+    def tearDown(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def test__stage__records_rss_per_stage(self):
+        # Arrange
+        monitor = MemoryMonitor()
+
+        # Act
+        with monitor.stage('profile_read', 1055):
+            pass
+
+        # Assert
+        self.assertGreater(monitor.max_rss_per_stage['profile_read'], 0)
+        self.assertEqual(monitor.peak_rss_stage, ('profile_read', 1055, None))
+
+    def test__stage__budget_exceeded(self):
+        # Arrange
+        monitor = MemoryMonitor(budget_mb=1)
+
+        # Act / Assert
+        with self.assertRaises(MemoryBudgetExceeded) as context:
+            with monitor.stage('shifting', 1055, 'scenario_1'):
+                pass
+        self.assertIn('"shifting"', str(context.exception))
+        self.assertIn('scenario_1', str(context.exception))
+
+    def test__check__budget_exceeded_within_stage(self):
+        # Arrange
+        monitor = MemoryMonitor(budget_mb=1)
+        households_processed = []
+
+        # Act / Assert
+        with self.assertRaises(MemoryBudgetExceeded) as context:
+            with monitor.stage('baseline', 1055):
+                for household in range(3):
+                    monitor.check()
+                    households_processed.append(household)
+        self.assertIn('during stage "baseline"', str(context.exception))
+        self.assertEqual(households_processed, [])
+
+    def test__stage__records_rss_if_stage_raises(self):
+        # Arrange
+        monitor = MemoryMonitor(budget_mb=1)
+
+        # Act / Assert
+        with self.assertRaises(ValueError):
+            with monitor.stage('profile_read', 1055):
+                raise ValueError('Unreadable profile')
+        self.assertGreater(monitor.max_rss_per_stage['profile_read'], 0)
+
+    def test__stage__traces_allocations(self):
+        # Arrange
+        monitor = MemoryMonitor(trace=True, num_top_allocations=3)
+
+        # Act
+        with monitor.stage('baseline'):
+            allocation = [0.0] * 1_000_000
+
+        # Assert
+        self.assertGreaterEqual(monitor.max_traced_peak_per_stage['baseline'], 8_000_000)
+        self.assertEqual(len(monitor.top_allocations()), 3)
+        del allocation
+
+    def test__stage_timer__report_includes_memory(self):
+        # Arrange
+        timer = StageTimer(memory_monitor=MemoryMonitor())
+
+        # Act
+        with timer.stage('shifting', 1055, 'scenario_1'):
+            pass
+        report = timer.report()
+
+        # Assert
+        self.assertIn('shifting', report['memory']['max_rss_mb_per_stage'])
+        self.assertIn(('shifting', 1055, 'scenario_1'), timer.durations)
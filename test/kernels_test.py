@@ -0,0 +1,91 @@
+import random
+import unittest
+from unittest import mock
+
+from ev_flex_metric import kernels
+
+
+def random_kernel_cases(seed: int) -> list[tuple[list[float], float]]:
+    generator = random.Random(seed)
+    return [([generator.choice([0.0, 1.5, 3.0, generator.uniform(0, 5)]) for _ in range(generator.randint(1, 12))],
+             generator.uniform(0, 30))
+            for _ in range(200)]
+
+
+def python_kernels():
+    """Run the kernels as plain Python although they are compiled."""
+    return mock.patch.multiple(kernels,
+                               BACKEND='python',
+                               divide_in_order=kernels.divide_in_order.py_func,
+                               immediate_fill_in_place=kernels.immediate_fill_in_place.py_func)
+
+
+class KernelsTest(unittest.TestCase):
+    def test__capped_even_split__capped_by_default_energy(self):
+        # Act
+        energy_per_step = kernels.capped_even_split([10.0, 2.0, 30.0, 2.0], 40.0)
+
+        # Assert
+        self.assertEqual(energy_per_step, [10.0, 2.0, 26.0, 2.0])
+
+    def test__immediate_fill__fills_from_first_index(self):
+        # Arrange
+        energy_per_step = [5.0, 1.0, 4.0, 0.0, 0.0]
+
+        # Act
+        energy_left, num_steps_charged = kernels.immediate_fill(energy_per_step, 1, [4.0, 4.0, 4.0, 4.0], 4.0)
+
+        # Assert
+        self.assertEqual(energy_per_step, [5.0, 4.0, 4.0, 1.0, 0.0])
+        self.assertEqual(energy_left, 0.0)
+        self.assertEqual(num_steps_charged, 3)
+
+    def test__immediate_fill__energy_left_if_capacity_full(self):
+        # Arrange
+        energy_per_step = [5.0, 1.0, 4.0, 0.0, 0.0]
+
+        # Act
+        energy_left, num_steps_charged = kernels.immediate_fill(energy_per_step, 1, [4.0, 4.0, 4.0, 4.0], 20.0)
+
+        # Assert
+        self.assertEqual(energy_per_step, [5.0, 4.0, 4.0, 4.0, 4.0])
+        self.assertEqual(energy_left, 9.0)
+        self.assertEqual(num_steps_charged, 4)
+
+    def test__backend__known(self):
+        # Act / Assert
+        self.assertIn(kernels.BACKEND, ['numba', 'python'])
+
+
+@unittest.skipIf(kernels.BACKEND != 'numba', 'numba is not installed')
+class CompiledKernelsTest(unittest.TestCase):
+    def test__capped_even_split__same_as_python(self):
+        # Arrange
+        cases = random_kernel_cases(42)
+
+        # Act
+        results = [kernels.capped_even_split(default_energy_per_step, non_flexible_energy)
+                   for default_energy_per_step, non_flexible_energy in cases]
+
+        # Assert
+        with python_kernels():
+            expected = [kernels.capped_even_split(default_energy_per_step, non_flexible_energy)
+                        for default_energy_per_step, non_flexible_energy in cases]
+        self.assertEqual(results, expected)
+
+    def test__immediate_fill__same_as_python(self):
+        # Arrange
+        cases = random_kernel_cases(43)
+        energy_per_step_per_case = [list(default_energy_per_step) for default_energy_per_step, _ in cases]
+        expected_energy_per_step_per_case = [list(default_energy_per_step) for default_energy_per_step, _ in cases]
+
+        # Act
+        results = [kernels.immediate_fill(energy_per_step, 0, [4.0] * len(energy_per_step), energy_joule)
+                   for energy_per_step, (_, energy_joule) in zip(energy_per_step_per_case, cases)]
+
+        # Assert
+        with python_kernels():
+            expected = [kernels.immediate_fill(energy_per_step, 0, [4.0] * len(energy_per_step), energy_joule)
+                        for energy_per_step, (_, energy_joule) in zip(expected_energy_per_step_per_case, cases)]
+        self.assertEqual(results, expected)
+        self.assertEqual(energy_per_step_per_case, expected_energy_per_step_per_case)
@@ -1,11 +1,19 @@
 from datetime import datetime, timedelta
+import math
+import os
+from pathlib import Path
+import tempfile
 import unittest
 
+import openpyxl
+import pandas
 import pytz
 
 from ev_flex_metric import main
-from ev_flex_metric.main import BlockMetadata, ChargingSession, EnergyProfile, EvFlexMetricProfile, \
-    ElaadChargingSession, to_energy_profile_using_default_charge_behaviour, ValuesInBlockProfile
+from ev_flex_metric.main import BlockMetadata, ChargingSession, EnergyProfile, EnergyProfileAccumulator, \
+    EvFlexMetricProfile, ElaadChargingSession, AlbatrosChargingSession, to_energy_profile_using_default_charge_behaviour, ValuesInBlockProfile, \
+    SessionFeatureTable, SlidingSessionWindow
+from ev_flex_metric.progress import WarningCollector
 from ev_flex_metric.ranges import IntRangeInBlock, DecimalRangeInBlock
 
 
@@ -211,6 +219,34 @@ class BlockMetadataTest(unittest.TestCase):
         # Assert
         self.assertFalse(overlaps)
 
+    def test__convert_epoch_ns_to_instants_in_block__same_as_convert_to_instant_in_block(self):
+        # Arrange
+        start_time = datetime(year=2022, month=3, day=1, hour=13, minute=0, second=19, tzinfo=pytz.utc)
+        end_time = datetime(year=2022, month=3, day=1, hour=14, minute=0, second=19, tzinfo=pytz.utc)
+        block_metadata = BlockMetadata(start_time, end_time, timedelta(minutes=15))
+        instants = pandas.Series(pandas.to_datetime(['2022-03-01 12:59:17', '2022-03-01 13:07:00',
+                                                     '2022-03-01 14:31:59'], utc=True))
+
+        # Act
+        instants_in_block = block_metadata.convert_epoch_ns_to_instants_in_block(main.to_epoch_ns_array(instants))
+
+        # Assert
+        expected_instants_in_block = [block_metadata.convert_to_instant_in_block(instant.to_pydatetime())
+                                      for instant in instants]
+        self.assertEqual(instants_in_block.tolist(), expected_instants_in_block)
+
+    def test__block_num_to_epoch_ns__correct(self):
+        # Arrange
+        start_time = datetime(year=2022, month=3, day=1, hour=13, minute=0, second=0, tzinfo=pytz.utc)
+        end_time = datetime(year=2022, month=3, day=1, hour=14, minute=0, second=0, tzinfo=pytz.utc)
+        block_metadata = BlockMetadata(start_time, end_time, timedelta(minutes=15))
+
+        # Act
+        epoch_ns = block_metadata.block_num_to_epoch_ns(3)
+
+        # Assert
+        self.assertEqual(epoch_ns, main.to_epoch_ns(block_metadata.from_instant_in_block(3)))
+
 
 class ValuesInBlockProfileTest(unittest.TestCase):
     def test__normalized_index_for_block_num__happy_path(self):
@@ -407,6 +443,53 @@ class EnergyProfileTest(unittest.TestCase):
         expected_energy = EnergyProfile(IntRangeInBlock(2, 3), [4])
         self.assertEqual(total_energy, expected_energy)
 
+    def test__mask_int__view_shares_values(self):
+        # Arrange
+        energy_profile = EnergyProfile(IntRangeInBlock(1, 4), [3, 4, 5])
+
+        # Act
+        masked_energy = energy_profile.mask_int(IntRangeInBlock(2, 4))
+
+        # Assert
+        self.assertIsInstance(masked_energy.value_per_block, main.ValuesView)
+        self.assertIs(masked_energy.value_per_block.buffer, energy_profile.value_per_block)
+        self.assertEqual(masked_energy.value_per_block, [4, 5])
+        self.assertEqual(masked_energy.energy_at(3), 5)
+
+    def test__writable_values__copy_on_write(self):
+        # Arrange
+        energy_profile = EnergyProfile(IntRangeInBlock(1, 4), [3, 4, 5])
+        masked_energy = energy_profile.mask_int(IntRangeInBlock(2, 4))
+
+        # Act
+        masked_energy.writable_values()[0] = 10
+        energy_profile.writable_values()[2] = 20
+
+        # Assert
+        self.assertEqual(masked_energy.value_per_block, [10, 5])
+        self.assertEqual(masked_energy.total_energy, 15)
+        self.assertEqual(energy_profile.value_per_block, [3, 4, 20])
+        self.assertEqual(energy_profile.total_energy, 27)
+
+    def test__set_energy__correct(self):
+        # Arrange
+        energy_profile = EnergyProfile(IntRangeInBlock(1, 5), [3, 4, 5, 6])
+
+        # Act
+        energy_profile.set_energy(EnergyProfile(IntRangeInBlock(2, 4), [1, 2]))
+
+        # Assert
+        self.assertEqual(energy_profile, EnergyProfile(IntRangeInBlock(1, 5), [3, 1, 2, 6]))
+        self.assertEqual(energy_profile.total_energy, 12)
+
+    def test__set_energy__outside_of_profile(self):
+        # Arrange
+        energy_profile = EnergyProfile(IntRangeInBlock(1, 4), [3, 4, 5])
+
+        # Act / Assert
+        with self.assertRaises(RuntimeError):
+            energy_profile.set_energy(EnergyProfile(IntRangeInBlock(3, 5), [1, 2]))
+
     def test__split_on_int__no_overlap_right(self):
         # Arrange
         energy_profile = EnergyProfile(IntRangeInBlock(2, 5), [3, 4, 5])
@@ -561,6 +644,39 @@ class EnergyProfileTest(unittest.TestCase):
         self.assertEqual(total_energy, expected_energy)
 
 
+class EnergyProfileAccumulatorTest(unittest.TestCase):
+    def test__add_into__overlap(self):
+        # Arrange
+        accumulator = EnergyProfileAccumulator(IntRangeInBlock(0, 6))
+
+        # Act
+        accumulator.add_into(EnergyProfile(IntRangeInBlock(1, 4), [3, 4, 5]))
+        accumulator.add_into(EnergyProfile(IntRangeInBlock(3, 5), [6, 9]))
+
+        # Assert
+        expected_energy = EnergyProfile(IntRangeInBlock(0, 6), [0.0, 3, 4, 11, 9, 0.0])
+        self.assertEqual(accumulator.to_energy_profile(), expected_energy)
+
+    def test__add_into__view(self):
+        # Arrange
+        accumulator = EnergyProfileAccumulator(IntRangeInBlock(0, 3))
+        energy_profile = EnergyProfile(IntRangeInBlock(0, 4), [3, 4, 5, 6])
+
+        # Act
+        accumulator.add_into(energy_profile.mask_int(IntRangeInBlock(1, 3)))
+
+        # Assert
+        self.assertEqual(accumulator.to_energy_profile(), EnergyProfile(IntRangeInBlock(0, 3), [0.0, 4, 5]))
+
+    def test__add_into__outside_of_range(self):
+        # Arrange
+        accumulator = EnergyProfileAccumulator(IntRangeInBlock(2, 6))
+
+        # Act / Assert
+        with self.assertRaises(RuntimeError):
+            accumulator.add_into(EnergyProfile(IntRangeInBlock(1, 4), [3, 4, 5]))
+
+
 class ChargingSessionTest(unittest.TestCase):
     def test__init__session_end_out_of_block(self):
         # Arrange
@@ -1933,6 +2049,33 @@ class ElaadChargingSessionTest(unittest.TestCase):
 
         self.assertEqual(general_charging_session, expected_charge_session)
 
+    def test__to_general_charging_session__default_energy_profile_reused_for_shifted_block(self):
+        # Arrange
+        step_duration = timedelta(minutes=10)
+        block_metadata_1 = BlockMetadata(datetime(year=2022, month=3, day=1, hour=12, minute=0, second=0),
+                                         datetime(year=2022, month=3, day=1, hour=14, minute=0, second=0),
+                                         step_duration)
+        block_metadata_2 = BlockMetadata(datetime(year=2022, month=3, day=1, hour=13, minute=0, second=0),
+                                         datetime(year=2022, month=3, day=1, hour=15, minute=0, second=0),
+                                         step_duration)
+        elaad_session = ElaadChargingSession('1',
+                                             datetime(year=2022, month=3, day=1, hour=12, minute=5, second=0),
+                                             datetime(year=2022, month=3, day=1, hour=14, minute=50, second=0),
+                                             timedelta(hours=1.5),
+                                             18,
+                                             40)
+
+        # Act
+        general_charging_session_1 = elaad_session.to_general_charging_session(block_metadata_1)
+        general_charging_session_2 = elaad_session.to_general_charging_session(block_metadata_2)
+
+        # Assert
+        self.assertEqual(len(elaad_session._default_energy_profiles), 1)
+        self.assertEqual(general_charging_session_1.energy_to_charge_profile,
+                         EnergyProfile(IntRangeInBlock(0, 12), [3_600_000] + [7_200_000] * 8 + [3_600_000, 0, 0]))
+        self.assertEqual(general_charging_session_2.energy_to_charge_profile,
+                         EnergyProfile(IntRangeInBlock(0, 11), [7_200_000] * 3 + [3_600_000] + [0] * 7))
+
     def test__from_line__correct(self):
         # Arrange
         line = '"19","1026840","BU321","BU321-1",2019-03-01 08:30:57,2019-03-01 12:08:04,"eabc4bb019389",3.62,1.75,1.87,4.859,3.64'
@@ -1950,6 +2093,19 @@ class ElaadChargingSessionTest(unittest.TestCase):
         self.assertEqual(elaad_transaction.charged_energy_kwh, 4.859)
         self.assertEqual(elaad_transaction.max_power_kw, 3.64)
 
+    def test__from_line__unparseable_line_collected_as_warnings(self):
+        # Arrange
+        line = '"19","1026840","BU321","BU321-1",2019-03-01 08:30:57,2019-03-01 12:08:04,"eabc4bb019389",3.62,NA,1.87,NA,3.64'
+        warnings = WarningCollector()
+
+        # Act
+        elaad_transaction = ElaadChargingSession.from_line(line, warnings)
+
+        # Assert
+        self.assertIsNone(elaad_transaction)
+        self.assertEqual(warnings.counts, {'Skipped line: charge duration NA': 1,
+                                           'Skipped line: charged energy NA': 1})
+
     def test__from_line__average_power_above_max_charging_power(self):
         # Arrange
         line = '"19","1026840","BU321","BU321-1",2019-03-01 08:30:00,2019-03-01 10:15:00,"eabc4bb019389",3.62,1.75,1.87,5.26,3.0'
@@ -2041,6 +2197,244 @@ class ElaadChargingSessionTest(unittest.TestCase):
         #   3. Perhaps a solution for #2, distribute the non-flexible energy up to the original energy used and as evenly as possible.
 
 
+class AlbatrosChargingSessionTest(unittest.TestCase):
+    HEADERS = ['session_id', 'startTime', 'endTime', 'plugOutTime', 'charge_kWh', 'maxChargePower_kW']
+    ROWS = [[1000001, '2020-06-01 07:20:00', '2020-06-01 09:14:00', '2020-06-01 12:09:00', 20.651, 11],
+            [1000014, '2020-06-01 12:12:00', '2020-06-01 12:54:00', '2020-06-01 12:54:00', 7.7, 11]]
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.temp_dir.name) / 'sessions.xlsx'
+        self.write_workbook(self.ROWS)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_workbook(self, rows):
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        sheet.append(self.HEADERS)
+        for row in rows:
+            sheet.append(row)
+        workbook.save(self.path)
+
+    def test__iter_file__correct(self):
+        # Act
+        transactions = list(AlbatrosChargingSession.iter_file(self.path))
+
+        # Assert
+        expected_transactions = [
+            AlbatrosChargingSession(1000001,
+                                    datetime(year=2020, month=6, day=1, hour=7, minute=20, tzinfo=pytz.utc),
+                                    datetime(year=2020, month=6, day=1, hour=12, minute=9, tzinfo=pytz.utc),
+                                    timedelta(hours=1, minutes=54),
+                                    20.651,
+                                    11),
+            AlbatrosChargingSession(1000014,
+                                    datetime(year=2020, month=6, day=1, hour=12, minute=12, tzinfo=pytz.utc),
+                                    datetime(year=2020, month=6, day=1, hour=12, minute=54, tzinfo=pytz.utc),
+                                    timedelta(minutes=42),
+                                    7.7,
+                                    11)]
+        self.assertEqual(transactions, expected_transactions)
+
+    def test__parse_file__writes_and_uses_sidecar(self):
+        # Arrange
+        parsed_transactions = AlbatrosChargingSession.parse_file(self.path)
+
+        # Act
+        cached_transactions = AlbatrosChargingSession.parse_file(self.path)
+
+        # Assert
+        self.assertTrue(self.path.with_name(self.path.name + main.ALBATROS_SIDECAR_SUFFIX).exists())
+        self.assertEqual(cached_transactions, parsed_transactions)
+
+    def test__parse_file__sidecar_used_when_only_mtime_changed(self):
+        # Arrange
+        parsed_transactions = AlbatrosChargingSession.parse_file(self.path)
+        stat = self.path.stat()
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        sidecar_path = self.path.with_name(self.path.name + main.ALBATROS_SIDECAR_SUFFIX)
+        sidecar_mtime_ns = sidecar_path.stat().st_mtime_ns
+
+        # Act
+        cached_transactions = AlbatrosChargingSession.parse_file(self.path)
+
+        # Assert
+        self.assertEqual(cached_transactions, parsed_transactions)
+        self.assertEqual(sidecar_path.stat().st_mtime_ns, sidecar_mtime_ns)
+
+    def test__parse_file__sidecar_ignored_when_workbook_changed(self):
+        # Arrange
+        AlbatrosChargingSession.parse_file(self.path)
+        self.write_workbook(self.ROWS[:1])
+
+        # Act
+        transactions = AlbatrosChargingSession.parse_file(self.path)
+
+        # Assert
+        self.assertEqual([t.transaction_id for t in transactions], [1000001])
+
+    def test__parse_file__sidecar_in_cache_dir(self):
+        # Arrange
+        sidecar_cache_dir = Path(self.temp_dir.name) / 'cache'
+        parsed_transactions = AlbatrosChargingSession.parse_file(self.path, sidecar_cache_dir=sidecar_cache_dir)
+
+        # Act
+        cached_transactions = AlbatrosChargingSession.parse_file(self.path, sidecar_cache_dir=sidecar_cache_dir)
+
+        # Assert
+        self.assertTrue((sidecar_cache_dir / (self.path.name + main.ALBATROS_SIDECAR_SUFFIX)).exists())
+        self.assertFalse(self.path.with_name(self.path.name + main.ALBATROS_SIDECAR_SUFFIX).exists())
+        self.assertEqual(cached_transactions, parsed_transactions)
+
+    @unittest.skipIf(os.geteuid() == 0, 'root may write to a read-only directory')
+    def test__parse_file__sessions_returned_when_directory_read_only(self):
+        # Arrange
+        os.chmod(self.temp_dir.name, 0o555)
+
+        # Act
+        transactions = AlbatrosChargingSession.parse_file(self.path)
+
+        # Assert
+        self.assertEqual([t.transaction_id for t in transactions], [1000001, 1000014])
+        self.assertFalse(self.path.with_name(self.path.name + main.ALBATROS_SIDECAR_SUFFIX).exists())
+
+    def test__parse_file__sessions_returned_when_sidecar_cannot_be_written(self):
+        # Arrange
+        sidecar_cache_dir = Path(self.temp_dir.name) / 'not_a_directory'
+        sidecar_cache_dir.write_text('')
+
+        # Act
+        transactions = AlbatrosChargingSession.parse_file(self.path, sidecar_cache_dir=sidecar_cache_dir)
+
+        # Assert
+        self.assertEqual([t.transaction_id for t in transactions], [1000001, 1000014])
+
+
+class SlidingSessionWindowTest(unittest.TestCase):
+    def setUp(self):
+        hour = timedelta(hours=1)
+        start = datetime(year=2021, month=6, day=1, hour=0, minute=0, second=0, tzinfo=pytz.utc)
+        self.transactions = [AlbatrosChargingSession(1, start + 5 * hour, start + 9 * hour, 2 * hour, 10.0, 11.0),
+                             AlbatrosChargingSession(2, start + 1 * hour, start + 3 * hour, 1 * hour, 5.0, 11.0),
+                             AlbatrosChargingSession(3, start + 2 * hour, start + 2 * hour, 0 * hour, 0.0, 11.0),
+                             AlbatrosChargingSession(4, start + 0 * hour, start + 12 * hour, 3 * hour, 20.0, 11.0)]
+        self.window_starts = [start + i * hour for i in range(12)]
+
+    def test__move_to__same_as_overlap_check(self):
+        # Arrange
+        window = SlidingSessionWindow(self.transactions)
+
+        for window_start in self.window_starts:
+            window_end = window_start + timedelta(hours=1)
+
+            # Act
+            transactions = window.move_to(window_start, window_end)
+
+            # Assert
+            expected_transactions = [transaction for transaction in self.transactions
+                                     if main.times_ranges_overlap(window_start,
+                                                                  window_end,
+                                                                  transaction.utc_session_start,
+                                                                  transaction.utc_session_stop)]
+            self.assertEqual(transactions, expected_transactions)
+
+    def test__move_to__backwards(self):
+        # Arrange
+        window = SlidingSessionWindow(self.transactions)
+        window.move_to(self.window_starts[2], self.window_starts[3])
+
+        # Act / Assert
+        with self.assertRaises(RuntimeError):
+            window.move_to(self.window_starts[1], self.window_starts[2])
+
+
+class SessionFeatureTableTest(unittest.TestCase):
+    def setUp(self):
+        self.flex_window = BlockMetadata(datetime(2022, 3, 1, 13), datetime(2022, 3, 1, 15), timedelta(minutes=10))
+        # Can charge 24.000.000 joule per 10 minutes / timestep
+        self.charging_sessions = [ChargingSession(DecimalRangeInBlock(1.2, 8.85),
+                                                  40_000,
+                                                  EnergyProfile(IntRangeInBlock(1, 9),
+                                                                [8_000_000, 24_000_000, 24_000_000, 10_000_000, 0, 0, 0, 0]),
+                                                  self.flex_window),
+                                  ChargingSession(DecimalRangeInBlock(3.5, 6.0),
+                                                  10_000,
+                                                  EnergyProfile(IntRangeInBlock(3, 6), [1_500_000, 5_300_000, 6_000_000]),
+                                                  self.flex_window)]
+        self.table = SessionFeatureTable(self.charging_sessions)
+
+    def test__energy_between__same_as_energy_profile(self):
+        # Act
+        energy = self.table.energy_between([0, 0, 1, 1], [2, 0, 4, 6], [4, 12, 6, 8])
+
+        # Assert
+        self.assertEqual(energy.tolist(), [48_000_000, 66_000_000, 11_300_000, 0])
+
+    def test__capacity_between__same_as_can_charge_energy_in_step(self):
+        # Act
+        capacity = self.table.capacity_between([0, 1], [1, 3], [3, 6])
+
+        # Assert
+        self.assertAlmostEqual(capacity[0], 0.8 * 24_000_000 + 24_000_000)
+        self.assertAlmostEqual(capacity[1], 2.5 * 6_000_000)
+
+    def test__cumulative_energy_envelope__charge_as_late_and_as_early_as_possible(self):
+        # Arrange
+        table = SessionFeatureTable(self.charging_sessions[1:])
+
+        # Act
+        lower, default, upper = table.cumulative_energy_envelope(0, 8)
+
+        # Assert
+        self.assertEqual(lower.tolist(), [0, 0, 0, 800_000, 6_800_000, 12_800_000, 12_800_000, 12_800_000])
+        self.assertEqual(default.tolist(), [0, 0, 0, 1_500_000, 6_800_000, 12_800_000, 12_800_000, 12_800_000])
+        self.assertEqual(upper.tolist(), [0, 0, 0, 3_000_000, 9_000_000, 12_800_000, 12_800_000, 12_800_000])
+
+    def test__non_flexible_energy_utilizing_whole_session__same_as_charging_session(self):
+        # Arrange
+        congestions = [IntRangeInBlock(start, end) for start in range(0, 10) for end in range(start + 1, 11)]
+
+        # Act
+        non_flexible_energy = self.table.non_flexible_energy_utilizing_whole_session(
+            [[0], [1]],
+            [[congestion.start for congestion in congestions]],
+            [[congestion.end for congestion in congestions]])
+
+        # Assert
+        for session_index, charging_session in enumerate(self.charging_sessions):
+            for congestion_index, congestion in enumerate(congestions):
+                expected = charging_session.non_flexible_energy_utilizing_whole_session(congestion)
+                actual = non_flexible_energy[session_index, congestion_index]
+                if expected is None:
+                    self.assertTrue(math.isnan(actual))
+                else:
+                    self.assertEqual(actual, expected)
+
+    def test__non_flexible_energy_utilizing_after_congestion__same_as_charging_session(self):
+        # Arrange
+        congestions = [IntRangeInBlock(start, end) for start in range(0, 10) for end in range(start + 1, 11)]
+
+        # Act
+        non_flexible_energy = self.table.non_flexible_energy_utilizing_after_congestion(
+            [[0], [1]],
+            [[congestion.start for congestion in congestions]],
+            [[congestion.end for congestion in congestions]],
+            0,
+            self.flex_window.to_range_in_block_int().end)
+
+        # Assert
+        for session_index, charging_session in enumerate(self.charging_sessions):
+            for congestion_index, congestion in enumerate(congestions):
+                expected = charging_session.non_flexible_energy_utilizing_after_congestion(self.flex_window, congestion)
+                actual = non_flexible_energy[session_index, congestion_index]
+                if expected is None:
+                    self.assertTrue(math.isnan(actual))
+                else:
+                    self.assertAlmostEqual(actual, expected, places=3)
+
+
 class GlobalTest(unittest.TestCase):
     def test__to_energy_profile__correct_within_block(self):
         # Arrange
@@ -2342,3 +2736,43 @@ class GlobalTest(unittest.TestCase):
                                                   -0.6965586419753089]) # (10_800_000 - 18_322_833.333333336) / 10_800_000])
         self.assertEqual(ev_flex_metric_profile, expected_ev_metric)
 
+
+    def test__calculate_ev_flex_metrics__same_as_per_congestion(self):
+        # Arrange
+        start_time = datetime(year=2022, month=3, day=1, hour=13, minute=0, second=0)
+        end_time = datetime(year=2022, month=3, day=1, hour=14, minute=0, second=0)
+        step_duration = timedelta(minutes=10)
+        block_metadata = BlockMetadata(start_time, end_time, step_duration)
+
+        charge_session_1 = ChargingSession(session=DecimalRangeInBlock(1, 5),
+                                           max_charging_power_watt=40_000,
+                                           energy_to_charge_profile=EnergyProfile(IntRangeInBlock(1, 5),
+                                                                                  [6.66 * 3_600_000,
+                                                                                   6.66 * 3_600_000,
+                                                                                   3.335 * 3_600_000,
+                                                                                   0]),
+                                           meta_data=block_metadata)
+        charge_session_2 = ChargingSession(session=DecimalRangeInBlock(0, 3.5),
+                                           max_charging_power_watt=40_000,
+                                           energy_to_charge_profile=EnergyProfile(IntRangeInBlock(0, 4),
+                                                                                  [3.335 * 3_600_000,
+                                                                                   3.335 * 3_600_000,
+                                                                                   0,
+                                                                                   3.33 * 3_600_000]),
+                                           meta_data=block_metadata)
+        charge_sessions = [charge_session_1, charge_session_2]
+        congestions = [IntRangeInBlock(0, 2), IntRangeInBlock(1, 5), IntRangeInBlock(3, 6), IntRangeInBlock(5, 6)]
+
+        # Act
+        ev_flex_metric_profiles = main.calculate_ev_flex_metrics(block_metadata, congestions, charge_sessions)
+
+        # Assert
+        expected_ev_flex_metric_profiles = []
+        for congestion in congestions:
+            sessions_during_congestion = [charge_session for charge_session in charge_sessions
+                                          if charge_session.session.overlaps(congestion)]
+            expected_ev_flex_metric_profiles.append(main.calculate_ev_flex_metric(block_metadata,
+                                                                                  congestion,
+                                                                                  sessions_during_congestion))
+        self.assertEqual(ev_flex_metric_profiles, expected_ev_flex_metric_profiles)
+        self.assertIsNone(ev_flex_metric_profiles[3])
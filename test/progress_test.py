@@ -0,0 +1,99 @@
+from contextlib import redirect_stdout
+import io
+from pathlib import Path
+import tempfile
+import unittest
+
+from ev_flex_metric.progress import ProgressReporter, WarningCollector, format_duration
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class ProgressReporterTest(unittest.TestCase):
+    def test__status__throughput_and_eta(self):
+        # Arrange
+        clock = FakeClock()
+        progress = ProgressReporter(total=10, unit='scenarios', interval_seconds=100, clock=clock)
+        clock.now = 8.0
+        with redirect_stdout(io.StringIO()):
+            progress.advance(4)
+
+        # Act
+        status = progress.status()
+
+        # Assert
+        self.assertEqual(status, 'Processed 4/10 scenarios (0.50 scenarios/s, elapsed 0:00:08, ETA 0:00:12)')
+
+    def test__status__eta_unknown_before_progress(self):
+        # Arrange
+        progress = ProgressReporter(total=10, clock=FakeClock())
+
+        # Act / Assert
+        self.assertEqual(progress.status(), 'Processed 0/10 items (0.00 items/s, elapsed 0:00:00, ETA unknown)')
+
+    def test__advance__only_reports_after_interval_and_at_end(self):
+        # Arrange
+        clock = FakeClock()
+        progress = ProgressReporter(total=4, interval_seconds=10, clock=clock)
+        output = io.StringIO()
+
+        # Act
+        with redirect_stdout(output):
+            clock.now = 5
+            progress.advance()
+            clock.now = 11
+            progress.advance()
+            clock.now = 12
+            progress.advance()
+            clock.now = 13
+            progress.advance()
+
+        # Assert
+        self.assertEqual(output.getvalue().splitlines(),
+                         ['Processed 2/4 items (0.18 items/s, elapsed 0:00:11, ETA 0:00:11)',
+                          'Processed 4/4 items (0.31 items/s, elapsed 0:00:13, ETA 0:00:00)'])
+
+    def test__format_duration__rounds_to_seconds(self):
+        # Act / Assert
+        self.assertEqual(format_duration(3725.6), '1:02:06')
+
+
+class WarningCollectorTest(unittest.TestCase):
+    def test__warn__counts_all_and_caps_samples(self):
+        # Arrange
+        warnings = WarningCollector(max_samples_per_category=2)
+
+        # Act
+        for i in range(5):
+            warnings.warn('category a', f'message {i}')
+        warnings.warn('category b', 'message b')
+
+        # Assert
+        self.assertEqual(warnings.counts, {'category a': 5, 'category b': 1})
+        self.assertEqual(warnings.samples['category a'], ['message 0', 'message 1'])
+        self.assertEqual(warnings.summary(), '5 x category a\n1 x category b')
+
+    def test__summary__no_warnings(self):
+        # Act / Assert
+        self.assertEqual(WarningCollector().summary(), 'No warnings.')
+
+    def test__write_log__correct(self):
+        # Arrange
+        warnings = WarningCollector(max_samples_per_category=1)
+        warnings.warn('category a', 'message 0')
+        warnings.warn('category a', 'message 1')
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir) / 'warnings.log'
+
+            # Act
+            warnings.write_log(path)
+
+            # Assert
+            self.assertEqual(path.read_text(), 'category a: 2 warnings, showing 1\n    message 0\n')
@@ -158,6 +158,36 @@ class RangeInBlockTest(unittest.TestCase):
         # Assert
         self.assertFalse(contained)
 
+    def test__init__end_before_start(self):
+        # Act / Assert
+        with self.assertRaises(RuntimeError):
+            IntRangeInBlock(3, 2)
+
+    def test__unchecked__skips_validation(self):
+        # Act
+        range_1 = DecimalRangeInBlock.unchecked(1.5, 3.0)
+
+        # Assert
+        self.assertIsInstance(range_1, DecimalRangeInBlock)
+        self.assertEqual(range_1, DecimalRangeInBlock(1.5, 3.0))
+
+    def test__slots__no_instance_dict(self):
+        # Act / Assert
+        self.assertFalse(hasattr(IntRangeInBlock(0, 3), '__dict__'))
+        self.assertFalse(hasattr(DecimalRangeInBlock(0.5, 3.0), '__dict__'))
+
+    def test__hash__ranges_with_same_sum_differ(self):
+        # Arrange
+        hashes = {hash(IntRangeInBlock(start, 10 - start)) for start in range(0, 6)}
+
+        # Act / Assert
+        self.assertEqual(len(hashes), 6)
+
+    def test__hash__equal_ranges_equal_hash(self):
+        # Act / Assert
+        self.assertEqual(hash(IntRangeInBlock(1, 3)), hash(DecimalRangeInBlock(1.0, 3.0)))
+        self.assertEqual({IntRangeInBlock(1, 3): 'cached'}[IntRangeInBlock(1, 3)], 'cached')
+
 
 class DecimalRangeInBlockTest(unittest.TestCase):
     def test__intersection_decimal__overlap(self):
@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+from pathlib import Path
+import tempfile
+import unittest
+
+import pandas
+import pytz
+
+from ev_flex_metric.main import AlbatrosChargingSession
+from ev_flex_metric.session_store import SessionTable, SessionSourceType
+
+
+class SessionTableTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.temp_path = Path(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_private_charging_parquet(self) -> Path:
+        path = self.temp_path / 'sessions.parquet'
+        pandas.DataFrame({'session_id': [3, 1, 2],
+                          'car_id': [10, 11, 12],
+                          'household_id': [200, 100, 100],
+                          'startTime': pandas.to_datetime(['2020-06-01 07:00', '2020-06-02 08:00', '2020-06-01 09:00']),
+                          'endTime': pandas.to_datetime(['2020-06-01 08:00', '2020-06-02 09:00', '2020-06-01 10:00']),
+                          'plugOutTime': pandas.to_datetime(['2020-06-01 09:00', '2020-06-02 09:30', '2020-06-01 10:00']),
+                          'charge_kWh': [5.0, 6.0, 7.0],
+                          'maxChargePower_kW': [11, 11, 22],
+                          'pc4': [1055, 1055, 1212]}).to_parquet(path)
+        return path
+
+    def test__from_private_charging_parquet__normalized_and_sorted(self):
+        # Arrange
+        path = self.write_private_charging_parquet()
+
+        # Act
+        table = SessionTable.from_private_charging_parquet(path)
+
+        # Assert
+        self.assertEqual(table.df['session_id'].tolist(), [1, 3, 2])
+        self.assertEqual(table.df['start'].dt.tz, pytz.utc)
+        self.assertEqual(table.df['start'].iloc[0], pandas.Timestamp('2020-06-02 08:00', tz=pytz.utc))
+        self.assertEqual(table.df['end'].iloc[0], pandas.Timestamp('2020-06-02 09:30', tz=pytz.utc))
+        self.assertEqual(table.df['charge_end'].iloc[0], pandas.Timestamp('2020-06-02 09:00', tz=pytz.utc))
+        self.assertEqual(table.df['max_power_kw'].dtype, 'float64')
+
+    def test__write_read__roundtrip_for_pc4(self):
+        # Arrange
+        table = SessionTable.from_private_charging_parquet(self.write_private_charging_parquet())
+        store_path = self.temp_path / 'store' / 'sessions.parquet'
+
+        # Act
+        table.write(store_path)
+        read_table = SessionTable.read(store_path, pc4=1055)
+
+        # Assert
+        pandas.testing.assert_frame_equal(read_table.df, table.for_pc4(1055).df)
+        self.assertEqual(len(read_table), 2)
+
+    def test__to_albatros_charging_sessions__correct(self):
+        # Arrange
+        table = SessionTable.from_private_charging_parquet(self.write_private_charging_parquet()).for_pc4(1212)
+
+        # Act
+        sessions = table.to_albatros_charging_sessions()
+
+        # Assert
+        expected_session = AlbatrosChargingSession(2,
+                                                   datetime(year=2020, month=6, day=1, hour=9, tzinfo=pytz.utc),
+                                                   datetime(year=2020, month=6, day=1, hour=10, tzinfo=pytz.utc),
+                                                   timedelta(hours=1),
+                                                   7.0,
+                                                   22.0)
+        self.assertEqual(sessions, [expected_session])
+
+    def test__from_source__pc4_required_for_source_without_pc4(self):
+        # Act / Assert
+        with self.assertRaises(RuntimeError):
+            SessionTable.from_source(SessionSourceType.ELAAD_CSV, self.temp_path / 'transactions.csv')
+
+    def test__init__missing_columns(self):
+        # Act / Assert
+        with self.assertRaises(RuntimeError):
+            SessionTable(pandas.DataFrame({'pc4': [1055]}))
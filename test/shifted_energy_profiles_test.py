@@ -0,0 +1,441 @@
+from dataclasses import replace
+from datetime import datetime, timedelta
+from pathlib import Path
+import tempfile
+import unittest
+
+import pandas
+import pytz
+from dataclass_binder import Binder
+
+from ev_flex_metric.instrumentation import MemoryBudgetExceeded, MemoryMonitor, StageTimer
+from ev_flex_metric.main import BlockMetadata, ChargingSession, EnergyProfile, to_epoch_ns
+from ev_flex_metric.ranges import DecimalRangeInBlock, IntRangeInBlock
+from ev_flex_metric.session_store import SessionTable
+from ev_flex_metric.shifted_energy_profiles import ChargingSessionCache, Config, InputConfig, InstrumentationConfig, \
+    OutputConfig, OutputProfilesConfig, ShiftedEnergyProfileMemo, calculate_shifted_energy_profiles, \
+    region_changed_by_shifting, translate_energy_profile
+
+
+PTU_DURATION = timedelta(minutes=15)
+SAMPLE_CONFIG_PATH = Path(__file__).parent.parent / 'package_files' / 'sample_config.toml'
+
+
+def charge_sessions_test_data() -> tuple[pandas.DataFrame, pandas.DataFrame]:
+    df_charge_sessions = pandas.DataFrame({
+        'session_id': [1, 2],
+        'start': pandas.to_datetime(['2020-06-01 10:05', '2020-06-01 12:00'], utc=True),
+        'end': pandas.to_datetime(['2020-06-01 11:10', '2020-06-01 12:10'], utc=True),
+        'max_power_kw': [11.0, 3.0],
+    })
+    # Session 2 charges above its max power during its partial step so its energy is clipped.
+    df_energy_profiles = pandas.DataFrame({
+        'time': pandas.date_range('2020-06-01 08:00', '2020-06-01 14:00', freq='15min', inclusive='left', tz=pytz.utc),
+        '1': [0.0] * 8 + [11.0, 11.0, 11.0, 11.0, 11.0] + [0.0] * 11,
+        '2': [0.0] * 16 + [3.0] + [0.0] * 7,
+    })
+    return df_charge_sessions, df_energy_profiles
+
+
+def write_households_test_data(directory: Path, pc4: int) -> InputConfig:
+    """Write the sessions of three households charging each evening of 2020-06-01 and 2020-06-02.
+
+    :return: The input config to read the written sessions and energy profiles.
+    """
+    # The session id, household id, day, start, end, max power in kW and the number of PTUs charging at max power.
+    sessions = [(1, 1, 1, '12:10', '13:40', 3.7, 5),
+                (2, 1, 1, '16:40', '21:00', 11.0, 8),
+                (3, 2, 1, '17:20', '23:10', 7.4, 10),
+                (4, 3, 1, '18:05', '06:00', 3.7, 12),
+                (5, 1, 2, '16:50', '20:20', 11.0, 7),
+                (6, 2, 2, '17:05', '22:00', 7.4, 9),
+                (7, 3, 2, '18:30', '07:15', 3.7, 14)]
+    profile_times = pandas.date_range('2020-06-01 00:00', '2020-06-03 12:00', freq=PTU_DURATION, inclusive='left')
+    df_energy_profiles = pandas.DataFrame({'time': profile_times})
+    rows = []
+    for session_id, household_id, day, start, end, max_power_kw, num_charging_ptus in sessions:
+        session_start = pandas.Timestamp(f'2020-06-0{day} {start}')
+        session_end = pandas.Timestamp(f'2020-06-0{day} {end}')
+        if session_end < session_start:
+            session_end += pandas.Timedelta(days=1)
+        first_ptu = profile_times.get_loc(session_start.floor(PTU_DURATION))
+        kwatt = [0.0] * len(profile_times)
+        kwatt[first_ptu:first_ptu + num_charging_ptus] = [max_power_kw] * num_charging_ptus
+        df_energy_profiles[str(session_id)] = kwatt
+        rows.append({'pc4': pc4,
+                     'household_id': household_id,
+                     'session_id': session_id,
+                     'start': session_start.tz_localize(pytz.utc),
+                     'end': session_end.tz_localize(pytz.utc),
+                     'charge_end': (session_start.floor(PTU_DURATION) + num_charging_ptus * PTU_DURATION).tz_localize(pytz.utc),
+                     'charged_energy_kwh': max_power_kw * num_charging_ptus / 4,
+                     'max_power_kw': max_power_kw})
+    SessionTable(pandas.DataFrame(rows)).write(directory / 'sessions.parquet')
+    df_energy_profiles.to_parquet(directory / f'profiles_{pc4}.parquet', index=False)
+    return InputConfig(energy_profiles_path_template_parquet=str(directory / 'profiles_{pc4}.parquet'),
+                       session_store_path=directory / 'sessions.parquet')
+
+
+def households_test_config(directory: Path, congestion_starts: list[datetime]) -> Config:
+    pc4 = 1055
+    return Config(pc4=pc4,
+                  congestion_durations_ptu=[4, 8],
+                  flex_window_start_before_congestion_start_ptu=4,
+                  flex_window_durations_ptu=[16, 32],
+                  input=write_households_test_data(directory, pc4),
+                  output=OutputConfig(profile_start=datetime(2020, 6, 1, tzinfo=pytz.utc),
+                                      profile_end=datetime(2020, 6, 3, 12, tzinfo=pytz.utc),
+                                      baseline_profiles=OutputProfilesConfig('csv', directory / 'baselines'),
+                                      shifted_profiles=OutputProfilesConfig('csv', directory / 'shifted')),
+                  ptu_duration=PTU_DURATION,
+                  congestion_start_moments=congestion_starts)
+
+
+def read_output_profiles(output_config: OutputProfilesConfig) -> dict[str, pandas.DataFrame]:
+    return {path.name: pandas.read_csv(path, sep=output_config.csv_seperator, index_col=0)
+            for path in sorted(output_config.output_dir.iterdir())}
+
+
+class CalculateShiftedEnergyProfilesTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.directory = Path(self.temp_dir.name)
+        self.config = households_test_config(self.directory,
+                                             [datetime(2020, 6, 1, 12, tzinfo=pytz.utc),
+                                              datetime(2020, 6, 1, 17, tzinfo=pytz.utc),
+                                              datetime(2020, 6, 1, 18, tzinfo=pytz.utc),
+                                              datetime(2020, 6, 2, 17, tzinfo=pytz.utc)])
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test__calculate_shifted_energy_profiles__moves_energy_within_household(self):
+        # Act
+        calculate_shifted_energy_profiles(self.config, InstrumentationConfig(), StageTimer())
+
+        # Assert
+        baselines = read_output_profiles(self.config.output.baseline_profiles)
+        shifted = read_output_profiles(self.config.output.shifted_profiles)
+        self.assertEqual(list(baselines), list(shifted))
+        self.assertEqual(len(shifted), 2 * 2 * 4)
+        self.assertTrue(any(not shifted[filename].equals(baselines[filename]) for filename in shifted))
+        for filename, df_shifted in shifted.items():
+            pandas.testing.assert_series_equal(baselines[filename].sum(), df_shifted.sum())
+
+    def test__calculate_shifted_energy_profiles__memory_budget_exceeded(self):
+        # Arrange
+        timer = StageTimer(memory_monitor=MemoryMonitor(budget_mb=1))
+
+        # Act / Assert
+        with self.assertRaises(MemoryBudgetExceeded):
+            calculate_shifted_energy_profiles(self.config, InstrumentationConfig(), timer)
+
+
+class RecurringCongestionProfilesTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.directory = Path(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test__calculate_shifted_energy_profiles__sum_of_congestion_starts_on_separate_days(self):
+        # Arrange
+        congestion_starts = [datetime(2020, 6, 1, 17, tzinfo=pytz.utc), datetime(2020, 6, 2, 17, tzinfo=pytz.utc)]
+        config_per_congestion_start = households_test_config(self.directory / 'per_congestion_start', congestion_starts)
+        config_recurring = replace(households_test_config(self.directory / 'recurring', congestion_starts),
+                                   recurring_congestion=True)
+
+        # Act
+        calculate_shifted_energy_profiles(config_per_congestion_start, InstrumentationConfig(), StageTimer())
+        calculate_shifted_energy_profiles(config_recurring, InstrumentationConfig(), StageTimer())
+
+        # Assert
+        baselines = read_output_profiles(config_per_congestion_start.output.baseline_profiles)
+        shifted = read_output_profiles(config_per_congestion_start.output.shifted_profiles)
+        recurring_baselines = read_output_profiles(config_recurring.output.baseline_profiles)
+        recurring_shifted = read_output_profiles(config_recurring.output.shifted_profiles)
+        self.assertEqual(len(recurring_shifted), 2 * 2)
+        for flex_window_duration in config_recurring.flex_window_durations_ptu:
+            for congestion_duration in config_recurring.congestion_durations_ptu:
+                filenames = [f'pc41055_flexwindowstart2020-06-0{day}T1600_flexwindowduration{flex_window_duration}_'
+                             f'congestionstart2020-06-0{day}T1700_congestionduration{congestion_duration}.csv'
+                             for day in [1, 2]]
+                recurring_filename = f'pc41055_recurring_flexwindowstartbefore4_flexwindowduration{flex_window_duration}_' \
+                                     f'congestionstart2020-06-01T1700_until2020-06-02T1700_congestionduration{congestion_duration}.csv'
+                df_baseline = baselines[filenames[0]]
+                df_expected_shifted = df_baseline + sum(shifted[filename] - baselines[filename] for filename in filenames)
+                self.assertFalse(shifted[filenames[1]].equals(baselines[filenames[1]]))
+                pandas.testing.assert_frame_equal(df_baseline, recurring_baselines[recurring_filename])
+                pandas.testing.assert_frame_equal(df_expected_shifted, recurring_shifted[recurring_filename])
+
+    def test__calculate_shifted_energy_profiles__overlapping_flex_windows(self):
+        # Arrange
+        config = replace(households_test_config(self.directory,
+                                                [datetime(2020, 6, 1, 17, tzinfo=pytz.utc),
+                                                 datetime(2020, 6, 1, 21, tzinfo=pytz.utc)]),
+                         recurring_congestion=True)
+
+        # Act / Assert
+        with self.assertRaisesRegex(RuntimeError, 'overlaps the flex window of the previous congestion start'):
+            calculate_shifted_energy_profiles(config, InstrumentationConfig(), StageTimer())
+
+    def test__calculate_shifted_energy_profiles__congestion_starts_not_whole_ptus_apart(self):
+        # Arrange
+        config = replace(households_test_config(self.directory,
+                                                [datetime(2020, 6, 1, 17, tzinfo=pytz.utc),
+                                                 datetime(2020, 6, 2, 17, 5, tzinfo=pytz.utc)]),
+                         recurring_congestion=True)
+
+        # Act / Assert
+        with self.assertRaisesRegex(RuntimeError, 'should be a multiple of the PTU duration'):
+            calculate_shifted_energy_profiles(config, InstrumentationConfig(), StageTimer())
+
+
+class ConfigTest(unittest.TestCase):
+    def test__parse_toml__sample_config(self):
+        # Act
+        config = Binder(Config).parse_toml(SAMPLE_CONFIG_PATH)
+
+        # Assert
+        self.assertEqual(timedelta(seconds=10), config.instrumentation.progress_interval)
+
+
+class RegionChangedByShiftingTest(unittest.TestCase):
+    def test__region_changed_by_shifting__grows_with_overlapping_sessions(self):
+        # Arrange
+        session_ranges = [IntRangeInBlock(0, 2), IntRangeInBlock(3, 6), IntRangeInBlock(5, 8),
+                          IntRangeInBlock(7, 9), IntRangeInBlock(10, 12)]
+
+        # Act
+        region, region_indices = region_changed_by_shifting(session_ranges, [1])
+
+        # Assert
+        self.assertEqual(region, IntRangeInBlock(3, 9))
+        self.assertEqual(region_indices, [1, 2, 3])
+
+    def test__region_changed_by_shifting__spans_all_affected_sessions(self):
+        # Arrange
+        session_ranges = [IntRangeInBlock(0, 2), IntRangeInBlock(3, 6), IntRangeInBlock(10, 12)]
+
+        # Act
+        region, region_indices = region_changed_by_shifting(session_ranges, [0, 2])
+
+        # Assert
+        self.assertEqual(region, IntRangeInBlock(0, 12))
+        self.assertEqual(region_indices, [0, 1, 2])
+
+
+class TranslateEnergyProfileTest(unittest.TestCase):
+    def test__translate_energy_profile__moves_steps(self):
+        # Arrange
+        energy_profile = EnergyProfile(IntRangeInBlock(3, 6), [1.0, 2.0, 3.0])
+
+        # Act
+        translated = translate_energy_profile(energy_profile, -3)
+
+        # Assert
+        self.assertEqual(EnergyProfile(IntRangeInBlock(0, 3), [1.0, 2.0, 3.0]), translated)
+
+    def test__translate_energy_profile__write_copies_values(self):
+        # Arrange
+        energy_profile = EnergyProfile(IntRangeInBlock(3, 6), [1.0, 2.0, 3.0])
+        translated = translate_energy_profile(energy_profile, -3)
+
+        # Act
+        translated.writable_values()[0] = 10.0
+        energy_profile.writable_values()[2] = 30.0
+
+        # Assert
+        self.assertEqual(EnergyProfile(IntRangeInBlock(3, 6), [1.0, 2.0, 30.0]), energy_profile)
+        self.assertEqual(EnergyProfile(IntRangeInBlock(0, 3), [10.0, 2.0, 3.0]), translated)
+
+
+class ChargingSessionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.ptu_duration = PTU_DURATION
+        self.df_charge_sessions, self.df_energy_profiles = charge_sessions_test_data()
+
+    def expected_charging_sessions(self, flex_window: BlockMetadata) -> list[ChargingSession]:
+        result = []
+        for row in self.df_charge_sessions.itertuples():
+            session_dec = flex_window.convert_to_range_in_block_decimal(row.start.to_pydatetime(),
+                                                                        row.end.to_pydatetime())
+            session_int = session_dec.to_range_in_block_int()
+            start, end = flex_window.from_int_block(session_int)
+            kwatt = self.df_energy_profiles[str(row.session_id)][(self.df_energy_profiles['time'] >= start) &
+                                                                 (self.df_energy_profiles['time'] < end)]
+            result.append(ChargingSession(session_dec,
+                                          row.max_power_kw * 1000,
+                                          EnergyProfile(session_int,
+                                                        (kwatt * 1000 * self.ptu_duration.total_seconds()).tolist()),
+                                          flex_window,
+                                          fix_energy_profile=True))
+        return result
+
+    def test__charging_sessions__same_as_constructed(self):
+        # Arrange
+        cache = ChargingSessionCache(self.df_charge_sessions, self.df_energy_profiles, self.ptu_duration)
+        flex_window = BlockMetadata(datetime(2020, 6, 1, 9, tzinfo=pytz.utc),
+                                    datetime(2020, 6, 1, 13, tzinfo=pytz.utc),
+                                    self.ptu_duration)
+
+        # Act
+        charging_sessions = cache.charging_sessions(flex_window)
+
+        # Assert
+        self.assertEqual(charging_sessions, self.expected_charging_sessions(flex_window))
+        self.assertAlmostEqual(charging_sessions[1].energy_to_charge_profile.energy_at(12), 3000 * 600.0, places=3)
+
+    def test__charging_sessions__reused_for_aligned_flex_window(self):
+        # Arrange
+        cache = ChargingSessionCache(self.df_charge_sessions, self.df_energy_profiles, self.ptu_duration)
+        flex_window_1 = BlockMetadata(datetime(2020, 6, 1, 9, tzinfo=pytz.utc),
+                                      datetime(2020, 6, 1, 13, tzinfo=pytz.utc),
+                                      self.ptu_duration)
+        flex_window_2 = BlockMetadata(datetime(2020, 6, 1, 10, 30, tzinfo=pytz.utc),
+                                      datetime(2020, 6, 1, 12, 30, tzinfo=pytz.utc),
+                                      self.ptu_duration)
+        cache.charging_sessions(flex_window_1)
+        cached_energy_profile = cache.cached_energy_profiles[0]
+
+        # Act
+        charging_sessions = cache.charging_sessions(flex_window_2)
+
+        # Assert
+        self.assertIs(cache.cached_energy_profiles[0], cached_energy_profile)
+        self.assertEqual(charging_sessions, self.expected_charging_sessions(flex_window_2))
+
+    def test__charging_sessions__rebuilt_for_unaligned_flex_window(self):
+        # Arrange
+        cache = ChargingSessionCache(self.df_charge_sessions, self.df_energy_profiles, self.ptu_duration)
+        flex_window_1 = BlockMetadata(datetime(2020, 6, 1, 9, tzinfo=pytz.utc),
+                                      datetime(2020, 6, 1, 13, tzinfo=pytz.utc),
+                                      self.ptu_duration)
+        flex_window_2 = BlockMetadata(datetime(2020, 6, 1, 9, 5, tzinfo=pytz.utc),
+                                      datetime(2020, 6, 1, 13, 5, tzinfo=pytz.utc),
+                                      self.ptu_duration)
+        cache.charging_sessions(flex_window_1)
+        cached_energy_profile = cache.cached_energy_profiles[0]
+
+        # Act
+        cache.charging_sessions(flex_window_2)
+
+        # Assert
+        self.assertIsNot(cache.cached_energy_profiles[0], cached_energy_profile)
+
+    def test__active_session_sweep__same_as_overlapping_sessions(self):
+        # Arrange
+        cache = ChargingSessionCache(self.df_charge_sessions, self.df_energy_profiles, self.ptu_duration)
+        sweep = cache.active_session_sweep()
+        window_starts = [datetime(2020, 6, 1, 9, 45, tzinfo=pytz.utc) + timedelta(minutes=15) * i for i in range(12)]
+        window_starts.append(datetime(2020, 6, 1, 10, 45, tzinfo=pytz.utc))
+
+        # Act
+        active_positions = [sweep.move_to(to_epoch_ns(window_start),
+                                          to_epoch_ns(window_start + timedelta(minutes=90)))
+                            for window_start in window_starts]
+
+        # Assert
+        expected = []
+        for window_start in window_starts:
+            window_end = window_start + timedelta(minutes=90)
+            expected.append([position for position, row in enumerate(self.df_charge_sessions.itertuples())
+                             if row.start < window_end and row.end > window_start])
+        self.assertEqual(active_positions, expected)
+        self.assertIn([0, 1], active_positions)
+        self.assertIn([], active_positions)
+
+
+class ShiftedEnergyProfileMemoTest(unittest.TestCase):
+    def setUp(self):
+        df_charge_sessions, df_energy_profiles = charge_sessions_test_data()
+        self.cache = ChargingSessionCache(df_charge_sessions, df_energy_profiles, PTU_DURATION)
+        self.flex_window_short = BlockMetadata(datetime(2020, 6, 1, 9, tzinfo=pytz.utc),
+                                               datetime(2020, 6, 1, 13, tzinfo=pytz.utc),
+                                               PTU_DURATION)
+        self.flex_window_long = BlockMetadata(datetime(2020, 6, 1, 9, tzinfo=pytz.utc),
+                                              datetime(2020, 6, 1, 15, tzinfo=pytz.utc),
+                                              PTU_DURATION)
+        self.congestion = IntRangeInBlock(4, 6)
+
+    def shift_with_memo(self, memo: ShiftedEnergyProfileMemo, flex_window: BlockMetadata, congestion: IntRangeInBlock):
+        charge_session = self.cache.charging_sessions(flex_window)[0]
+        session_key = (0, self.cache.session_starts_in_flex_window_ns(flex_window)[0])
+        return memo.shift_flexible_energy_after_congestion(session_key, charge_session, flex_window, congestion)
+
+    def test__shift_flexible_energy_after_congestion__reused_for_longer_flex_window(self):
+        # Arrange
+        memo = ShiftedEnergyProfileMemo(max_entries=10)
+        shifted_short = self.shift_with_memo(memo, self.flex_window_short, self.congestion)
+
+        # Act
+        shifted_long = self.shift_with_memo(memo, self.flex_window_long, self.congestion)
+
+        # Assert
+        expected = self.cache.charging_sessions(self.flex_window_long)[0] \
+            .shift_flexible_energy_after_congestion(self.flex_window_long, self.congestion)
+        self.assertIs(shifted_long, shifted_short)
+        self.assertEqual(shifted_long, expected)
+        self.assertEqual(memo.statistics(), {'entries': 1, 'max_entries': 10, 'hits': 1, 'derived_hits': 0,
+                                             'misses': 1, 'evictions': 0, 'hit_rate': 0.5})
+
+    def test__shift_flexible_energy_after_congestion__least_recently_used_evicted(self):
+        # Arrange
+        memo = ShiftedEnergyProfileMemo(max_entries=1)
+        self.shift_with_memo(memo, self.flex_window_short, self.congestion)
+        self.shift_with_memo(memo, self.flex_window_short, IntRangeInBlock(5, 6))
+
+        # Act
+        self.shift_with_memo(memo, self.flex_window_short, self.congestion)
+
+        # Assert
+        self.assertEqual(len(memo), 1)
+        self.assertEqual(memo.hits, 0)
+        self.assertEqual(memo.misses, 3)
+        self.assertEqual(memo.evictions, 2)
+
+    def shift_session_in_flex_windows(self, flex_window_ends: list[datetime]) -> tuple[ShiftedEnergyProfileMemo, list[EnergyProfile], list[EnergyProfile]]:
+        memo = ShiftedEnergyProfileMemo(max_entries=10)
+        congestion = IntRangeInBlock(2, 4)
+        memoized_energy_profiles = []
+        expected_energy_profiles = []
+        for flex_window_end in flex_window_ends:
+            flex_window = BlockMetadata(datetime(2022, 3, 1, 13), flex_window_end, timedelta(minutes=10))
+            # Can charge 24.000.000 joule per 10 minutes / timestep
+            charge_session = ChargingSession(DecimalRangeInBlock(1.2, 8.85),
+                                             40_000,
+                                             EnergyProfile(IntRangeInBlock(1, 9),
+                                                           [8_000_000, 24_000_000, 24_000_000, 10_000_000, 0, 0, 0, 0]),
+                                             flex_window)
+            memoized_energy_profiles.append(memo.shift_flexible_energy_after_congestion(0, charge_session, flex_window,
+                                                                                        congestion))
+            expected_energy_profiles.append(charge_session.shift_flexible_energy_after_congestion(flex_window,
+                                                                                                  congestion))
+        return memo, memoized_energy_profiles, expected_energy_profiles
+
+    def test__shift_flexible_energy_after_congestion__derived_for_shorter_flex_window(self):
+        # Arrange
+        flex_window_ends = [datetime(2022, 3, 1, 15), datetime(2022, 3, 1, 14, 10)]
+
+        # Act
+        memo, memoized_energy_profiles, expected_energy_profiles = self.shift_session_in_flex_windows(flex_window_ends)
+
+        # Assert
+        self.assertEqual(memoized_energy_profiles, expected_energy_profiles)
+        self.assertIs(memoized_energy_profiles[1], memoized_energy_profiles[0])
+        self.assertEqual(memo.derived_hits, 1)
+        self.assertEqual(memo.misses, 1)
+
+    def test__shift_flexible_energy_after_congestion__shifted_again_if_shorter_flex_window_ends_before_shifted_energy(self):
+        # Arrange
+        flex_window_ends = [datetime(2022, 3, 1, 15), datetime(2022, 3, 1, 14)]
+
+        # Act
+        memo, memoized_energy_profiles, expected_energy_profiles = self.shift_session_in_flex_windows(flex_window_ends)
+
+        # Assert
+        self.assertEqual(memoized_energy_profiles, expected_energy_profiles)
+        self.assertNotEqual(memoized_energy_profiles[1], memoized_energy_profiles[0])
+        self.assertEqual(memo.derived_hits, 0)
+        self.assertEqual(memo.misses, 2)
@@ -0,0 +1,157 @@
+from datetime import datetime, timedelta
+import unittest
+
+import numpy
+
+from ev_flex_metric.main import BlockMetadata, ChargingSession, EnergyProfile
+from ev_flex_metric.ranges import DecimalRangeInBlock, IntRangeInBlock
+from ev_flex_metric.shifting_strategies import CoordinatedFillStrategy, ImmediateFillStrategy, NeighbourhoodLoad, \
+    SessionBatch, ShiftingStrategy, SpreadEvenlyStrategy, shifting_strategy, water_fill
+
+
+def charging_sessions_test_data() -> tuple[BlockMetadata, list[ChargingSession]]:
+    start_time = datetime(year=2022, month=3, day=1, hour=13, minute=0, second=0)
+    end_time = datetime(year=2022, month=3, day=1, hour=15, minute=0, second=0)
+    flex_window = BlockMetadata(start_time, end_time, timedelta(minutes=10))
+
+    max_charging_power_watt = 40_000  # Can charge 24.000.000 joule per 10 minutes / timestep
+    charge_sessions = [ChargingSession(DecimalRangeInBlock(1.2, 8.85),
+                                       max_charging_power_watt,
+                                       EnergyProfile(IntRangeInBlock(1, 9),
+                                                     [8_000_000, 24_000_000, 24_000_000, 10_000_000, 0, 0, 0, 0]),
+                                       flex_window),
+                       ChargingSession(DecimalRangeInBlock(2.5, 5.5),
+                                       max_charging_power_watt,
+                                       EnergyProfile(IntRangeInBlock(2, 6), [12_000_000, 24_000_000, 24_000_000, 5_000_000]),
+                                       flex_window),
+                       ChargingSession(DecimalRangeInBlock(6.0, 9.0),
+                                       max_charging_power_watt,
+                                       EnergyProfile(IntRangeInBlock(6, 9), [24_000_000, 1_000_000, 0]),
+                                       flex_window)]
+    return flex_window, charge_sessions
+
+
+class ImmediateFillStrategyTest(unittest.TestCase):
+    def test__shift__same_as_charging_session(self):
+        # Arrange
+        flex_window, charge_sessions = charging_sessions_test_data()
+        congestion = IntRangeInBlock(3, 5)
+        session_batch = SessionBatch(charge_sessions, flex_window, congestion)
+
+        # Act
+        shift_results = session_batch.to_shift_results(ImmediateFillStrategy().shift(session_batch))
+
+        # Assert
+        expected_shift_results = [charge_session.shift_flexible_energy_after_congestion_result(flex_window, congestion)
+                                  for charge_session in charge_sessions]
+        self.assertEqual(expected_shift_results, shift_results)
+
+
+class SpreadEvenlyStrategyTest(unittest.TestCase):
+    def test__shift__spreads_shifted_energy_evenly_after_congestion(self):
+        # Arrange
+        flex_window, charge_sessions = charging_sessions_test_data()
+        session_batch = SessionBatch(charge_sessions[:1], flex_window, IntRangeInBlock(2, 4))
+
+        # Act
+        shift_results = session_batch.to_shift_results(SpreadEvenlyStrategy().shift(session_batch))
+
+        # Assert
+        expected_energy_profile = EnergyProfile(IntRangeInBlock(1, 9), [8_000_000, 0, 0, 19_600_000, 9_600_000,
+                                                                        9_600_000, 9_600_000, 9_600_000])
+        self.assertEqual(expected_energy_profile, shift_results[0].energy_profile)
+        self.assertEqual(9, shift_results[0].charged_extra_until)
+
+    def test__shift__keeps_energy_within_capacity(self):
+        # Arrange
+        flex_window, charge_sessions = charging_sessions_test_data()
+        session_batch = SessionBatch(charge_sessions, flex_window, IntRangeInBlock(3, 5))
+
+        # Act
+        shifted_energy = SpreadEvenlyStrategy().shift(session_batch)
+
+        # Assert
+        numpy.testing.assert_allclose(session_batch.default_energy.sum(axis=1), shifted_energy.sum(axis=1))
+        self.assertTrue(numpy.all(shifted_energy <= session_batch.capacity + 0.001))
+
+
+class CoordinatedFillStrategyTest(unittest.TestCase):
+    def test__shift__same_as_immediate_fill_below_capacity(self):
+        # Arrange
+        flex_window, charge_sessions = charging_sessions_test_data()
+        congestion = IntRangeInBlock(3, 5)
+        neighbourhood = NeighbourhoodLoad(EnergyProfile(IntRangeInBlock(0, 12), [0] * 12), 1_000_000_000)
+        session_batch = SessionBatch(charge_sessions, flex_window, congestion, neighbourhood)
+
+        # Act
+        shifted_energy = CoordinatedFillStrategy().shift(session_batch)
+
+        # Assert
+        numpy.testing.assert_array_equal(ImmediateFillStrategy().shift(session_batch), shifted_energy)
+
+    def test__shift__earliest_flex_window_end_first_within_capacity(self):
+        # Arrange
+        start_time = datetime(year=2022, month=3, day=1, hour=13, minute=0, second=0)
+        end_time = datetime(year=2022, month=3, day=1, hour=15, minute=0, second=0)
+        flex_window = BlockMetadata(start_time, end_time, timedelta(minutes=10))
+        max_charging_power_watt = 40_000  # Can charge 24.000.000 joule per 10 minutes / timestep
+        charge_sessions = [ChargingSession(DecimalRangeInBlock(0, 5),
+                                           max_charging_power_watt,
+                                           EnergyProfile(IntRangeInBlock(0, 5), [24_000_000, 24_000_000, 0, 0, 0]),
+                                           flex_window),
+                           ChargingSession(DecimalRangeInBlock(0, 3),
+                                           max_charging_power_watt,
+                                           EnergyProfile(IntRangeInBlock(0, 3), [24_000_000, 24_000_000, 0]),
+                                           flex_window)]
+        neighbourhood = NeighbourhoodLoad(EnergyProfile(IntRangeInBlock(0, 5), [48_000_000, 48_000_000, 0, 0, 0]),
+                                          40_000_000)
+        session_batch = SessionBatch(charge_sessions, flex_window, IntRangeInBlock(0, 2), neighbourhood)
+
+        # Act
+        shifted_energy = CoordinatedFillStrategy().shift(session_batch)
+
+        # Assert
+        numpy.testing.assert_array_equal(numpy.array([[0, 0, 16_000_000, 24_000_000, 8_000_000],
+                                                      [12_000_000, 12_000_000, 24_000_000, 0, 0]]),
+                                         shifted_energy)
+
+    def test__shift__requires_neighbourhood(self):
+        # Arrange
+        flex_window, charge_sessions = charging_sessions_test_data()
+        session_batch = SessionBatch(charge_sessions, flex_window, IntRangeInBlock(3, 5))
+
+        # Act / Assert
+        with self.assertRaises(RuntimeError):
+            CoordinatedFillStrategy().shift(session_batch)
+
+
+class WaterFillTest(unittest.TestCase):
+    def test__water_fill__passes_energy_on_from_capped_steps(self):
+        # Arrange
+        capacity = numpy.array([[1.0, 5.0, 5.0, 0.0], [2.0, 2.0, 2.0, 2.0]])
+        energy = numpy.array([7.0, 10.0])
+
+        # Act
+        result = water_fill(capacity, energy)
+
+        # Assert
+        numpy.testing.assert_array_equal(numpy.array([[1.0, 3.0, 3.0, 0.0], [2.0, 2.0, 2.0, 2.0]]), result)
+
+
+class ShiftingStrategyTest(unittest.TestCase):
+    def test__shifting_strategy__unknown_name(self):
+        # Arrange
+        name = 'charge-at-night'
+
+        # Act / Assert
+        with self.assertRaises(RuntimeError):
+            shifting_strategy(name)
+
+    def test__init__strategy_without_shift(self):
+        # Arrange
+        class KeepDefaultStrategy(ShiftingStrategy):
+            fills_earliest_steps_first = True
+
+        # Act / Assert
+        with self.assertRaises(TypeError):
+            KeepDefaultStrategy()